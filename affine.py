@@ -1,5 +1,8 @@
+import collections
+import threading
+import numpy as np
 import tensorflow as tf
-from tf_image_augmentations import utils
+from tf_image_augmentations import utils, sampling, instrumentation
 """Affine transformations"""
 
 
@@ -32,8 +35,87 @@ def generate_zoom_matrix(zoom_h, zoom_w):
     return stretch_mat
 
 
+def generate_shear_matrices(shear_levels):
+    """Batched generate_shear_matrix, shear_levels: B -> B x 3 x 3"""
+    shear_levels = tf.convert_to_tensor(shear_levels, dtype=tf.float32)
+    zeros, ones = tf.zeros_like(shear_levels), tf.ones_like(shear_levels)
+    shear_matrices = tf.stack([tf.stack([ones, shear_levels, zeros], axis=-1),
+                               tf.stack([shear_levels, ones, zeros], axis=-1),
+                               tf.stack([zeros, zeros, ones], axis=-1)], axis=1)
+    return shear_matrices
+
+
+def generate_rotation_matrices(rotation_angles):
+    """Batched generate_rotation_matrix, rotation_angles: B -> B x 3 x 3"""
+    rotation_angles = tf.convert_to_tensor(rotation_angles, dtype=tf.float32)
+    zeros, ones = tf.zeros_like(rotation_angles), tf.ones_like(rotation_angles)
+    cos, sin = tf.cos(rotation_angles), tf.sin(rotation_angles)
+    rot_mats = tf.stack([tf.stack([cos, -sin, zeros], axis=-1),
+                         tf.stack([sin, cos, zeros], axis=-1),
+                         tf.stack([zeros, zeros, ones], axis=-1)], axis=1)
+    return rot_mats
+
+
+def generate_zoom_matrices(zoom_h, zoom_w):
+    """Batched generate_zoom_matrix, zoom_h, zoom_w: B -> B x 3 x 3"""
+    zoom_h = tf.convert_to_tensor(zoom_h, dtype=tf.float32)
+    zoom_w = tf.convert_to_tensor(zoom_w, dtype=tf.float32)
+    zeros, ones = tf.zeros_like(zoom_h), tf.ones_like(zoom_h)
+    stretch_mats = tf.stack([tf.stack([zoom_h, zeros, zeros], axis=-1),
+                             tf.stack([zeros, zoom_w, zeros], axis=-1),
+                             tf.stack([zeros, zeros, ones], axis=-1)], axis=1)
+    return stretch_mats
+
+
+def generate_rotation_matrix_3d(angle_hw, angle_dw=0.0, angle_dh=0.0):
+    """
+    Generates the 4x4 homogeneous rotation matrix of a volume (d, h, w, 1 coordinates)
+    angles in radians, rotations in the (h, w), (d, w) and (d, h) planes applied in this order
+    """
+    def plane_rotation(angle, axis_0, axis_1):
+        cos, sin = tf.cos(tf.cast(angle, tf.float32)), tf.sin(tf.cast(angle, tf.float32))
+        return tf.tensor_scatter_nd_update(tf.eye(4), [[axis_0, axis_0], [axis_0, axis_1], [axis_1, axis_0],
+                                                       [axis_1, axis_1]], [cos, -sin, sin, cos])
+    return plane_rotation(angle_dh, 0, 1) @ plane_rotation(angle_dw, 0, 2) @ plane_rotation(angle_hw, 1, 2)
+
+
+def generate_shear_matrix_3d(shear_hw, shear_dw=0.0, shear_dh=0.0):
+    """Generates the 4x4 homogeneous shear matrix of a volume, symmetric shear in each plane as in 2D"""
+    shears = tf.cast(tf.stack([shear_hw, shear_dw, shear_dh]), tf.float32)
+    return tf.tensor_scatter_nd_update(tf.eye(4), [[1, 2], [2, 1], [0, 2], [2, 0], [0, 1], [1, 0]],
+                                       tf.repeat(shears, 2))
+
+
+def generate_zoom_matrix_3d(zoom_d, zoom_h, zoom_w):
+    """Generates the 4x4 homogeneous stretch matrix of a volume, relative to the original size"""
+    return tf.linalg.diag(tf.cast(tf.stack([zoom_d, zoom_h, zoom_w, 1.0]), tf.float32))
+
+
+def transform_grid_3d(grid, img_dhw, trans_mat):
+    """Composes a DHW3 volume sampling grid with a 4x4 homogeneous transformation around the volume center"""
+    img_dhw = tf.convert_to_tensor(img_dhw)
+    dhw__img_center = tf.cast(img_dhw, tf.float32) / 2 - 0.5
+    grid_shape = tf.shape(grid)
+    sample__dhw__coords_cent = tf.reshape(grid, [-1, 3]) - dhw__img_center
+    sample__dhw1__coords_cent = tf.pad(sample__dhw__coords_cent, [[0, 0], [0, 1]], constant_values=1.0)
+    sample__dhw1__org_coords = sample__dhw1__coords_cent @ tf.linalg.matrix_transpose(tf.linalg.inv(trans_mat))
+    sample__dhw__org_coords = sample__dhw1__org_coords[:, :3] + dhw__img_center
+    return tf.reshape(sample__dhw__org_coords, grid_shape)
+
+
+@instrumentation.instrumented('affine.linear_transform_grid_3d')
+def linear_transform_grid_3d(img_dhw, trans_mat):
+    """Sampling grid of a 4x4 homogeneous transformation of a volume around its center, for sampling.sample_volume"""
+    return transform_grid_3d(sampling.identity_grid_3d(img_dhw), img_dhw, trans_mat)
+
+
+@instrumentation.instrumented('affine.linear_transform_coords')
 def linear_transform_coords(img_dims, trans_mat):
-    """Calculate the old and new pixel coordinates, image format HWC"""
+    """
+    Calculate the old and new pixel coordinates, image format HWC
+    The coordinates are trimmed to the image, so the output shape depends on the values (not XLA compatible),
+    see linear_transform_coords_batch for a fixed shape masked version
+    """
     hwc__img_center = tf.convert_to_tensor([img_dims[0] / 2, img_dims[1] / 2, 0.0], dtype=tf.float32)
     hwc__sample__new_coords = utils.image_dims_to_coordinates(img_dims)
     hwc__sample__new_coords_cent = tf.cast(hwc__sample__new_coords, tf.float32) - tf.expand_dims(hwc__img_center, 1)
@@ -51,24 +133,280 @@ def linear_transform_coords(img_dims, trans_mat):
     return hwc__sample__org_coords_trimmed, hwc__sample__new_coords_trimmed
 
 
+def _org_pixel_coords(img_hw, hw__sample__new_coords, trans_mat):
+    """Maps the (h, w) x pixel new coordinates to the original (float) coordinates, trans_mat: 3x3 or Bx3x3"""
+    img_hw = tf.convert_to_tensor(img_hw)
+    hw__img_center = tf.convert_to_tensor([img_hw[0] / 2, img_hw[1] / 2, 0.0], dtype=tf.float32)
+    hw__sample__new_coords_cent = tf.pad(tf.cast(hw__sample__new_coords, tf.float32), [[0, 1], [0, 0]]) -\
+        tf.expand_dims(hw__img_center, 1)
+    inv_trans_mat = tf.linalg.inv(trans_mat)
+    hw__sample__org_coords_cent = inv_trans_mat @ hw__sample__new_coords_cent
+    hw__sample__org_coords = hw__sample__org_coords_cent + tf.expand_dims(hw__img_center, 1)
+    return hw__sample__org_coords[..., :2, :]
+
+
+def _pixel_coords_in_image(img_hw, hw__sample__coords):
+    """Mask of the (float) pixel coordinates that fall inside the image"""
+    hw__sample__trim_mask = (hw__sample__coords < tf.cast(tf.reshape(img_hw, [2, 1]), tf.float32)) &\
+                            (hw__sample__coords >= 0.0)
+    return tf.reduce_all(hw__sample__trim_mask, axis=-2)
+
+
+def transform_grid(grid, img_hw, trans_mat):
+    """
+    Composes a sampling grid (see sampling) with a linear transformation around the image center
+    grid: HW2 or BHW2, trans_mat: 3x3 or Bx3x3
+    """
+    img_hw = tf.convert_to_tensor(img_hw)
+    hw__img_center = tf.convert_to_tensor([img_hw[0] / 2 - 0.5, img_hw[1] / 2 - 0.5, 0.0], dtype=tf.float32)
+    grid_shape = tf.shape(grid)
+    sample__hw__coords = tf.reshape(grid, tf.concat([grid_shape[:-3], [-1, 2]], axis=0))
+    hw__sample__coords = tf.linalg.matrix_transpose(sample__hw__coords)
+    paddings = tf.concat([tf.zeros([tf.rank(hw__sample__coords) - 2, 2], tf.int32), [[0, 1], [0, 0]]], axis=0)
+    hw__sample__coords_cent = tf.pad(hw__sample__coords, paddings) - tf.expand_dims(hw__img_center, 1)
+    hw__sample__org_coords = tf.linalg.inv(trans_mat) @ hw__sample__coords_cent + tf.expand_dims(hw__img_center, 1)
+    sample__hw__org_coords = tf.linalg.matrix_transpose(hw__sample__org_coords[..., :2, :])
+    out_shape = tf.concat([tf.shape(sample__hw__org_coords)[:-2], grid_shape[-3:]], axis=0)
+    return tf.reshape(sample__hw__org_coords, out_shape)
+
+
+def transform_points(points, img_hw, trans_mat, pixel_centers=True):
+    """
+    Moves points by a linear transformation around the image center, to where linear_transform_grid samples them from
+    points: ...N2 (h, w) pixel coordinates, N2 with a 3x3 trans_mat or BN2 with a Bx3x3 trans_mat
+    pixel_centers: the linear_transform_grid convention, with False a point moves to the center of the output pixels
+    whose truncated source coordinates fall in its pixel
+    """
+    img_hw = tf.cast(img_hw, tf.float32)
+    points = tf.cast(points, tf.float32)
+    # The truncation reads pixel (h, w) for the source coordinates in [h, h + 1) x [w, w + 1), around (H/2, W/2)
+    truncated_shift = 0.5 - 0.5 * tf.cast(pixel_centers, tf.float32)
+    hw__img_center = img_hw / 2 - 0.5 + truncated_shift
+    points = points + truncated_shift
+    return (points - hw__img_center) @ tf.linalg.matrix_transpose(trans_mat[..., :2, :2]) + hw__img_center
+
+
+def _truncated_transform_grid(img_hw, trans_mat):
+    """The original coordinates of linear_transform_coords, truncated to whole pixels, as an HW2 or BHW2 grid"""
+    img_hw = tf.convert_to_tensor(img_hw)
+    hw__sample__org_coords = tf.floor(_org_pixel_coords(img_hw, utils.image_hw_to_coordinates(img_hw), trans_mat))
+    sample__hw__org_coords = tf.linalg.matrix_transpose(hw__sample__org_coords)
+    out_shape = tf.concat([tf.shape(sample__hw__org_coords)[:-2], img_hw, [2]], axis=0)
+    return tf.reshape(sample__hw__org_coords, out_shape)
+
+
+@instrumentation.instrumented('affine.linear_transform_grid')
+def linear_transform_grid(img_hw, trans_mat, pixel_centers=True):
+    """
+    Sampling grid of a linear transformation around the image center (see sampling), for sampling.sample_image
+    trans_mat: 3x3 -> HW2 grid, or Bx3x3 -> BHW2 grid
+    pixel_centers: False for the pixels of linear_transform_image, the center is (H/2, W/2) and the source
+    coordinates are truncated to whole pixels (the same pixels with nearest sampling, no bilinear blend)
+    """
+    if not pixel_centers:
+        return _truncated_transform_grid(img_hw, trans_mat)
+    return transform_grid(sampling.identity_grid(img_hw), img_hw, trans_mat)
+
+
+def linear_transform_tiles(org_img, trans_mat, tile_hw=(512, 512), interpolation='nearest', fill_value=0.0,
+                           compute_dtype=tf.float32):
+    """
+    Tiled sampling.sample_image(org_img, linear_transform_grid(img_hw, trans_mat)) for very large images,
+    a generator of (offset_h, offset_w, tile) output tiles identical to the untiled result,
+    see sampling.sample_image_tiles and sampling.assemble_tiles
+    org_img: HWC tensor or numpy array (a numpy memmap is read tile by tile)
+    """
+    img_hw = tuple(int(dim) for dim in org_img.shape[:2])
+
+    def grid_fcn(offset_hw, tile_size):
+        tile_grid = sampling.identity_grid(tile_size) + tf.cast(offset_hw, tf.float32)
+        return transform_grid(tile_grid, img_hw, trans_mat)
+    return sampling.sample_image_tiles(org_img, grid_fcn, img_hw, tile_hw, interpolation, fill_value, compute_dtype)
+
+
+@instrumentation.instrumented('affine.linear_transform_from_coords')
 def linear_transform_from_coords(org_img, org_pixel_coords, new_pixel_coords, fill_value=0.0):
+    """Moves the pixels to their new coordinates, in the image dtype (no float32 copy)"""
     img_dims = tf.shape(org_img)
-    new_img = tf.fill(img_dims, fill_value)
+    new_img = tf.fill(img_dims, tf.cast(fill_value, org_img.dtype))
     new_img = tf.tensor_scatter_nd_update(new_img,
                                           tf.transpose(new_pixel_coords),
-                                          tf.gather_nd(tf.cast(org_img, tf.float32), tf.transpose(org_pixel_coords)))
-    new_img = tf.cast(new_img, org_img.dtype)
+                                          tf.gather_nd(org_img, tf.transpose(org_pixel_coords)))
     return new_img
 
 
+@instrumentation.instrumented('affine.linear_transform_image')
 def linear_transform_image(org_img, rotation_angle=0.0, shear_factor=0.0, zoom_h=1.0, zoom_w=1.0, fill_value=0.0):
-    """Applies liner transformation to an image"""
+    """Applies liner transformation to an image, as a fixed shape masked gather (graph and XLA friendly)"""
     rot_mat = generate_rotation_matrix(rotation_angle)
     shear_mat = generate_shear_matrix(shear_factor)
     stretch_mat = generate_zoom_matrix(zoom_h, zoom_w)
     trans_mat = rot_mat @ shear_mat @ stretch_mat
+    img_hw = tf.shape(org_img)[:2]
+    org_pixel_coords, valid_mask = linear_transform_coords_batch(img_hw, tf.expand_dims(trans_mat, 0))
+    new_img = linear_transform_from_coords_batch(utils.hwc_to_bhwc(org_img), org_pixel_coords, valid_mask, fill_value)
+    return utils.bhwc_to_hwc(new_img)
+
+
+@instrumentation.instrumented('affine.linear_transform_coords_batch')
+def linear_transform_coords_batch(img_hw, trans_mats):
+    """
+    Calculate the old pixel coordinates of a batch of transformations on the same HW grid
+    Unlike linear_transform_coords nothing is trimmed, the output shape is fixed:
+    org coords B x 2 x (H*W) int32 (row major pixel order), valid mask B x (H*W)
+    """
+    hw__sample__new_coords = utils.image_hw_to_coordinates(img_hw)
+    b__hw__sample__org_coords = _org_pixel_coords(img_hw, hw__sample__new_coords, trans_mats)
+    b__sample__valid_mask = _pixel_coords_in_image(img_hw, b__hw__sample__org_coords)
+
+    b__hw__sample__org_coords = tf.where(tf.expand_dims(b__sample__valid_mask, -2), b__hw__sample__org_coords, 0.0)
+    b__hw__sample__org_coords = tf.cast(b__hw__sample__org_coords, tf.int32)
+    return b__hw__sample__org_coords, b__sample__valid_mask
+
+
+@instrumentation.instrumented('affine.linear_transform_from_coords_batch')
+def linear_transform_from_coords_batch(org_imgs, org_pixel_coords, valid_mask, fill_value=0.0):
+    """
+    Gathers a batch of images (BHWC) from the output of linear_transform_coords_batch
+    Pixels with no valid source are set to fill_value
+    """
+    img_dims = tf.shape(org_imgs)
+    b__sample__hw = tf.transpose(org_pixel_coords, [0, 2, 1])
+    new_imgs = tf.gather_nd(org_imgs, b__sample__hw, batch_dims=1)
+    new_imgs = tf.where(tf.expand_dims(valid_mask, -1), new_imgs, tf.cast(fill_value, org_imgs.dtype))
+    new_imgs = tf.reshape(new_imgs, img_dims)
+    return new_imgs
+
+
+@instrumentation.instrumented('affine.linear_transform_image_batch')
+def linear_transform_image_batch(org_imgs, rotation_angles, shear_factors, zoom_h, zoom_w, fill_value=0.0):
+    """Applies a different linear transformation to each image of a BHWC batch in a single gather"""
+    rot_mats = generate_rotation_matrices(rotation_angles)
+    shear_mats = generate_shear_matrices(shear_factors)
+    stretch_mats = generate_zoom_matrices(zoom_h, zoom_w)
+    trans_mats = rot_mats @ shear_mats @ stretch_mats
+    img_hw = tf.shape(org_imgs)[1:3]
+    org_pixel_coords, valid_mask = linear_transform_coords_batch(img_hw, trans_mats)
+    new_imgs = linear_transform_from_coords_batch(org_imgs, org_pixel_coords, valid_mask, fill_value)
+    return new_imgs
+
+
+@instrumentation.instrumented('affine.gather_by_index_table')
+def gather_by_index_table(org_img, index_table, fill_value=0.0):
+    """
+    Warps an HWC image by a flat gather-index table (see AffineIndexCache) in a single gather,
+    index H * W (one past the last pixel) is the fill value
+    """
     img_dims = tf.shape(org_img)
-    org_pixel_coords, new_pixel_coords = linear_transform_coords(img_dims, trans_mat)
-    new_img = linear_transform_from_coords(org_img, org_pixel_coords, new_pixel_coords, fill_value)
-    return new_img
+    pixel__channel__img = tf.reshape(org_img, [img_dims[0] * img_dims[1], -1])
+    fill_pixel = tf.fill([1, tf.shape(pixel__channel__img)[1]], tf.cast(fill_value, org_img.dtype))
+    pixel__channel__img = tf.concat([pixel__channel__img, fill_pixel], axis=0)
+    return tf.reshape(tf.gather(pixel__channel__img, index_table), img_dims)
+
+
+class AffineIndexCache:
+    """
+    Bounded LRU cache of the nearest neighbour gather-index tables of quantized affine transformations,
+    keyed by (image size, quantized rotation, shear, zoom_h, zoom_w, flips)
+    The parameters are rounded to multiples of the steps, then a warp is a table lookup and gather_by_index_table
+    instead of building the coordinates, the inverse matrix and the trim mask on every call.
+    Same warp as sampling.sample_image on linear_transform_grid of the quantized parameters (and flip_grid),
+    up to the float rounding of points exactly between two pixels
+    pixel_centers: the linear_transform_grid convention, False for the pixels of linear_transform_image
+    The lookups run in tf.numpy_function under a lock, so one cache can be shared by parallel Dataset.map calls
+    (not XLA compatible)
+    Memory: entries * H * W int32
+    """
+    def __init__(self, max_entries=64, rotation_step=np.pi / 180, shear_step=0.01, zoom_step=0.01,
+                 pixel_centers=False):
+        self.max_entries = max_entries
+        self.pixel_centers = pixel_centers
+        self.steps = np.array([rotation_step, shear_step, zoom_step, zoom_step], np.float32)
+        self._tables = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def quantize(self, rotation_angle, shear_factor, zoom_h, zoom_w):
+        """The integer multiples of the steps closest to the parameters"""
+        params = tf.stack([tf.cast(param, tf.float32) for param in (rotation_angle, shear_factor, zoom_h, zoom_w)])
+        return tf.cast(tf.round(params / self.steps), tf.int64)
+
+    def _build_table(self, img_hw, quantized, flips):
+        height, width = (int(v) for v in img_hw)
+        rotation_angle, shear_factor, zoom_h, zoom_w = quantized * self.steps
+        rot_mat = np.array([[np.cos(rotation_angle), -np.sin(rotation_angle)],
+                            [np.sin(rotation_angle), np.cos(rotation_angle)]], np.float32)
+        shear_mat = np.array([[1.0, shear_factor], [shear_factor, 1.0]], np.float32)
+        trans_mat = rot_mat @ shear_mat @ np.diag([zoom_h, zoom_w]).astype(np.float32)
+        hw__img_center = np.array([height / 2, width / 2], np.float32) - (0.5 if self.pixel_centers else 0.0)
+        pixel__hw__coords = np.stack(np.meshgrid(np.arange(height, dtype=np.float32),
+                                                 np.arange(width, dtype=np.float32), indexing='ij'), -1)
+        pixel__hw__coords = pixel__hw__coords.reshape(-1, 2)
+        pixel__hw__org = (pixel__hw__coords - hw__img_center) @ np.linalg.inv(trans_mat).T + hw__img_center
+        if not self.pixel_centers:
+            pixel__hw__org = np.floor(pixel__hw__org)
+        hw__limits = np.array([height, width])
+        # The flips are applied to the image before the transformation, as in seg_aug.sample_affine_plan
+        pixel__hw__org = np.where(flips.astype(bool)[::-1], hw__limits - 1 - pixel__hw__org, pixel__hw__org)
+        pixel__hw__idxs = np.floor(pixel__hw__org + 0.5).astype(np.int64)
+        pixel__valid = np.all((pixel__hw__idxs >= 0) & (pixel__hw__idxs < hw__limits), axis=-1)
+        index_table = np.where(pixel__valid, pixel__hw__idxs[:, 0] * width + pixel__hw__idxs[:, 1], height * width)
+        return index_table.astype(np.int32)
+
+    def _lookup(self, img_hw, quantized, flips):
+        key = tuple(int(v) for v in np.concatenate([img_hw, quantized, flips]))
+        with self._lock:
+            index_table = self._tables.get(key)
+            if index_table is not None:
+                self._tables.move_to_end(key)
+                self._hits += 1
+                return index_table
+            self._misses += 1
+        # Built outside the lock, a concurrent miss on the same key builds the same table
+        index_table = self._build_table(img_hw, quantized, flips)
+        with self._lock:
+            self._tables[key] = index_table
+            self._tables.move_to_end(key)
+            while len(self._tables) > self.max_entries:
+                self._tables.popitem(last=False)
+                self._evictions += 1
+        return index_table
+
+    def index_table(self, img_hw, rotation_angle, shear_factor, zoom_h, zoom_w, flip_lr=False, flip_ud=False):
+        """The flat H * W gather-index table of the quantized transformation, for gather_by_index_table"""
+        img_hw = tf.cast(img_hw, tf.int64)
+        flips = tf.cast(tf.stack([flip_lr, flip_ud]), tf.int64)
+        index_table = tf.numpy_function(self._lookup,
+                                        [img_hw, self.quantize(rotation_angle, shear_factor, zoom_h, zoom_w), flips],
+                                        tf.int32, stateful=True)
+        return tf.reshape(index_table, [img_hw[0] * img_hw[1]])
+
+    def transform_image(self, org_img, rotation_angle=0.0, shear_factor=0.0, zoom_h=1.0, zoom_w=1.0,
+                        fill_value=0.0):
+        """linear_transform_image with quantized parameters, by a cached gather-index table"""
+        index_table = self.index_table(tf.shape(org_img)[:2], rotation_angle, shear_factor, zoom_h, zoom_w)
+        return gather_by_index_table(org_img, index_table, fill_value)
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+
+    @property
+    def memory_bytes(self):
+        with self._lock:
+            return sum(index_table.nbytes for index_table in self._tables.values())
+
+    def statistics(self):
+        """Lookups, hit rate, evictions, number of cached tables and their memory"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            statistics = {'hits': self._hits,
+                          'misses': self._misses,
+                          'hit_rate': self._hits / lookups if lookups else 0.0,
+                          'evictions': self._evictions,
+                          'entries': len(self._tables)}
+        statistics['memory_bytes'] = self.memory_bytes
+        return statistics
 
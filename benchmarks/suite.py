@@ -0,0 +1,240 @@
+"""Throughput and peak memory benchmarks of the augmentations, CPU-only Linux
+usage: python -m tf_image_augmentations.benchmarks.suite --sizes 128 512 --output results.json
+       python -m tf_image_augmentations.benchmarks.suite --baseline results.json --max-slowdown 0.1
+Every case runs eagerly and in a tf.data map (num_parallel_calls, batched before or after the map),
+results are json records keyed by case, image size, channels, dtype, mode, num_parallel_calls and batching"""
+import argparse
+import collections
+import itertools
+import json
+import os
+import platform
+import threading
+import time
+import tensorflow as tf
+from tf_image_augmentations import affine, elastic, seg_aug, binary_mask
+
+
+# A case builds a map function fcn(image, label) for an image size, channels and dtype,
+# batched cases expect BHWC batches (mapped after Dataset.batch)
+Case = collections.namedtuple('Case', ['name', 'build_fcn', 'batched'])
+
+CASES = [
+    Case('affine.linear_transform_image',
+         lambda: lambda image, label: affine.linear_transform_image(image, 0.3, 0.1, 1.1, 0.9), False),
+    Case('affine.linear_transform_image_batch',
+         lambda: lambda images, labels: affine.linear_transform_image_batch(
+             images, tf.fill([tf.shape(images)[0]], 0.3), tf.fill([tf.shape(images)[0]], 0.1),
+             tf.fill([tf.shape(images)[0]], 1.1), tf.fill([tf.shape(images)[0]], 0.9)), True),
+    Case('elastic.generate_random_elastic_flow',
+         lambda: lambda image, label: elastic.generate_random_elastic_flow(tf.shape(image), 3, 10.0), False),
+    # The same sigma for both generators, the coarse flow should never be slower
+    Case('elastic.generate_random_elastic_flow_sigma_8',
+         lambda: lambda image, label: elastic.generate_random_elastic_flow(tf.shape(image), 8, 10.0), False),
+    Case('elastic.generate_coarse_elastic_flow',
+         lambda: lambda image, label: elastic.generate_coarse_elastic_flow(tf.shape(image), 8, 10.0), False),
+    Case('elastic.warp_image_by_flow',
+         lambda: lambda image, label: elastic.warp_image_by_flow(
+             image, tf.random.uniform(tf.concat([tf.shape(image)[:2], [2]], 0), -3.0, 3.0)), False),
+    Case('seg_aug.random_affine_transform_fcn',
+         lambda: seg_aug.random_affine_transform_fcn(-0.5, 0.5, -0.2, 0.2, 0.8, 1.2, 0.5, 0.5), False),
+    Case('seg_aug.random_affine_transform_batch_fcn',
+         lambda: seg_aug.random_affine_transform_batch_fcn(-0.5, 0.5, -0.2, 0.2, 0.8, 1.2, 0.5, 0.5), True),
+    Case('seg_aug.elastic_augmentation_fcn',
+         lambda: seg_aug.elastic_augmentation_fcn(3, 10.0), False),
+    Case('seg_aug.GeometricPipeline',
+         lambda: seg_aug.GeometricPipeline().flip(0.5, 0.5).affine(-0.5, 0.5, -0.2, 0.2, 0.8, 1.2).elastic(3, 10.0),
+         False),
+    Case('seg_aug.AugmentationPolicy',
+         lambda: seg_aug.AugmentationPolicy().flip(0.5, 0.5).affine(0.5, -0.5, 0.5, -0.2, 0.2, 0.8, 1.2)
+         .elastic(0.5, 3, 10.0), False),
+    Case('binary_mask.tight_box_coordinates',
+         lambda: lambda image, label: binary_mask.tight_box_coordinates(label), False),
+    Case('binary_mask.loose_box_coordinates',
+         lambda: lambda image, label: binary_mask.loose_box_coordinates(label, 0.05), False),
+    Case('binary_mask.instance_tight_box_coordinates',
+         lambda: lambda images, labels: binary_mask.instance_tight_box_coordinates(labels, 16), True),
+]
+
+DEFAULT_SIZES = (128, 256, 512, 1024, 2048)
+DEFAULT_CHANNELS = (1, 3)
+DEFAULT_DTYPES = ('uint8', 'float32')
+DEFAULT_PARALLEL_CALLS = (1, 4)
+DEFAULT_BATCH_SIZE = 8
+KEY_FIELDS = ('case', 'size', 'channels', 'dtype', 'mode', 'num_parallel_calls', 'batching')
+
+
+class PeakRssSampler:
+    """Samples the resident memory of the process (/proc/self/statm) in a thread, peak_bytes is above the start"""
+    def __init__(self, interval_seconds=0.002):
+        self.interval_seconds = interval_seconds
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._page_size = os.sysconf('SC_PAGE_SIZE')
+
+    def _rss_bytes(self):
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * self._page_size
+
+    def _sample(self):
+        while not self._stop.wait(self.interval_seconds):
+            self.peak_bytes = max(self.peak_bytes, self._rss_bytes() - self._start_bytes)
+
+    def __enter__(self):
+        self._start_bytes = self._rss_bytes()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, self._rss_bytes() - self._start_bytes)
+
+
+def generate_sample(size, channels, dtype):
+    """A random image and a single object label (a centered box) of the given size"""
+    max_value = 255 if dtype == 'uint8' else 1.0
+    image = tf.cast(tf.random.uniform([size, size, channels], maxval=max_value), dtype)
+    box = tf.pad(tf.ones([size // 2, size // 2, 1], tf.uint8),
+                 [[size // 4, size - size // 2 - size // 4]] * 2 + [[0, 0]])
+    return image, box
+
+
+def _time_eager(fcn, image, label, num_elements):
+    fcn(image, label)
+    start = time.perf_counter()
+    for _ in range(num_elements):
+        fcn(image, label)
+    return time.perf_counter() - start
+
+
+def _time_dataset(fcn, image, label, num_elements, num_parallel_calls, batching, batch_size):
+    dataset = tf.data.Dataset.from_tensors((image, label)).repeat()
+    if batching == 'before':
+        dataset = dataset.batch(batch_size).map(fcn, num_parallel_calls=num_parallel_calls)
+        num_batches = max(1, num_elements // batch_size)
+    else:
+        dataset = dataset.map(fcn, num_parallel_calls=num_parallel_calls)
+        num_batches = num_elements
+        if batching == 'after':
+            dataset = dataset.batch(batch_size)
+            num_batches = max(1, num_elements // batch_size)
+    iterator = iter(dataset.prefetch(1))
+    next(iterator)
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        next(iterator)
+    elapsed = time.perf_counter() - start
+    return elapsed, num_batches * (batch_size if batching != 'none' else 1)
+
+
+def run_case(case, size, channels, dtype, mode, num_parallel_calls=None, batching='none',
+             num_elements=16, batch_size=DEFAULT_BATCH_SIZE):
+    """Runs one benchmark configuration, returns its json record"""
+    image, label = generate_sample(size, channels, dtype)
+    fcn = case.build_fcn()
+    with PeakRssSampler() as memory:
+        if mode == 'eager':
+            if case.batched:
+                image, label = tf.stack([image] * batch_size), tf.stack([label] * batch_size)
+            elapsed = _time_eager(fcn, image, label, num_elements)
+            num_images = num_elements * (batch_size if case.batched else 1)
+        else:
+            elapsed, num_images = _time_dataset(fcn, image, label, num_elements, num_parallel_calls,
+                                                batching, batch_size)
+    return {'case': case.name, 'size': size, 'channels': channels, 'dtype': dtype, 'mode': mode,
+            'num_parallel_calls': num_parallel_calls, 'batching': batching,
+            'images_per_sec': num_images / elapsed, 'peak_memory_bytes': memory.peak_bytes}
+
+
+def configurations(cases=CASES, sizes=DEFAULT_SIZES, channels=DEFAULT_CHANNELS, dtypes=DEFAULT_DTYPES,
+                   parallel_calls=DEFAULT_PARALLEL_CALLS):
+    """All the (case, size, channels, dtype, mode, num_parallel_calls, batching) combinations"""
+    for case, size, num_channels, dtype in itertools.product(cases, sizes, channels, dtypes):
+        yield case, size, num_channels, dtype, 'eager', None, 'none'
+        batchings = ('before',) if case.batched else ('none', 'after')
+        for num_parallel_calls, batching in itertools.product(parallel_calls, batchings):
+            yield case, size, num_channels, dtype, 'dataset', num_parallel_calls, batching
+
+
+def run_suite(cases=CASES, sizes=DEFAULT_SIZES, channels=DEFAULT_CHANNELS, dtypes=DEFAULT_DTYPES,
+              parallel_calls=DEFAULT_PARALLEL_CALLS, num_elements=16, batch_size=DEFAULT_BATCH_SIZE, log=print):
+    """Runs all the configurations, returns the results document"""
+    records = []
+    for case, size, num_channels, dtype, mode, num_parallel_calls, batching in configurations(
+            cases, sizes, channels, dtypes, parallel_calls):
+        record = run_case(case, size, num_channels, dtype, mode, num_parallel_calls, batching,
+                          num_elements, batch_size)
+        records.append(record)
+        if log is not None:
+            log(f"{record['case']} {size}x{size}x{num_channels} {dtype} {mode} "
+                f"calls={num_parallel_calls} batching={batching}: {record['images_per_sec']:.1f} images/sec, "
+                f"{record['peak_memory_bytes'] / 2 ** 20:.1f} MiB")
+    return {'tensorflow': tf.__version__, 'platform': platform.platform(), 'results': records}
+
+
+def record_key(record):
+    return tuple(record[field] for field in KEY_FIELDS)
+
+
+def compare(results, baseline, max_slowdown=0.1, max_memory_increase=0.2, memory_tolerance_bytes=2 ** 20):
+    """
+    Regressions of results against a baseline results document, for the configurations present in both:
+    throughput lower by more than max_slowdown or peak memory higher by more than max_memory_increase (fractions)
+    memory_tolerance_bytes: increases smaller than this are sampling noise and never regressions
+    """
+    baseline_records = {record_key(record): record for record in baseline['results']}
+    regressions = []
+    for record in results['results']:
+        baseline_record = baseline_records.get(record_key(record))
+        if baseline_record is None:
+            continue
+        slowdown = 1.0 - record['images_per_sec'] / baseline_record['images_per_sec']
+        if slowdown > max_slowdown:
+            regressions.append({'key': record_key(record), 'metric': 'images_per_sec',
+                                'baseline': baseline_record['images_per_sec'], 'value': record['images_per_sec']})
+        memory_limit = max(baseline_record['peak_memory_bytes'] * (1.0 + max_memory_increase),
+                           baseline_record['peak_memory_bytes'] + memory_tolerance_bytes)
+        if record['peak_memory_bytes'] > memory_limit:
+            regressions.append({'key': record_key(record), 'metric': 'peak_memory_bytes',
+                                'baseline': baseline_record['peak_memory_bytes'],
+                                'value': record['peak_memory_bytes']})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--cases', nargs='*', help='case names (substrings), default all')
+    parser.add_argument('--sizes', nargs='*', type=int, default=DEFAULT_SIZES)
+    parser.add_argument('--channels', nargs='*', type=int, default=DEFAULT_CHANNELS)
+    parser.add_argument('--dtypes', nargs='*', default=DEFAULT_DTYPES)
+    parser.add_argument('--parallel-calls', nargs='*', type=int, default=DEFAULT_PARALLEL_CALLS)
+    parser.add_argument('--num-elements', type=int, default=16)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--output', help='json file to write the results to')
+    parser.add_argument('--baseline', help='json results to compare to, exits with 1 on regressions')
+    parser.add_argument('--max-slowdown', type=float, default=0.1)
+    parser.add_argument('--max-memory-increase', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    cases = [case for case in CASES if not args.cases or any(name in case.name for name in args.cases)]
+    results = run_suite(cases, args.sizes, args.channels, args.dtypes, args.parallel_calls,
+                        args.num_elements, args.batch_size)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.max_slowdown, args.max_memory_increase)
+        for regression in regressions:
+            print(f"REGRESSION {regression['key']} {regression['metric']}: "
+                  f"{regression['baseline']} -> {regression['value']}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
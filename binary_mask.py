@@ -27,3 +27,50 @@ def loose_box_coordinates(binary_mask, margin):
     boxes = tf.convert_to_tensor([new_min_y, new_min_x, new_max_y, new_max_x], dtype=tf.float32)
     return boxes
 
+
+def instance_tight_box_coordinates(instance_maps, num_instances, ragged=False):
+    """
+    Calculates the minimal encapsulating rectangles of all the instances of a batch of instance ID maps in one pass
+    instance_maps: BHW or BHW1 integer IDs, 0 is the background and 1..num_instances are the instances
+    Returns the B x num_instances x 4 boxes (same format as tight_box_coordinates, missing instances get zeros) and
+    the B x num_instances mask of the present instances, or a ragged B x (present instances) x 4 tensor if ragged
+    """
+    if instance_maps.shape.rank == 4:
+        instance_maps = tf.squeeze(instance_maps, -1)
+    tf.assert_rank(instance_maps, 3, 'expected a BHW instance map')
+    maps_shape = tf.shape(instance_maps, out_type=tf.int64)
+    batch_size, height, width = tf.unstack(maps_shape)
+
+    # One segment per (image, instance), and a last segment for the background and the out of range IDs
+    instance_ids = tf.cast(instance_maps, tf.int64)
+    in_range = (instance_ids > 0) & (instance_ids <= num_instances)
+    num_segments = batch_size * num_instances + 1
+    segment_ids = tf.where(in_range, tf.reshape(tf.range(batch_size), [-1, 1, 1]) * num_instances + instance_ids - 1,
+                           num_segments - 1)
+    y_idxs = tf.broadcast_to(tf.reshape(tf.range(height), [1, -1, 1]), maps_shape)
+    x_idxs = tf.broadcast_to(tf.reshape(tf.range(width), [1, 1, -1]), maps_shape)
+
+    min_y = tf.math.unsorted_segment_min(y_idxs, segment_ids, num_segments)[:-1]
+    max_y = tf.math.unsorted_segment_max(y_idxs, segment_ids, num_segments)[:-1]
+    min_x = tf.math.unsorted_segment_min(x_idxs, segment_ids, num_segments)[:-1]
+    max_x = tf.math.unsorted_segment_max(x_idxs, segment_ids, num_segments)[:-1]
+    # Empty segments get the dtype max as min and the dtype min as max
+    present = min_y <= max_y
+
+    boxes = tf.stack([min_y / (height - 1), min_x / (width - 1), max_y / (height - 1), max_x / (width - 1)], axis=-1)
+    boxes = tf.where(tf.expand_dims(present, -1), tf.cast(boxes, tf.float32), 0.0)
+    boxes = tf.reshape(boxes, [batch_size, num_instances, 4])
+    present = tf.reshape(present, [batch_size, num_instances])
+    if ragged:
+        return tf.ragged.boolean_mask(boxes, present)
+    return boxes, present
+
+
+def instance_loose_box_coordinates(instance_maps, num_instances, margin, ragged=False):
+    """instance_tight_box_coordinates with margin added from each side, as in loose_box_coordinates"""
+    boxes, present = instance_tight_box_coordinates(instance_maps, num_instances)
+    boxes = tf.clip_by_value(boxes + [-margin, -margin, margin, margin], 0.0, 1.0)
+    boxes = tf.where(tf.expand_dims(present, -1), boxes, 0.0)
+    if ragged:
+        return tf.ragged.boolean_mask(boxes, present)
+    return boxes, present
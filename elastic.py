@@ -1,8 +1,12 @@
+import math
+import threading
+import numpy as np
 import tensorflow as tf
 import tensorflow_addons as tfa
-from tf_image_augmentations import utils
+from tf_image_augmentations import utils, sampling, instrumentation
 
 
+@instrumentation.instrumented('elastic.generate_random_elastic_flow')
 def generate_random_elastic_flow(img_size, elasticity_coefficient, deformation_intensity):
     """
     Generates a random flow field for elastic deformation
@@ -15,24 +19,327 @@ def generate_random_elastic_flow(img_size, elasticity_coefficient, deformation_i
     return elastic_flow
 
 
-def warp_image_by_flow(img, flow):
+def _blur_separable(img, kernel):
+    """Blurs an HWC image by a 1D kernel along the height and the width, no padding"""
+    channels = tf.shape(img)[-1]
+    kernel = tf.cast(kernel, tf.float32)
+    kernel_h = tf.tile(tf.reshape(kernel, [-1, 1, 1, 1]), [1, 1, channels, 1])
+    kernel_w = tf.tile(tf.reshape(kernel, [1, -1, 1, 1]), [1, 1, channels, 1])
+    blurred = tf.nn.depthwise_conv2d(utils.hwc_to_bhwc(img), kernel_h, strides=[1, 1, 1, 1], padding='VALID')
+    blurred = tf.nn.depthwise_conv2d(blurred, kernel_w, strides=[1, 1, 1, 1], padding='VALID')
+    return utils.bhwc_to_hwc(blurred)
+
+
+def _blur_fft(img, kernel):
+    """Circular convolution of an HWC image by a 1D kernel along the height and the width"""
+    height, width = tf.unstack(tf.shape(img)[:2])
+    kernel = tf.cast(kernel, tf.float32)
+
+    def kernel_response(n):
+        # The kernel wrapped around a length n signal
+        wrapped = tf.math.unsorted_segment_sum(kernel, tf.range(tf.size(kernel)) % n, n)
+        return tf.signal.rfft(wrapped), tf.signal.fft(tf.cast(wrapped, tf.complex64))
+
+    _, response_h = kernel_response(height)
+    response_w, _ = kernel_response(width)
+    spectrum = tf.signal.rfft2d(tf.transpose(tf.cast(img, tf.float32), [2, 0, 1]))
+    blurred = tf.signal.irfft2d(spectrum * response_h[:, None] * response_w[None, :], fft_length=[height, width])
+    return tf.transpose(blurred, [1, 2, 0])
+
+
+def _random_flow_kernel_1d(sigma):
+    """The 1D kernel of generate_random_elastic_flow: tfa gaussian_filter2d truncated at filter_shape = sigma taps"""
+    filter_shape = max(1, int(sigma))
+    offsets = np.arange(-filter_shape // 2 + 1, filter_shape // 2 + 1)
+    kernel = np.exp(-offsets ** 2 / (2.0 * float(sigma) ** 2))
+    return offsets, kernel / np.sum(kernel)
+
+
+def _interpolation_weights(method, phase):
+    """Weights of the control points at offsets -1, 0, 1, 2 for a point at phase in [0, 1) between 0 and 1"""
+    if method == 'bicubic':
+        # Keys cubic with a = -0.5, as tf.image.resize
+        distances = np.abs(np.array([-1.0, 0.0, 1.0, 2.0]) - phase)
+        return np.where(distances <= 1, 1.5 * distances ** 3 - 2.5 * distances ** 2 + 1,
+                        np.where(distances < 2, -0.5 * distances ** 3 + 2.5 * distances ** 2 - 4 * distances + 2, 0.0))
+    return np.array([0.0, 1.0 - phase, phase, 0.0])
+
+
+def coarse_flow_kernel(elasticity_coefficient, grid_spacing, upsampling='bilinear', half_pixel=False):
+    """
+    The control grid counterpart of the generate_random_elastic_flow blur, so the coarse flows have the same
+    amplitude and smoothness: the 1D kernel taps of every control point cell are summed, and the noise scale per axis
+    makes the variance of the interpolated field (averaged over the positions between control points) the variance
+    of the full resolution blur. Returns the coarse 1D kernel and the noise scale per axis
+    upsampling: 'bilinear' or 'bicubic', half_pixel: the control points are at pixel centers (tf.image.resize)
+    """
+    offsets, kernel = _random_flow_kernel_1d(elasticity_coefficient)
+    cells = np.floor(offsets / grid_spacing + 0.5).astype(np.int64)
+    coarse_kernel = np.bincount(cells - cells.min(), weights=kernel)
+    # Autocovariance of the blurred unit variance noise, by control point lag
+    autocov = np.array([np.sum(coarse_kernel[lag:] * coarse_kernel[:len(coarse_kernel) - lag]) for lag in range(4)])
+    positions = np.arange(grid_spacing) / grid_spacing
+    if half_pixel:
+        positions = (positions + 0.5 / grid_spacing - 0.5) % 1.0
+    lags = np.abs(np.arange(4)[:, None] - np.arange(4)[None, :])
+    interpolated_var = np.mean([weights @ autocov[lags] @ weights
+                                for weights in (_interpolation_weights(upsampling, phase) for phase in positions)])
+    return coarse_kernel.astype(np.float32), math.sqrt(np.sum(kernel ** 2) / interpolated_var)
+
+
+# Blur taps of generate_random_elastic_flow (H * W * sigma ** 2) below which the fixed cost of the control grid ops
+# is higher than the full resolution blur (measured on CPU), generate_coarse_elastic_flow falls back to it
+COARSE_FLOW_MIN_TAPS = 2 ** 23
+
+
+@instrumentation.instrumented('elastic.generate_coarse_elastic_flow')
+def generate_coarse_elastic_flow(img_size, elasticity_coefficient, deformation_intensity,
+                                 grid_spacing=None, blur='separable', upsampling='bicubic'):
+    """
+    Generates a random flow field for elastic deformation on a coarse control grid, upsampled to the image size
+    Much cheaper than generate_random_elastic_flow for large images, the noise and blur are on (H/spacing x W/spacing),
+    with the same amplitude and smoothness (see coarse_flow_kernel)
+    img_size: height, width, elasticity_coefficient = sigma, deformation_intensity = alpha
+    grid_spacing: pixels between control points, default sigma / 4, the default falls back to
+    generate_random_elastic_flow when the spacing is 1 (sigma < 8) or the image is small (see COARSE_FLOW_MIN_TAPS),
+    so it is never slower
+    blur: 'separable' or 'fft' (better for very large sigma)
+    upsampling: tf.image.resize method, 'bilinear' for XLA compilation (XLA has no bicubic resize)
+    """
+    img_size = utils.image_shape_to_hw(img_size)
+    if grid_spacing is None:
+        grid_spacing = max(1, int(elasticity_coefficient / 4))
+        static_size = tf.get_static_value(img_size)
+        if static_size is not None and int(np.prod(static_size)) * elasticity_coefficient ** 2 < COARSE_FLOW_MIN_TAPS:
+            grid_spacing = 1
+    if blur not in ('separable', 'fft'):
+        raise ValueError(f"blur must be 'separable' or 'fft', got {blur}")
+    if grid_spacing == 1:
+        return generate_random_elastic_flow(img_size, elasticity_coefficient, deformation_intensity)
+    coarse_kernel, noise_scale = coarse_flow_kernel(elasticity_coefficient, grid_spacing, upsampling, half_pixel=True)
+    coarse_size = tf.cast(tf.math.ceil(tf.cast(img_size, tf.float32) / grid_spacing), tf.int32) + 1
+
+    if blur == 'separable':
+        # Noise beyond the borders, so the blur needs no padding
+        y__x__d = tf.random.uniform(tf.concat([coarse_size + len(coarse_kernel) - 1, [2]], axis=0),
+                                    minval=-noise_scale ** 2, maxval=noise_scale ** 2)
+        y__x__g = _blur_separable(y__x__d, coarse_kernel)
+    else:
+        y__x__d = tf.random.uniform(tf.concat([coarse_size, [2]], axis=0),
+                                    minval=-noise_scale ** 2, maxval=noise_scale ** 2)
+        y__x__g = _blur_fft(y__x__d, coarse_kernel)
+
+    # Scaled on the control grid, the control grid covers the image and the upsampled field is cropped to the image
+    y__x__g = deformation_intensity * y__x__g
+    elastic_flow = tf.image.resize(y__x__g, coarse_size * grid_spacing, method=upsampling)[:img_size[0], :img_size[1]]
+    return elastic_flow
+
+
+def randomize_flow(flow, alpha_jitter=0.0):
+    """
+    Cheap randomization of a HW2 flow that keeps its smoothness statistics:
+    random left-right and up-down flips, transpose (square flows only), sign flip and alpha scaling by 1 +- alpha_jitter
+    """
+    def flip_lr():
+        return flow[:, ::-1] * [1.0, -1.0]
+
+    def flip_ud():
+        return flow[::-1] * [-1.0, 1.0]
+
+    flags = tf.random.uniform([4]) < 0.5
+    flow = tf.cond(flags[0], flip_lr, lambda: flow)
+    flow = tf.cond(flags[1], flip_ud, lambda: flow)
+    if flow.shape[0] is not None and flow.shape[0] == flow.shape[1]:
+        flow = tf.cond(flags[2], lambda: tf.transpose(flow, [1, 0, 2])[..., ::-1], lambda: flow)
+    sign = tf.where(flags[3], -1.0, 1.0)
+    scale = tf.random.uniform([], minval=1.0 - alpha_jitter, maxval=1.0 + alpha_jitter)
+    return flow * sign * scale
+
+
+def warp_image_by_flow_tiles(img, flow, tile_hw=(512, 512), compute_dtype=tf.float32, interpolation='bilinear'):
+    """
+    Tiled warp_image_by_flow for very large images, a generator of (offset_h, offset_w, tile) output tiles
+    identical to the untiled result, see sampling.sample_image_tiles and sampling.assemble_tiles
+    img: HWC, flow: HW2, tensors or numpy arrays (numpy memmaps are read tile by tile)
+    """
+    def grid_fcn(offset_hw, tile_size):
+        flow_tile = flow[offset_hw[0]:offset_hw[0] + tile_size[0], offset_hw[1]:offset_hw[1] + tile_size[1]]
+        tile_grid = sampling.identity_grid(tile_size) + tf.cast(offset_hw, tf.float32)
+        return tile_grid - tf.convert_to_tensor(flow_tile, tf.float32)
+    return sampling.sample_image_tiles(img, grid_fcn, img.shape[:2], tile_hw, interpolation,
+                                       compute_dtype=compute_dtype)
+
+
+class ElasticFlowBank:
+    """
+    A fixed size pool of precomputed elastic flows for one (image size, sigma, alpha),
+    drawing from the bank replaces generating a fresh flow for every sample
+    Every draw is randomized by randomize_flow, and the pool is refreshed incrementally:
+    on draws (refresh_rate new flows per draw on average) and/or by a background thread (start_background_refresh)
+    Memory: pool_size * H * W * 2 float32
+    """
+    EVICTIONS = ('fifo', 'random')
+
+    def __init__(self, img_size, elasticity_coefficient, deformation_intensity, pool_size=16,
+                 refresh_rate=0.0, eviction='fifo', alpha_jitter=0.0, flow_generator=None):
+        """
+        img_size: height, width (static), refresh_rate: in [0, 1], eviction: which slot a new flow replaces
+        flow_generator: same signature as generate_random_elastic_flow, default generate_coarse_elastic_flow
+        """
+        if eviction not in self.EVICTIONS:
+            raise ValueError(f'eviction must be one of {self.EVICTIONS}, got {eviction}')
+        self.img_size = tuple(int(v) for v in img_size)
+        self.elasticity_coefficient = elasticity_coefficient
+        self.deformation_intensity = deformation_intensity
+        self.pool_size = pool_size
+        self.refresh_rate = refresh_rate
+        self.eviction = eviction
+        self.alpha_jitter = alpha_jitter
+        self.flow_generator = flow_generator or generate_coarse_elastic_flow
+
+        flows = tf.stack([self._generate_flow() for _ in range(pool_size)])
+        self._flows = tf.Variable(flows, trainable=False, name='elastic_flow_bank')
+        self._next_slot = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self._slot_section = tf.CriticalSection(name='elastic_flow_bank_slot')
+        self._draws = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self._refreshes = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self._refresh_thread = None
+        self._stop_refresh = threading.Event()
+
+    @property
+    def memory_bytes(self):
+        return self.pool_size * self.img_size[0] * self.img_size[1] * 2 * 4
+
+    def _generate_flow(self):
+        return self.flow_generator(self.img_size, self.elasticity_coefficient, self.deformation_intensity)
+
+    def _take_fifo_slot(self):
+        """Reads and increments the next fifo slot, in a critical section so concurrent refreshes get different slots"""
+        def take_slot():
+            slot = self._next_slot.read_value()
+            with tf.control_dependencies([slot]):
+                increment = self._next_slot.assign_add(1, read_value=False)
+            with tf.control_dependencies([increment]):
+                return tf.identity(slot)
+        return tf.math.floormod(self._slot_section.execute(take_slot), self.pool_size)
+
+    def refresh(self, num_flows=1):
+        """Replaces num_flows flows of the pool with fresh ones"""
+        for _ in range(num_flows):
+            if self.eviction == 'fifo':
+                slot = self._take_fifo_slot()
+            else:
+                slot = tf.random.uniform([], maxval=self.pool_size, dtype=tf.int64)
+            self._flows.scatter_nd_update([[slot]], [self._generate_flow()])
+            self._refreshes.assign_add(1)
+
+    def draw(self):
+        """A randomized flow from the pool, graph compatible for TF dataset map"""
+        if self.refresh_rate > 0.0:
+            refresh_now = tf.random.uniform([]) < self.refresh_rate
+            tf.cond(refresh_now, lambda: self.refresh(1), lambda: None)
+        self._draws.assign_add(1)
+        slot = tf.random.uniform([], maxval=self.pool_size, dtype=tf.int32)
+        return randomize_flow(self._flows[slot], self.alpha_jitter)
+
+    def start_background_refresh(self, interval_seconds, flows_per_refresh=1):
+        """Refreshes flows_per_refresh flows every interval_seconds in a daemon thread"""
+        if self._refresh_thread is not None:
+            return
+        self._stop_refresh.clear()
+
+        def refresh_loop():
+            while not self._stop_refresh.wait(interval_seconds):
+                self.refresh(flows_per_refresh)
+
+        self._refresh_thread = threading.Thread(target=refresh_loop, daemon=True)
+        self._refresh_thread.start()
+
+    def stop_background_refresh(self):
+        if self._refresh_thread is None:
+            return
+        self._stop_refresh.set()
+        self._refresh_thread.join()
+        self._refresh_thread = None
+
+    def statistics(self):
+        """Number of draws and of freshly generated flows since the bank was filled, and the bank memory"""
+        draws = int(self._draws.numpy())
+        refreshes = int(self._refreshes.numpy())
+        return {'draws': draws,
+                'refreshes': refreshes,
+                'draws_per_generated_flow': draws / (self.pool_size + refreshes),
+                'memory_bytes': self.memory_bytes}
+
+
+def _blur_separable_3d(vol, kernel):
+    """Blurs a DHWC volume by a 1D kernel along the depth, the height and the width, no padding"""
+    kernel = tf.cast(kernel, tf.float32)
+    # The channels are blurred independently as a batch of single channel volumes
+    blurred = tf.expand_dims(tf.transpose(vol, [3, 0, 1, 2]), -1)
+    for kernel_shape in ([-1, 1, 1, 1, 1], [1, -1, 1, 1, 1], [1, 1, -1, 1, 1]):
+        blurred = tf.nn.conv3d(blurred, tf.reshape(kernel, kernel_shape), strides=[1] * 5, padding='VALID')
+    return tf.transpose(tf.squeeze(blurred, -1), [1, 2, 3, 0])
+
+
+@instrumentation.instrumented('elastic.generate_coarse_elastic_flow_3d')
+def generate_coarse_elastic_flow_3d(img_size, elasticity_coefficient, deformation_intensity, grid_spacing=None):
+    """
+    Generates a random DHW3 flow field for elastic deformation of a volume, the displacements are sampled on a coarse
+    3D control grid, blurred there and interpolated (trilinear) to the volume size, smooth across the slices
+    Same amplitude and smoothness as generate_random_elastic_flow with its blur along all 3 axes
+    (see coarse_flow_kernel)
+    img_size: depth, height, width, elasticity_coefficient = sigma, deformation_intensity = alpha
+    grid_spacing: voxels between control points, default sigma / 4
+    """
+    img_size = tf.convert_to_tensor(img_size)[:3]
+    if grid_spacing is None:
+        grid_spacing = max(1, int(elasticity_coefficient / 4))
+    coarse_kernel, noise_scale = coarse_flow_kernel(elasticity_coefficient, grid_spacing)
+    coarse_size = (img_size - 1) // grid_spacing + 2
+    # Noise beyond the borders, so the blur needs no padding
+    d__y__x__d = tf.random.uniform(tf.concat([coarse_size + len(coarse_kernel) - 1, [3]], axis=0),
+                                   minval=-noise_scale ** 3, maxval=noise_scale ** 3)
+    d__y__x__g = _blur_separable_3d(d__y__x__d, coarse_kernel)
+    coarse_grid = sampling.identity_grid_3d(img_size) / grid_spacing
+    elastic_flow = deformation_intensity * sampling.sample_volume_trilinear(d__y__x__g, coarse_grid)
+    return elastic_flow
+
+
+@instrumentation.instrumented('elastic.warp_volume_by_flow')
+def warp_volume_by_flow(vol, flow, interpolation='bilinear', compute_dtype=tf.float32):
+    """
+    Volume counterpart of warp_image_by_flow, vol: DHWC, flow: DHW3
+    interpolation: 'bilinear' (trilinear) or 'nearest' for label volumes
+    """
+    tf.assert_rank(vol, 4, 'Expected volume format DHWC (4D)')
+    grid = sampling.identity_grid_3d(tf.shape(flow)[:3]) - flow
+    return sampling.sample_volume(vol, grid, interpolation, compute_dtype=compute_dtype)
+
+
+def flow_to_grid(flow):
+    """Converts a HW2 flow to the sampling grid of the warp (see sampling)"""
+    return sampling.identity_grid(tf.shape(flow)[:2]) - flow
+
+
+def warp_points_by_flow(points, flow):
+    """
+    Moves N2 (h, w) pixel coordinates of points by a HW2 flow, to where warp_image_by_flow moves their pixels
+    The flow is sampled at the points (bilinear, clamped to the edges), the first order inverse of the warp
+    """
+    points = tf.cast(points, flow.dtype)
+    flow_at_points = sampling.sample_bilinear(flow, tf.expand_dims(points, -2))
+    return points + tf.squeeze(flow_at_points, -2)
+
+
+@instrumentation.instrumented('elastic.warp_image_by_flow')
+def warp_image_by_flow(img, flow, compute_dtype=tf.float32, interpolation='bilinear'):
     """
     Compatible with TF data pipeline when an explicit image size is given
     img: HWC, flow: HW2
+    compute_dtype: the bilinear blend dtype, tf.float16 / tf.bfloat16 to save memory (see sampling)
+    interpolation: 'bilinear', or 'nearest' for class index masks (an exact gather in the label dtype, no float blend)
     """
-    img_shape = tf.shape(img)
-    tf.assert_equal(len(img_shape), 3, 'Expected image format HWC (3D)')
-
-    height, width, channels = tf.unstack(img_shape)
-    grid_x, grid_y = tf.meshgrid(tf.range(width), tf.range(height))
-    stacked_grid = tf.cast(tf.stack([grid_y, grid_x], axis=2), flow.dtype)
-    batched_grid = tf.expand_dims(stacked_grid, axis=0)
-    query_points_on_grid = batched_grid - flow
-    query_points_flattened = tf.reshape(
-        query_points_on_grid, [1, height * width, 2]
-    )
-    interpolated = tfa.image.interpolate_bilinear(tf.cast(utils.hwc_to_bhwc(img), tf.float32), query_points_flattened)
-    interpolated = tf.cast(interpolated, img.dtype)
-    warped = tf.reshape(interpolated, [height, width, channels])
+    tf.assert_rank(img, 3, 'Expected image format HWC (3D)')
+    warped = sampling.sample_image(img, flow_to_grid(flow), interpolation, compute_dtype=compute_dtype)
     return warped
-
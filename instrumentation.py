@@ -0,0 +1,136 @@
+import collections
+import contextlib
+import functools
+import threading
+import numpy as np
+import tensorflow as tf
+
+"""Opt-in per-stage instrumentation of the augmentations: wall time, calls, tensor sizes and counters
+usage:
+    recorder = instrumentation.Recorder()
+    with instrumentation.instrument(recorder):
+        dataset = dataset.map(seg_aug.elastic_augmentation_fcn(3, 10.0))
+    for element in dataset: ...
+    recorder.as_dict() or recorder.write_summaries(step)
+Instrumentation is decided when a function is traced (or called eagerly): functions traced inside instrument() keep
+recording to its recorder afterwards, functions traced outside of it have no instrumentation ops at all.
+The stages record through tf.numpy_function, instrumented functions don't compile with XLA.
+Stage times include the nested stages (e.g. seg_aug.apply_plan includes sampling.sample_image)."""
+
+_ACTIVE = threading.local()
+
+
+class Recorder:
+    """Thread-safe aggregator of the stage records, keyed by stage name"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = collections.defaultdict(collections.Counter)
+
+    def record(self, stage, seconds, input_bytes, output_bytes):
+        with self._lock:
+            stage_record = self._stages[stage]
+            stage_record['calls'] += 1
+            stage_record['total_seconds'] += float(seconds)
+            stage_record['max_seconds'] = max(stage_record['max_seconds'], float(seconds))
+            stage_record['input_bytes'] += int(input_bytes)
+            stage_record['output_bytes'] += int(output_bytes)
+
+    def count(self, stage, counter, value=1):
+        with self._lock:
+            self._stages[stage][counter] += int(value)
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+
+    def as_dict(self):
+        """Plain dict of the stage records, with the mean time per call"""
+        with self._lock:
+            stages = {stage: dict(stage_record) for stage, stage_record in self._stages.items()}
+        for stage_record in stages.values():
+            if stage_record.get('calls'):
+                stage_record['mean_seconds'] = stage_record['total_seconds'] / stage_record['calls']
+        return stages
+
+    def write_summaries(self, step, prefix='augmentation'):
+        """Writes the stage records as tf.summary scalars to the default summary writer"""
+        for stage, stage_record in self.as_dict().items():
+            for name, value in stage_record.items():
+                tf.summary.scalar(f'{prefix}/{stage}/{name}', value, step=step)
+
+
+def active_recorder():
+    """The recorder of the enclosing instrument() context in this thread, None when the instrumentation is off"""
+    return getattr(_ACTIVE, 'recorder', None)
+
+
+@contextlib.contextmanager
+def instrument(recorder=None):
+    """Turns the instrumentation on for the functions traced or called eagerly in the context"""
+    recorder = Recorder() if recorder is None else recorder
+    previous_recorder = active_recorder()
+    _ACTIVE.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _ACTIVE.recorder = previous_recorder
+
+
+def _structure_bytes(structure):
+    tensors = [tensor for tensor in tf.nest.flatten(structure) if isinstance(tensor, (tf.Tensor, tf.Variable))]
+    return tf.add_n([tf.size(tensor, tf.int64) * tensor.dtype.size for tensor in tensors] +
+                    [tf.constant(0, tf.int64)])
+
+
+def _tensors_after(structure, dependencies):
+    """The structure with its tensors computed after the dependencies"""
+    with tf.control_dependencies(dependencies):
+        return tf.nest.map_structure(lambda item: tf.identity(item) if isinstance(item, tf.Tensor) else item,
+                                     structure)
+
+
+def instrumented(stage):
+    """
+    Decorator recording the wall time, calls and input and output bytes of a stage, to the active recorder
+    The decorated function is called as is when the instrumentation is off
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            recorder = active_recorder()
+            if recorder is None:
+                return function(*args, **kwargs)
+            with tf.control_dependencies([tensor for tensor in tf.nest.flatten((args, kwargs))
+                                          if isinstance(tensor, tf.Tensor)]):
+                start_time = tf.timestamp()
+            args, kwargs = _tensors_after((args, kwargs), [start_time])
+            outputs = function(*args, **kwargs)
+            with tf.control_dependencies([tensor for tensor in tf.nest.flatten(outputs)
+                                          if isinstance(tensor, tf.Tensor)]):
+                end_time = tf.timestamp()
+
+            def record(seconds, input_bytes, output_bytes):
+                recorder.record(stage, seconds, input_bytes, output_bytes)
+                return np.int64(0)
+
+            recorded = tf.numpy_function(record, [end_time - start_time, _structure_bytes((args, kwargs)),
+                                                  _structure_bytes(outputs)], tf.int64, stateful=True)
+            return _tensors_after(outputs, [recorded])
+        return wrapper
+    return decorator
+
+
+def count(stage, counter, value=1):
+    """
+    Adds a value (e.g. a boolean condition) to a counter of a stage, a no-op when the instrumentation is off
+    Returns the operation to depend on in graph mode, None when there is nothing to run
+    """
+    recorder = active_recorder()
+    if recorder is None:
+        return None
+
+    def add(counter_value):
+        recorder.count(stage, counter, counter_value)
+        return np.int64(0)
+
+    return tf.numpy_function(add, [tf.cast(value, tf.int64)], tf.int64, stateful=True)
@@ -0,0 +1,264 @@
+"""Offline materialization of augmented epochs to sharded files, and datasets that read them back
+usage: python -m tf_image_augmentations.materialize --dataset my_module:make_dataset \\
+           --augmentation tf_image_augmentations.seg_aug:random_affine_transform_fcn \\
+           --kwargs '{"rotation_min": -0.5, "rotation_max": 0.5, ...}' \\
+           --output-dir augmented --epochs 4 --shards 8 --workers 4 --seed 0
+Every (epoch, shard) is a job writing the augmented samples of dataset.shard(num_shards, shard) and a json manifest
+with the per-sample seeds and the config, the manifest is written last so finished shards are skipped when the job is
+rerun with the same config (seed, augmentations and format), a different config raises.
+The augmentations sample their parameters from the global TF seed, which is set to the recorded sample seed before
+every sample, so the same seed gives identical files and a single sample can be reproduced from its seed.
+Dataset elements are tuples of tensors (or single tensors), e.g. (image, label) for the seg_aug closures."""
+import argparse
+import concurrent.futures
+import functools
+import glob
+import importlib
+import json
+import multiprocessing
+import os
+import numpy as np
+import tensorflow as tf
+
+
+FORMATS = ('tfrecord', 'raw')
+MANIFEST_PATTERN = 'epoch-*-shard-*.json'
+
+
+def sample_seed(seed, epoch, shard_index, sample_index):
+    """Seed of a single sample, independent of the number of workers and of the order in which the shards run"""
+    return int(np.random.SeedSequence([seed, epoch, shard_index, sample_index]).generate_state(1, np.uint32)[0])
+
+
+def shard_name(epoch, shard_index, num_shards):
+    return f'epoch-{epoch:05d}-shard-{shard_index:05d}-of-{num_shards:05d}'
+
+
+def _as_tuple(element):
+    return element if isinstance(element, tuple) else (element,)
+
+
+def augment_element(element, augmentation_fcns, seed):
+    """Runs the augmentation closures in order on a dataset element, eagerly and seeded"""
+    tf.random.set_seed(seed)
+    for augmentation_fcn in augmentation_fcns:
+        element = augmentation_fcn(*_as_tuple(element))
+    return _as_tuple(element)
+
+
+def _describe(augmentation):
+    """A description of an augmentation builder that is the same in every process (no object addresses)"""
+    if isinstance(augmentation, functools.partial):
+        args = [repr(arg) for arg in augmentation.args]
+        args += [f'{key}={value!r}' for key, value in sorted(augmentation.keywords.items())]
+        return f'{_describe(augmentation.func)}({", ".join(args)})'
+    if hasattr(augmentation, '__qualname__'):
+        return f'{augmentation.__module__}:{augmentation.__qualname__}'
+    return repr(augmentation)
+
+
+def shard_config(augmentations, seed, file_format):
+    """The config recorded in the shard manifests, a rerun only skips the shards written with the same config"""
+    return {'seed': seed, 'augmentations': [_describe(augmentation) for augmentation in augmentations],
+            'format': file_format}
+
+
+def _serialize_example(components, seed):
+    feature = {f'component_{i}': tf.train.Feature(bytes_list=tf.train.BytesList(
+                   value=[tf.io.serialize_tensor(component).numpy()]))
+               for i, component in enumerate(components)}
+    feature['seed'] = tf.train.Feature(int64_list=tf.train.Int64List(value=[seed]))
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+
+def materialize_shard(dataset_fn, augmentations, output_dir, epoch, shard_index, num_shards, seed=0,
+                      file_format='tfrecord'):
+    """
+    Writes the augmented samples of one shard of one epoch, returns the shard manifest
+    dataset_fn: builds the source dataset, augmentations: build the closures for TF dataset map
+    (e.g. functools.partial(seg_aug.elastic_augmentation_fcn, 3, 10.0)), both are picklable for the process pool
+    The manifest records the per-sample seeds, not the sampled augmentation parameters: augment_element with the seed
+    reproduces a sample. An empty shard (more shards than samples) has a manifest without files
+    A shard with a manifest is finished and isn't written again, a ValueError is raised if its config is different
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f'file_format should be one of {FORMATS}, got {file_format}')
+    name = shard_name(epoch, shard_index, num_shards)
+    manifest_path = os.path.join(output_dir, name + '.json')
+    config = shard_config(augmentations, seed, file_format)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get('config') != config:
+            raise ValueError(f'shard {name} in {output_dir} was materialized with {manifest.get("config")}, '
+                             f'got {config}: use another output_dir or remove the shard')
+        return manifest
+
+    augmentation_fcns = [augmentation() for augmentation in augmentations]
+    dataset = dataset_fn().shard(num_shards, shard_index)
+    seeds = []
+    components_spec = None
+    # The files are opened on the first sample, an empty shard has none
+    file_names = []
+    writers = []
+    try:
+        for sample_index, element in enumerate(dataset):
+            seeds.append(sample_seed(seed, epoch, shard_index, sample_index))
+            components = augment_element(element, augmentation_fcns, seeds[-1])
+            if components_spec is None:
+                components_spec = [{'dtype': component.dtype.name, 'shape': component.shape.as_list()}
+                                   for component in components]
+                if file_format == 'tfrecord':
+                    file_names = [name + '.tfrecord']
+                    writers = [tf.io.TFRecordWriter(os.path.join(output_dir, file_names[0] + '.tmp'))]
+                else:
+                    file_names = [f'{name}.{i}.raw' for i in range(len(components))]
+                    for file_name in file_names:
+                        writers.append(open(os.path.join(output_dir, file_name + '.tmp'), 'wb'))
+            if file_format == 'tfrecord':
+                writers[0].write(_serialize_example(components, seeds[-1]))
+            else:
+                for component, spec, raw_file in zip(components, components_spec, writers):
+                    if component.shape.as_list() != spec['shape']:
+                        raise ValueError(f'the raw format expects static component shapes, got {component.shape} '
+                                         f'after {spec["shape"]}')
+                    raw_file.write(component.numpy().tobytes())
+    except BaseException:
+        # A failed shard leaves no partial files behind
+        for writer in writers:
+            writer.close()
+        for file_name in file_names:
+            if os.path.exists(os.path.join(output_dir, file_name + '.tmp')):
+                os.remove(os.path.join(output_dir, file_name + '.tmp'))
+        raise
+    for writer in writers:
+        writer.close()
+    # Files are moved into place before the manifest marks the shard as finished
+    for file_name in file_names:
+        os.replace(os.path.join(output_dir, file_name + '.tmp'), os.path.join(output_dir, file_name))
+    manifest = {'epoch': epoch, 'shard': shard_index, 'num_shards': num_shards, 'format': file_format,
+                'num_samples': len(seeds), 'seeds': seeds, 'files': file_names, 'components': components_spec,
+                'config': config}
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest
+
+
+def materialize(dataset_fn, augmentations, output_dir, num_epochs=1, num_shards=1, num_workers=0, seed=0,
+                file_format='tfrecord'):
+    """
+    Writes num_epochs augmented epochs of the dataset in num_shards shards each, returns the shard manifests
+    num_workers: size of the process pool (spawned processes), 0 runs the shards in this process
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = [(epoch, shard_index) for epoch in range(num_epochs) for shard_index in range(num_shards)]
+    shard_fcn = functools.partial(materialize_shard, dataset_fn, augmentations, output_dir,
+                                  num_shards=num_shards, seed=seed, file_format=file_format)
+    if num_workers == 0:
+        return [shard_fcn(epoch, shard_index) for epoch, shard_index in jobs]
+    with concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(shard_fcn, epoch, shard_index) for epoch, shard_index in jobs]
+        return [future.result() for future in futures]
+
+
+def shard_manifests(output_dir, epoch=None):
+    """Manifests of the finished shards, ordered by epoch and shard"""
+    manifests = []
+    for manifest_path in sorted(glob.glob(os.path.join(output_dir, MANIFEST_PATTERN))):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        if epoch is None or manifest['epoch'] == epoch:
+            manifests.append(manifest)
+    return manifests
+
+
+def load_raw_shard(output_dir, manifest):
+    """Memory maps the components of a raw shard, arrays of shape (num_samples, ...) that are read on slicing"""
+    return tuple(np.memmap(os.path.join(output_dir, file_name), dtype=spec['dtype'], mode='r',
+                           shape=tuple([manifest['num_samples']] + spec['shape']))
+                 for file_name, spec in zip(manifest['files'], manifest['components']))
+
+
+def _decode_raw(record, spec):
+    """A raw record back to a tensor of the component spec, booleans are stored as bytes"""
+    if spec.dtype == tf.bool:
+        return tf.reshape(tf.io.decode_raw(record, tf.uint8), spec.shape) > 0
+    return tf.reshape(tf.io.decode_raw(record, spec.dtype), spec.shape)
+
+
+def materialized_dataset(output_dir, epoch=None, with_seeds=False):
+    """
+    Dataset of the materialized samples in epoch and shard order, elements are tuples of the augmented components
+    (and the sample seed last with with_seeds, the seed recorded in the manifest, not the sampled parameters)
+    epoch: a single epoch, None reads all of the epochs
+    """
+    # Empty shards have no files
+    manifests = [manifest for manifest in shard_manifests(output_dir, epoch) if manifest['num_samples']]
+    if not manifests:
+        raise ValueError(f'no materialized samples in {output_dir}')
+    components_spec = manifests[0]['components']
+    signature = tuple(tf.TensorSpec(spec['shape'], spec['dtype']) for spec in components_spec)
+
+    if manifests[0]['format'] == 'raw':
+        # One fixed length record per sample in every component file, decoded in parallel by tf.data
+        components = []
+        for i, spec in enumerate(signature):
+            file_paths = [os.path.join(output_dir, manifest['files'][i]) for manifest in manifests]
+            record_bytes = spec.shape.num_elements() * spec.dtype.size
+            components.append(tf.data.FixedLengthRecordDataset(file_paths, record_bytes))
+        if with_seeds:
+            components.append(tf.data.Dataset.from_tensor_slices(
+                tf.constant([seed for manifest in manifests for seed in manifest['seeds']], tf.int64)))
+
+        def parse_records(*records):
+            sample = tuple(_decode_raw(record, spec) for record, spec in zip(records, signature))
+            return sample + records[len(signature):]
+
+        return tf.data.Dataset.zip(tuple(components)).map(parse_records, num_parallel_calls=tf.data.AUTOTUNE)
+
+    features = {f'component_{i}': tf.io.FixedLenFeature([], tf.string) for i in range(len(signature))}
+    features['seed'] = tf.io.FixedLenFeature([], tf.int64)
+
+    def parse_example(serialized):
+        example = tf.io.parse_single_example(serialized, features)
+        sample = tuple(tf.ensure_shape(tf.io.parse_tensor(example[f'component_{i}'], spec.dtype), spec.shape)
+                       for i, spec in enumerate(signature))
+        return sample + (example['seed'],) if with_seeds else sample
+
+    file_paths = [os.path.join(output_dir, manifest['files'][0]) for manifest in manifests]
+    return tf.data.TFRecordDataset(file_paths).map(parse_example, num_parallel_calls=tf.data.AUTOTUNE)
+
+
+def _resolve(spec):
+    module_name, attribute = spec.split(':')
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dataset', required=True, help='module:function building the source dataset')
+    parser.add_argument('--augmentation', action='append', default=[],
+                        help='module:function building a closure for TF dataset map, in order')
+    parser.add_argument('--kwargs', action='append', default=[],
+                        help='json keyword arguments of the augmentation of the same position')
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--format', choices=FORMATS, default='tfrecord')
+    args = parser.parse_args(argv)
+
+    kwargs = [json.loads(augmentation_kwargs) for augmentation_kwargs in args.kwargs]
+    kwargs += [{}] * (len(args.augmentation) - len(kwargs))
+    augmentations = [functools.partial(_resolve(augmentation), **augmentation_kwargs)
+                     for augmentation, augmentation_kwargs in zip(args.augmentation, kwargs)]
+    manifests = materialize(_resolve(args.dataset), augmentations, args.output_dir, args.epochs, args.shards,
+                            args.workers, args.seed, args.format)
+    print(f'{sum(manifest["num_samples"] for manifest in manifests)} samples in {len(manifests)} shards')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
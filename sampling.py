@@ -0,0 +1,326 @@
+import functools
+import numpy as np
+import tensorflow as tf
+from tf_image_augmentations import instrumentation
+
+"""Resampling of images on a grid of source coordinates, shared by the geometric transformations
+Grid format: HW2 (or BHW2 for a batch) of the (h, w) source coordinate of every output pixel,
+pixel centers are at integer coordinates
+
+Precision: nearest neighbour sampling gathers the image in its own dtype (no float copy of uint8 or integer labels).
+Bilinear sampling gathers the 4 neighbours in the image dtype and blends them in compute_dtype, the coordinates and
+weights are always computed in float32. float16 / bfloat16 halve the memory of the blend, at a relative error of
+about 1e-3 / 1e-2 of the pixel values (exact enough for uint8 images with float16, not for labels or float data)"""
+
+INTERPOLATIONS = ('nearest', 'bilinear')
+
+
+IDENTITY_GRID_CACHE_SIZE = 16
+
+
+def _build_identity_grid(img_hw):
+    h, w = tf.unstack(img_hw)
+    grid_h, grid_w = tf.meshgrid(tf.range(h), tf.range(w), indexing='ij')
+    return tf.cast(tf.stack([grid_h, grid_w], axis=2), tf.float32)
+
+
+@functools.lru_cache(maxsize=IDENTITY_GRID_CACHE_SIZE)
+def _cached_identity_grid(h, w):
+    # Built eagerly so the cached grid can be captured by any graph (Dataset.map, tf.function)
+    with tf.init_scope():
+        return _build_identity_grid(tf.constant([h, w]))
+
+
+def identity_grid(img_hw):
+    """
+    The HW2 grid that samples every pixel from itself
+    The grid is cached per image size when the size is known while tracing
+    """
+    static_hw = tf.get_static_value(img_hw)
+    if static_hw is None:
+        return _build_identity_grid(img_hw)
+    return _cached_identity_grid(int(static_hw[0]), int(static_hw[1]))
+
+
+def flip_grid(grid, img_hw, flip_lr, flip_ud):
+    """
+    Composes a grid with a flip of the source image (the flip is applied first)
+    flip_lr, flip_ud: boolean scalars, or B booleans for a batch of grids
+    """
+    img_hw = tf.cast(img_hw, grid.dtype)
+    grid_h, grid_w = tf.unstack(grid, axis=-1)
+    flip_ud = tf.reshape(flip_ud, tf.concat([tf.shape(flip_ud), tf.ones([2], tf.int32)], axis=0))
+    flip_lr = tf.reshape(flip_lr, tf.concat([tf.shape(flip_lr), tf.ones([2], tf.int32)], axis=0))
+    grid_h = tf.where(flip_ud, img_hw[0] - 1 - grid_h, grid_h)
+    grid_w = tf.where(flip_lr, img_hw[1] - 1 - grid_w, grid_w)
+    return tf.stack([grid_h, grid_w], axis=-1)
+
+
+def flip_points(points, img_hw, flip_lr, flip_ud):
+    """
+    Flips (h, w) pixel coordinates of points, N2 with scalar flags or BN2 with B flags (same flags as flip_grid)
+    """
+    img_hw = tf.cast(img_hw, points.dtype)
+    points_h, points_w = tf.unstack(points, axis=-1)
+    points_h = tf.where(tf.expand_dims(flip_ud, -1), img_hw[0] - 1 - points_h, points_h)
+    points_w = tf.where(tf.expand_dims(flip_lr, -1), img_hw[1] - 1 - points_w, points_w)
+    return tf.stack([points_h, points_w], axis=-1)
+
+
+def _batch_image_and_grid(img, grid):
+    """Brings an image and its grid to BHWC and B x pixel x 2"""
+    if img.shape.rank == 3:
+        img = tf.expand_dims(img, 0)
+        grid = tf.expand_dims(grid, 0)
+    tf.assert_rank(img, 4, 'expected image format HWC (3D) or BHWC (4D)')
+    grid_shape = tf.shape(grid)
+    b__sample__grid = tf.reshape(grid, [grid_shape[0], grid_shape[1] * grid_shape[2], 2])
+    return img, b__sample__grid
+
+
+def _unbatch_image(b__sample__img, img, grid):
+    """Reshapes the sampled B x pixel x C values to the grid size (HWC or BHWC like the image)"""
+    out_shape = tf.concat([tf.shape(grid)[:-1], tf.shape(img)[-1:]], axis=0)
+    return tf.reshape(b__sample__img, out_shape)
+
+
+def _grid_in_image(b__sample__grid, img_hw):
+    """Mask of the grid points whose nearest pixel is inside the image"""
+    b__sample__idxs = tf.floor(b__sample__grid + 0.5)
+    hw__limits = tf.cast(img_hw, b__sample__grid.dtype)
+    return tf.reduce_all((b__sample__idxs >= 0.0) & (b__sample__idxs < hw__limits), axis=-1)
+
+
+def _source_window(b__img, source_offset, source_hw):
+    """The size of the source image and the offset of the (cropped) image in it, see sample_image"""
+    if source_hw is None:
+        return tf.shape(b__img)[1:3], tf.zeros([2], tf.int32)
+    return tf.convert_to_tensor(source_hw, tf.int32), tf.convert_to_tensor(source_offset, tf.int32)
+
+
+def sample_nearest(img, grid, fill_value=None, source_offset=None, source_hw=None):
+    """
+    Nearest neighbour sampling of an image (HWC or BHWC) on a grid, the image dtype is preserved
+    Out of image points are set to fill_value, or take the closest edge pixel if fill_value is None
+    """
+    b__img, b__sample__grid = _batch_image_and_grid(img, grid)
+    img_hw, offset = _source_window(b__img, source_offset, source_hw)
+    b__sample__idxs = tf.cast(tf.floor(b__sample__grid + 0.5), tf.int32)
+    b__sample__idxs = tf.clip_by_value(b__sample__idxs, 0, img_hw - 1) - offset
+    b__sample__img = tf.gather_nd(b__img, b__sample__idxs, batch_dims=1)
+    if fill_value is not None:
+        b__sample__valid = _grid_in_image(b__sample__grid, img_hw)
+        b__sample__img = tf.where(tf.expand_dims(b__sample__valid, -1), b__sample__img,
+                                  tf.cast(fill_value, img.dtype))
+    return _unbatch_image(b__sample__img, img, grid)
+
+
+def _bilinear_gather(b__img, b__sample__grid, compute_dtype, img_hw, offset):
+    """Same as tfa.image.interpolate_bilinear (clamped to the edges), blended in compute_dtype"""
+    floors, ceils, alphas = [], [], []
+    for dim in range(2):
+        queries = b__sample__grid[..., dim]
+        max_floor = tf.cast(tf.maximum(img_hw[dim] - 2, 0), queries.dtype)
+        floor = tf.minimum(tf.maximum(0.0, tf.floor(queries)), max_floor)
+        int_floor = tf.cast(floor, tf.int32)
+        floors.append(int_floor - offset[dim])
+        ceils.append(tf.minimum(int_floor + 1, img_hw[dim] - 1) - offset[dim])
+        alpha = tf.clip_by_value(tf.cast(queries - floor, compute_dtype), 0.0, 1.0)
+        alphas.append(tf.expand_dims(alpha, -1))
+
+    def gather(y_coords, x_coords):
+        return tf.cast(tf.gather_nd(b__img, tf.stack([y_coords, x_coords], axis=-1), batch_dims=1), compute_dtype)
+
+    top_left = gather(floors[0], floors[1])
+    top_right = gather(floors[0], ceils[1])
+    bottom_left = gather(ceils[0], floors[1])
+    bottom_right = gather(ceils[0], ceils[1])
+    interp_top = alphas[1] * (top_right - top_left) + top_left
+    interp_bottom = alphas[1] * (bottom_right - bottom_left) + bottom_left
+    return alphas[0] * (interp_bottom - interp_top) + interp_top
+
+
+def sample_bilinear(img, grid, fill_value=None, compute_dtype=tf.float32, source_offset=None, source_hw=None):
+    """
+    Bilinear sampling of an image (HWC or BHWC) on a grid, blended in compute_dtype and cast back to the image dtype
+    Out of image points are set to fill_value, or are clamped to the image edges if fill_value is None
+    """
+    b__img, b__sample__grid = _batch_image_and_grid(img, grid)
+    img_hw, offset = _source_window(b__img, source_offset, source_hw)
+    b__sample__img = _bilinear_gather(b__img, b__sample__grid, compute_dtype, img_hw, offset)
+    b__sample__img = tf.cast(b__sample__img, img.dtype)
+    if fill_value is not None:
+        b__sample__valid = _grid_in_image(b__sample__grid, img_hw)
+        b__sample__img = tf.where(tf.expand_dims(b__sample__valid, -1), b__sample__img,
+                                  tf.cast(fill_value, img.dtype))
+    return _unbatch_image(b__sample__img, img, grid)
+
+
+def identity_grid_3d(img_dhw):
+    """The DHW3 grid that samples every voxel of a volume from itself"""
+    d, h, w = tf.unstack(tf.convert_to_tensor(img_dhw))
+    grid_d, grid_h, grid_w = tf.meshgrid(tf.range(d), tf.range(h), tf.range(w), indexing='ij')
+    return tf.cast(tf.stack([grid_d, grid_h, grid_w], axis=3), tf.float32)
+
+
+def flip_grid_3d(grid, img_dhw, flips):
+    """Composes a DHW3 grid with flips of the source volume (applied first), flips: 3 booleans (d, h, w)"""
+    img_dhw = tf.cast(img_dhw, grid.dtype)
+    return tf.where(flips, img_dhw - 1 - grid, grid)
+
+
+def _grid_in_volume(grid, img_dhw):
+    """Mask of the DHW3 grid points whose nearest voxel is inside the volume"""
+    idxs = tf.floor(grid + 0.5)
+    return tf.reduce_all((idxs >= 0.0) & (idxs < tf.cast(img_dhw, grid.dtype)), axis=-1)
+
+
+def sample_volume_nearest(vol, grid, fill_value=None):
+    """Nearest neighbour sampling of a DHWC volume on a DHW3 grid (in any output size), in the volume dtype"""
+    tf.assert_rank(vol, 4, 'expected volume format DHWC (4D)')
+    img_dhw = tf.shape(vol)[:3]
+    idxs = tf.clip_by_value(tf.cast(tf.floor(grid + 0.5), tf.int32), 0, img_dhw - 1)
+    new_vol = tf.gather_nd(vol, idxs)
+    if fill_value is not None:
+        new_vol = tf.where(tf.expand_dims(_grid_in_volume(grid, img_dhw), -1), new_vol, tf.cast(fill_value, vol.dtype))
+    return new_vol
+
+
+def sample_volume_trilinear(vol, grid, fill_value=None, compute_dtype=tf.float32):
+    """
+    Trilinear sampling of a DHWC volume on a DHW3 grid, clamped to the edges like sample_bilinear,
+    the 8 corners are gathered in the volume dtype and accumulated in compute_dtype
+    """
+    tf.assert_rank(vol, 4, 'expected volume format DHWC (4D)')
+    img_dhw = tf.shape(vol)[:3]
+    max_floor = tf.cast(tf.maximum(img_dhw - 2, 0), grid.dtype)
+    floor = tf.minimum(tf.maximum(0.0, tf.floor(grid)), max_floor)
+    int_floor = tf.cast(floor, tf.int32)
+    int_ceil = tf.minimum(int_floor + 1, img_dhw - 1)
+    alpha = tf.clip_by_value(tf.cast(grid - floor, compute_dtype), 0.0, 1.0)
+
+    new_vol = 0.0
+    for corner in range(8):
+        # Bit i of the corner selects the ceil along dimension i
+        upper = [bool(corner >> dim & 1) for dim in range(3)]
+        idxs = tf.where(upper, int_ceil, int_floor)
+        weight = tf.reduce_prod(tf.where(upper, alpha, 1.0 - alpha), axis=-1, keepdims=True)
+        new_vol += weight * tf.cast(tf.gather_nd(vol, idxs), compute_dtype)
+    new_vol = tf.cast(new_vol, vol.dtype)
+    if fill_value is not None:
+        new_vol = tf.where(tf.expand_dims(_grid_in_volume(grid, img_dhw), -1), new_vol, tf.cast(fill_value, vol.dtype))
+    return new_vol
+
+
+def sample_volume(vol, grid, interpolation='nearest', fill_value=None, compute_dtype=tf.float32):
+    """Samples a DHWC volume on a DHW3 grid with one of INTERPOLATIONS ('bilinear' is trilinear)"""
+    if interpolation == 'nearest':
+        return sample_volume_nearest(vol, grid, fill_value)
+    elif interpolation == 'bilinear':
+        return sample_volume_trilinear(vol, grid, fill_value, compute_dtype)
+    raise ValueError(f'interpolation must be one of {INTERPOLATIONS}, got {interpolation}')
+
+
+@instrumentation.instrumented('sampling.sample_image')
+def sample_image(img, grid, interpolation='nearest', fill_value=None, compute_dtype=tf.float32,
+                 source_offset=None, source_hw=None):
+    """
+    Samples an image (HWC or BHWC) on a grid with one of INTERPOLATIONS, compute_dtype only affects bilinear
+    source_offset, source_hw: the image is a crop at source_offset of a source_hw image and the grid is in the source
+    coordinates, the result is the same as sampling the whole source image as long as the crop holds all the pixels
+    the grid reads (see sample_image_tiles)
+    A DHW3 grid samples a DHWC volume, see sample_volume (no source window)
+    """
+    if grid.shape[-1] == 3:
+        if source_offset is not None or source_hw is not None:
+            raise ValueError('source_offset and source_hw are for HW2 grids, a DHW3 grid samples the whole volume')
+        return sample_volume(img, grid, interpolation, fill_value, compute_dtype)
+    if interpolation == 'nearest':
+        return sample_nearest(img, grid, fill_value, source_offset, source_hw)
+    elif interpolation == 'bilinear':
+        return sample_bilinear(img, grid, fill_value, compute_dtype, source_offset, source_hw)
+    raise ValueError(f'interpolation must be one of {INTERPOLATIONS}, got {interpolation}')
+
+
+def source_window(grid, img_hw):
+    """
+    The smallest window of an img_hw image holding all the pixels a grid reads (nearest or bilinear):
+    offset_h, offset_w, window_h, window_w
+    """
+    img_hw = tf.convert_to_tensor(img_hw, tf.int32)
+    hw__grid_min = tf.reduce_min(tf.reshape(grid, [-1, 2]), axis=0)
+    hw__grid_max = tf.reduce_max(tf.reshape(grid, [-1, 2]), axis=0)
+    # Bilinear sampling reads from max(img_hw - 2, 0) at least, even for grid points past the end of the image
+    window_min = tf.clip_by_value(tf.cast(tf.floor(hw__grid_min), tf.int32), 0, tf.maximum(img_hw - 2, 0))
+    window_max = tf.clip_by_value(tf.cast(tf.math.ceil(hw__grid_max), tf.int32) + 2, window_min + 1, img_hw)
+    return tf.concat([window_min, window_max - window_min], axis=0)
+
+
+def tile_offsets(output_hw, tile_hw):
+    """The (offset_h, offset_w, tile_h, tile_w) of the tiles covering output_hw, row major"""
+    for offset_h in range(0, output_hw[0], tile_hw[0]):
+        for offset_w in range(0, output_hw[1], tile_hw[1]):
+            yield offset_h, offset_w, min(tile_hw[0], output_hw[0] - offset_h), min(tile_hw[1], output_hw[1] - offset_w)
+
+
+def sample_image_tiles(img, grid_fcn, output_hw, tile_hw=(512, 512), interpolation='nearest', fill_value=None,
+                       compute_dtype=tf.float32):
+    """
+    Memory bounded sample_image for very large images, a generator of (offset_h, offset_w, tile) output tiles
+    Only the tile grid, the window of the image it reads (the tile plus a halo of its maximum displacement) and
+    the output tile are in memory at once. The tiles are identical to the same region of the untiled result
+    img: HWC tensor or numpy array (a numpy memmap is only read window by window)
+    grid_fcn(offset_hw, tile_hw): the grid of an output tile, in the img coordinates
+    """
+    img_hw = tuple(int(dim) for dim in img.shape[:2])
+    for offset_h, offset_w, tile_h, tile_w in tile_offsets(output_hw, tile_hw):
+        grid = grid_fcn((offset_h, offset_w), (tile_h, tile_w))
+        window_h, window_w, window_size_h, window_size_w = (int(v) for v in source_window(grid, img_hw))
+        window = tf.convert_to_tensor(img[window_h:window_h + window_size_h, window_w:window_w + window_size_w])
+        tile = sample_image(window, grid, interpolation, fill_value, compute_dtype,
+                            source_offset=(window_h, window_w), source_hw=img_hw)
+        yield offset_h, offset_w, tile
+
+
+def assemble_tiles(tiles, output_shape, dtype, out=None):
+    """Writes (offset_h, offset_w, tile) tiles to a numpy array, out: an existing array (e.g. numpy memmap)"""
+    if out is None:
+        out = np.empty(output_shape, dtype=tf.as_dtype(dtype).as_numpy_dtype)
+    for offset_h, offset_w, tile in tiles:
+        tile = np.asarray(tile)
+        out[offset_h:offset_h + tile.shape[0], offset_w:offset_w + tile.shape[1]] = tile
+    return out
+
+
+def estimate_resampling_bytes(img_dims, dtype, interpolation='nearest', compute_dtype=tf.float32, grid_hw=None):
+    """
+    Analytic estimate of the peak bytes in flight to resample one HWC element on a grid_hw grid (default: the image
+    size): the grid, the gather indices, the gathered values (in compute_dtype for bilinear) and the output,
+    see measure_resampling_bytes for the bytes actually allocated
+    """
+    height, width, channels = img_dims
+    grid_h, grid_w = grid_hw if grid_hw is not None else (height, width)
+    num_points = grid_h * grid_w
+    pixel_bytes = channels * tf.as_dtype(dtype).size
+    grid_bytes = num_points * 2 * 4
+    if interpolation == 'nearest':
+        return grid_bytes + num_points * 2 * 4 + 2 * num_points * pixel_bytes
+    elif interpolation == 'bilinear':
+        corners_bytes = 4 * num_points * channels * tf.as_dtype(compute_dtype).size
+        return grid_bytes + 4 * num_points * 4 + corners_bytes + num_points * pixel_bytes
+    raise ValueError(f'interpolation must be one of {INTERPOLATIONS}, got {interpolation}')
+
+
+def measure_resampling_bytes(img, grid, interpolation='nearest', compute_dtype=tf.float32, device='CPU:0'):
+    """
+    Measured peak bytes allocated by TF on the device to resample an image on a grid eagerly (above the inputs),
+    from the tf.config.experimental memory stats, next to estimate_resampling_bytes
+    """
+    with tf.device(device):
+        img, grid = tf.identity(img), tf.identity(grid)
+        # A first call, so the measured call doesn't include one-off allocations
+        sample_image(img, grid, interpolation, compute_dtype=compute_dtype)
+        tf.config.experimental.reset_memory_stats(device)
+        start_bytes = tf.config.experimental.get_memory_info(device)['current']
+        sample_image(img, grid, interpolation, compute_dtype=compute_dtype)
+        return tf.config.experimental.get_memory_info(device)['peak'] - start_bytes
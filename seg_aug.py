@@ -1,86 +1,767 @@
+import functools
 import tensorflow as tf
-from tf_image_augmentations import utils, affine, elastic
+from tf_image_augmentations import utils, affine, elastic, sampling, binary_mask, instrumentation
 
 """ The functions in this model are performed on both the image and the mask.
 Functions to preform random segmentation augmentations maintaining compatability between the image and the mask"""
 
 
+def _sample_flips(params_shape, rate_flip_lr, rate_flip_ud):
+    """Random left-right and up-down flip flags"""
+    flag_flip_lr = tf.random.uniform(shape=params_shape, minval=0.0, maxval=1.0) < rate_flip_lr
+    flag_flip_ud = tf.random.uniform(shape=params_shape, minval=0.0, maxval=1.0) < rate_flip_ud
+    return flag_flip_lr, flag_flip_ud
+
+
+def _sample_affine_params(params_shape, rotation_min, rotation_max, shear_min, shear_max, zoom_min, zoom_max):
+    """Random rotation angle, shear factor, zoom_h and zoom_w"""
+    rot_angle = tf.random.uniform(shape=params_shape, minval=rotation_min, maxval=rotation_max)
+    shear_factor = tf.random.uniform(shape=params_shape, minval=shear_min, maxval=shear_max)
+    zoom_h, zoom_w = tf.unstack(tf.random.uniform(shape=[2] + params_shape, minval=zoom_min, maxval=zoom_max))
+    return rot_angle, shear_factor, zoom_h, zoom_w
+
+
+def _sample_affine_matrix(params_shape, rotation_min, rotation_max, shear_min, shear_max, zoom_min, zoom_max):
+    """Random rotation @ shear @ zoom matrix, 3x3 for params_shape [] or Bx3x3 for params_shape [B]"""
+    rot_angle, shear_factor, zoom_h, zoom_w = _sample_affine_params(params_shape, rotation_min, rotation_max,
+                                                                    shear_min, shear_max, zoom_min, zoom_max)
+
+    if len(params_shape) == 0:
+        rot_mat = affine.generate_rotation_matrix(rot_angle)
+        shear_mat = affine.generate_shear_matrix(shear_factor)
+        zoom_mat = affine.generate_zoom_matrix(zoom_h, zoom_w)
+    else:
+        rot_mat = affine.generate_rotation_matrices(rot_angle)
+        shear_mat = affine.generate_shear_matrices(shear_factor)
+        zoom_mat = affine.generate_zoom_matrices(zoom_h, zoom_w)
+    return rot_mat @ shear_mat @ zoom_mat
+
+
+@instrumentation.instrumented('seg_aug.sample_affine_plan')
+def sample_affine_plan(img_hw,
+                       rotation_min=0.0, rotation_max=0.0,
+                       shear_min=0.0, shear_max=0.0,
+                       zoom_min=1.0, zoom_max=1.0,
+                       rate_flip_lr=0.0, rate_flip_ud=0.0,
+                       batch_size=None, fill_value=0.0, pixel_centers=False):
+    """
+    Samples the random affine parameters once and builds their sampling grid, the plan is applied by apply_plan
+    and transform_annotations
+    batch_size: None for a single HWC sample, otherwise independent parameters for every sample of a BHWC batch
+    pixel_centers: False for the pixels of the original random_affine_transform (truncated source coordinates,
+    see affine.linear_transform_grid), True for the pixel center convention of the other plans, needed for a smooth
+    bilinear warp and for annotations that move exactly with the pixels
+    """
+    params_shape = [] if batch_size is None else [batch_size]
+    flag_flip_lr, flag_flip_ud = _sample_flips(params_shape, rate_flip_lr, rate_flip_ud)
+    trans_mat = _sample_affine_matrix(params_shape, rotation_min, rotation_max, shear_min, shear_max,
+                                      zoom_min, zoom_max)
+
+    grid = affine.linear_transform_grid(img_hw, trans_mat, pixel_centers)
+    # The flips are applied to the image before the transformation
+    grid = sampling.flip_grid(grid, img_hw, flag_flip_lr, flag_flip_ud)
+    return {'grid': grid, 'fill_value': fill_value, 'img_hw': tf.convert_to_tensor(img_hw), 'trans_mat': trans_mat,
+            'flip_lr': flag_flip_lr, 'flip_ud': flag_flip_ud, 'pixel_centers': pixel_centers}
+
+
+def _sample_elastic_flow(img_hw, elasticity_coefficient, deformation_intensity, flow_bank=None):
+    """A fresh random elastic flow, or a draw from an elastic.ElasticFlowBank built for the same parameters"""
+    if flow_bank is not None:
+        return flow_bank.draw()
+    return elastic.generate_random_elastic_flow(img_hw, elasticity_coefficient, deformation_intensity)
+
+
+@instrumentation.instrumented('seg_aug.sample_elastic_plan')
+def sample_elastic_plan(img_hw, elasticity_coefficient, deformation_intensity, flow_bank=None):
+    """
+    Samples a random elastic flow once and builds its sampling grid, the plan is applied by apply_plan
+    and transform_annotations
+    flow_bank: optional elastic.ElasticFlowBank to draw the flow from instead of generating it
+    """
+    elastic_flow = _sample_elastic_flow(img_hw, elasticity_coefficient, deformation_intensity, flow_bank)
+    return {'grid': elastic.flow_to_grid(elastic_flow), 'fill_value': None, 'img_hw': tf.shape(elastic_flow)[:2],
+            'flow': elastic_flow}
+
+
+@instrumentation.instrumented('seg_aug.apply_plan')
+def apply_plan(plan, tensors, interpolation='nearest', compute_dtype=tf.float32):
+    """
+    Applies a sampled plan to any structure (dict, tuple, list) of aligned tensors,
+    HWC tensors for a single sample plan or BHWC for a batch plan, each tensor keeps its dtype and channels
+    interpolation: one of sampling.INTERPOLATIONS for all the tensors, or a matching structure with one per tensor
+    compute_dtype: the bilinear blend dtype, see sampling for the accuracy tradeoff
+    """
+    if instrumentation.active_recorder() is not None:
+        instrumentation.count('seg_aug.apply_plan', 'identity_transforms', _num_identity_grids(plan['grid']))
+    if isinstance(interpolation, str):
+        interpolation = tf.nest.map_structure(lambda _: interpolation, tensors)
+    return tf.nest.map_structure(
+        lambda tensor, tensor_interpolation: sampling.sample_image(tensor, plan['grid'], tensor_interpolation,
+                                                                   plan['fill_value'], compute_dtype),
+        tensors, interpolation, check_types=False)
+
+
+def _transform_points_dense(plan, points):
+    """Moves dense ...2 points, N2 (or any leading dimensions) for a single sample plan and BN2 for a batch plan"""
+    points = tf.cast(points, tf.float32)
+    if 'trans_mat' in plan:
+        batch_shape = tf.shape(plan['trans_mat'])[:-2]
+        sample__points = tf.reshape(points, tf.concat([batch_shape, [-1, 2]], axis=0))
+        sample__points = sampling.flip_points(sample__points, plan['img_hw'], plan['flip_lr'], plan['flip_ud'])
+        sample__points = affine.transform_points(sample__points, plan['img_hw'], plan['trans_mat'],
+                                                 plan['pixel_centers'])
+    elif 'flow' in plan:
+        sample__points = elastic.warp_points_by_flow(tf.reshape(points, [-1, 2]), plan['flow'])
+    else:
+        raise ValueError('only affine and elastic plans (sample_affine_plan, sample_elastic_plan) transform points')
+    return tf.reshape(sample__points, tf.shape(points))
+
+
+@instrumentation.instrumented('seg_aug.transform_points')
+def transform_points(plan, points):
+    """
+    Moves keypoints or polygon vertices to where the plan moves their pixels, computed from the sampled parameters
+    at O(number of points): exactly for affine plans with pixel_centers (including the flips), to the center of the
+    output pixels reading the point's pixel for the default truncated affine plans (within a pixel of the warped
+    labels), and by the flow sampled at the points for elastic plans
+    points: ...2 (h, w) pixel coordinates (the sampling grid convention), BN2 for a batch plan,
+    or a ragged tensor (e.g. polygons x (vertices) x 2) for a single sample plan
+    """
+    if isinstance(points, tf.RaggedTensor):
+        return tf.ragged.map_flat_values(lambda flat_points: _transform_points_dense(plan, flat_points), points)
+    return _transform_points_dense(plan, points)
+
+
+@instrumentation.instrumented('seg_aug.transform_boxes')
+def transform_boxes(plan, boxes):
+    """
+    Moves boxes in the binary_mask.tight_box_coordinates format (min_y, min_x, max_y, max_x relative to the image)
+    by the plan, to the box of their moved corners clipped to the image, ...4 or BN4 for a batch plan
+    The box of the moved corners encloses the moved box, it can be looser than the box of the warped mask
+    """
+    boxes = tf.cast(boxes, tf.float32)
+    hw__limits = tf.cast(plan['img_hw'] - 1, tf.float32)
+    min_y, min_x, max_y, max_x = tf.unstack(boxes * tf.tile(hw__limits, [2]), axis=-1)
+    corners = tf.stack([tf.stack([min_y, min_x], -1), tf.stack([min_y, max_x], -1),
+                        tf.stack([max_y, min_x], -1), tf.stack([max_y, max_x], -1)], axis=-2)
+    corners = transform_points(plan, corners) / hw__limits
+    moved_boxes = tf.concat([tf.reduce_min(corners, axis=-2), tf.reduce_max(corners, axis=-2)], axis=-1)
+    return tf.clip_by_value(moved_boxes, 0.0, 1.0)
+
+
+ANNOTATION_KEYS = ('boxes', 'keypoints', 'polygons')
+
+
+def transform_annotations(plan, annotations):
+    """
+    Moves a dict of annotations by the plan: 'boxes' by transform_boxes, 'keypoints' and 'polygons' by
+    transform_points
+    """
+    unknown_keys = set(annotations) - set(ANNOTATION_KEYS)
+    if unknown_keys:
+        raise ValueError(f'annotation keys should be in {ANNOTATION_KEYS}, got {sorted(unknown_keys)}')
+    return {key: transform_boxes(plan, value) if key == 'boxes' else transform_points(plan, value)
+            for key, value in annotations.items()}
+
+
+def _num_identity_grids(grid):
+    """The number of grids (of a single or batch plan) that sample every pixel from itself"""
+    num_dims = grid.shape[-1]
+    if num_dims == 3:
+        identity = sampling.identity_grid_3d(tf.shape(grid)[-4:-1])
+    else:
+        identity = sampling.identity_grid(tf.shape(grid)[-3:-1])
+    is_identity = tf.reduce_all(tf.equal(grid, identity), axis=list(range(-num_dims - 1, 0)))
+    return tf.reduce_sum(tf.cast(is_identity, tf.int64))
+
+
+def _structure_hw(tensors):
+    """The height and width of the first tensor of a structure"""
+    return utils.image_shape_to_hw(tf.shape(tf.nest.flatten(tensors)[0]))
+
+
+def _is_static_value(value, *values):
+    """True for python values (not tensors) equal to one of the values"""
+    return not isinstance(value, (tf.Tensor, tf.Variable)) and value in values
+
+
+def _is_identity_affine(rotation_min, rotation_max, shear_min, shear_max, zoom_min, zoom_max,
+                        rate_flip_lr=0.0, rate_flip_ud=0.0):
+    """True when the python parameters can only sample the identity transformation, known while tracing"""
+    return (all(_is_static_value(value, 0.0) for value in (rotation_min, rotation_max, shear_min, shear_max,
+                                                            rate_flip_lr, rate_flip_ud)) and
+            all(_is_static_value(value, 1.0) for value in (zoom_min, zoom_max)))
+
+
+def _is_identity_elastic(deformation_intensity, flow_bank=None):
+    """True when the elastic parameters can only sample the zero flow, known while tracing"""
+    return flow_bank is None and _is_static_value(deformation_intensity, 0.0)
+
+
+def random_affine_transform_tensors(tensors, interpolation='nearest',
+                                    rotation_min=0.0, rotation_max=0.0,
+                                    shear_min=0.0, shear_max=0.0,
+                                    zoom_min=1.0, zoom_max=1.0,
+                                    rate_flip_lr=0.0, rate_flip_ud=0.0, pixel_centers=False):
+    """
+    Applies the same random affine transformation to a structure of aligned HWC tensors
+    interpolation: one for all the tensors, or a matching structure with one per tensor
+    pixel_centers: the sample_affine_plan convention, True for a smooth bilinear warp
+    The tensors are returned as is when the parameters can only sample the identity (e.g. the default values)
+    """
+    if _is_identity_affine(rotation_min, rotation_max, shear_min, shear_max, zoom_min, zoom_max,
+                           rate_flip_lr, rate_flip_ud):
+        return tensors
+    plan = sample_affine_plan(_structure_hw(tensors),
+                              rotation_min, rotation_max,
+                              shear_min, shear_max,
+                              zoom_min, zoom_max,
+                              rate_flip_lr, rate_flip_ud,
+                              pixel_centers=pixel_centers)
+    return apply_plan(plan, tensors, interpolation)
+
+
+@instrumentation.instrumented('seg_aug.random_affine_transform')
 def random_affine_transform(inputs, labels,
                             rotation_min=0.0, rotation_max=0.0,
                             shear_min=0.0, shear_max=0.0,
                             zoom_min=1.0, zoom_max=1.0,
-                            rate_flip_lr=0.0, rate_flip_ud=0.0):
+                            rate_flip_lr=0.0, rate_flip_ud=0.0,
+                            index_cache=None):
     """
     Apply random affine transformations for data augmentation
     rotation in radians
     shear and zoom relative to the image size
     rate flip_lr, flip_ud, which fraction of the images to flip: 0.0 never, 1.0 always
+    index_cache: optional affine.AffineIndexCache, the parameters are quantized to its steps and the warp is a
+    cached gather-index table lookup and a gather
    """
 
     tf.assert_rank(inputs, 3, 'expected image format HWC (3D)')
     tf.assert_rank(labels, 3, 'expected label format HWC (3D)')
+    if index_cache is not None and not _is_identity_affine(rotation_min, rotation_max, shear_min, shear_max,
+                                                           zoom_min, zoom_max, rate_flip_lr, rate_flip_ud):
+        affine_params = _sample_affine_params([], rotation_min, rotation_max, shear_min, shear_max, zoom_min, zoom_max)
+        flag_flip_lr, flag_flip_ud = _sample_flips([], rate_flip_lr, rate_flip_ud)
+        index_table = index_cache.index_table(tf.shape(inputs)[:2], *affine_params, flag_flip_lr, flag_flip_ud)
+        return affine.gather_by_index_table(inputs, index_table), affine.gather_by_index_table(labels, index_table)
 
-    flag_flip_lr = tf.random.uniform(shape=[], minval=0.0, maxval=1.0) < rate_flip_lr
-    flag_flip_ud = tf.random.uniform(shape=[], minval=0.0, maxval=1.0) < rate_flip_ud
-
-    rot_angle = tf.random.uniform(shape=[], minval=rotation_min, maxval=rotation_max)
-    shear_factor = tf.random.uniform(shape=[], minval=shear_min, maxval=shear_max)
-    zoom_h, zoom_w = tf.unstack(tf.random.uniform(shape=(2,), minval=zoom_min, maxval=zoom_max))
-
-    if flag_flip_lr:
-        inputs = tf.image.flip_left_right(inputs)
-        labels = tf.image.flip_left_right(labels)
-
-    if flag_flip_ud:
-        inputs = tf.image.flip_up_down(inputs)
-        labels = tf.image.flip_up_down(labels)
-
-    rot_mat = affine.generate_rotation_matrix(rot_angle)
-    shear_mat = affine.generate_shear_matrix(shear_factor)
-    zoom_mat = affine.generate_zoom_matrix(zoom_h, zoom_w)
-    trans_mat = rot_mat @ shear_mat @ zoom_mat
-
-    org_coords_inputs, new_coords_inputs = affine.linear_transform_coords(tf.shape(inputs), trans_mat)
-    org_coords_labels, new_coords_labels = affine.linear_transform_coords(tf.shape(labels), trans_mat)
-
-    inputs = affine.linear_transform_from_coords(inputs, org_coords_inputs, new_coords_inputs)
-    labels = affine.linear_transform_from_coords(labels, org_coords_labels, new_coords_labels)
+    inputs, labels = random_affine_transform_tensors((inputs, labels), 'nearest',
+                                                     rotation_min, rotation_max,
+                                                     shear_min, shear_max,
+                                                     zoom_min, zoom_max,
+                                                     rate_flip_lr, rate_flip_ud)
     return inputs, labels
 
 
 def random_affine_transform_fcn(rotation_min, rotation_max,
                                 shear_min, shear_max,
                                 zoom_min, zoom_max,
-                                rate_flip_lr, rate_flip_ud):
+                                rate_flip_lr, rate_flip_ud,
+                                index_cache=None):
     """Function closure for TF dataset map"""
     def transform_fcn(input_image, binary_mask):
         return random_affine_transform(input_image, binary_mask,
                                        rotation_min, rotation_max,
                                        shear_min, shear_max,
                                        zoom_min, zoom_max,
-                                       rate_flip_lr, rate_flip_ud
+                                       rate_flip_lr, rate_flip_ud,
+                                       index_cache
                                        )
     return transform_fcn
 
 
-def elastic_deformation(images, labels, elasticity_coefficient, deformation_intensity):
+@instrumentation.instrumented('seg_aug.random_affine_transform_batch')
+def random_affine_transform_batch(inputs, labels,
+                                  rotation_min=0.0, rotation_max=0.0,
+                                  shear_min=0.0, shear_max=0.0,
+                                  zoom_min=1.0, zoom_max=1.0,
+                                  rate_flip_lr=0.0, rate_flip_ud=0.0):
     """
-    Deforms a batch of images and pixel labels by a random elastic transformation
-    Image format: HWC
+    Batched random_affine_transform, format BHWC for both inputs and labels
+    Every sample of the batch gets its own random parameters and the whole batch is warped in a single gather,
+    to be mapped after Dataset.batch
+   """
+
+    tf.assert_rank(inputs, 4, 'expected image format BHWC (4D)')
+    tf.assert_rank(labels, 4, 'expected label format BHWC (4D)')
+    if _is_identity_affine(rotation_min, rotation_max, shear_min, shear_max, zoom_min, zoom_max,
+                           rate_flip_lr, rate_flip_ud):
+        return inputs, labels
+
+    plan = sample_affine_plan(tf.shape(inputs)[1:3],
+                              rotation_min, rotation_max,
+                              shear_min, shear_max,
+                              zoom_min, zoom_max,
+                              rate_flip_lr, rate_flip_ud,
+                              batch_size=tf.shape(inputs)[0])
+    inputs, labels = apply_plan(plan, (inputs, labels))
+    return inputs, labels
+
+
+@instrumentation.instrumented('seg_aug.random_affine_transform_annotated')
+def random_affine_transform_annotated(inputs, labels, annotations,
+                                      rotation_min=0.0, rotation_max=0.0,
+                                      shear_min=0.0, shear_max=0.0,
+                                      zoom_min=1.0, zoom_max=1.0,
+                                      rate_flip_lr=0.0, rate_flip_ud=0.0):
+    """
+    random_affine_transform that also moves the annotations (see transform_annotations) by the same sampled
+    transformation, instead of recomputing them from the warped labels
+    The plan uses the pixel center convention (see sample_affine_plan), so the annotations match the warped pixels
+    """
+    tf.assert_rank(inputs, 3, 'expected image format HWC (3D)')
+    tf.assert_rank(labels, 3, 'expected label format HWC (3D)')
+    if _is_identity_affine(rotation_min, rotation_max, shear_min, shear_max, zoom_min, zoom_max,
+                           rate_flip_lr, rate_flip_ud):
+        return inputs, labels, annotations
+
+    plan = sample_affine_plan(tf.shape(inputs)[:2],
+                              rotation_min, rotation_max,
+                              shear_min, shear_max,
+                              zoom_min, zoom_max,
+                              rate_flip_lr, rate_flip_ud,
+                              pixel_centers=True)
+    inputs, labels = apply_plan(plan, (inputs, labels))
+    return inputs, labels, transform_annotations(plan, annotations)
+
+
+def random_affine_transform_annotated_fcn(rotation_min, rotation_max,
+                                          shear_min, shear_max,
+                                          zoom_min, zoom_max,
+                                          rate_flip_lr, rate_flip_ud):
+    """Function closure for TF dataset map, for (image, label, annotations) elements"""
+    def transform_fcn(input_image, binary_mask, annotations):
+        return random_affine_transform_annotated(input_image, binary_mask, annotations,
+                                                 rotation_min, rotation_max,
+                                                 shear_min, shear_max,
+                                                 zoom_min, zoom_max,
+                                                 rate_flip_lr, rate_flip_ud)
+    return transform_fcn
+
+
+def random_affine_transform_batch_fcn(rotation_min, rotation_max,
+                                      shear_min, shear_max,
+                                      zoom_min, zoom_max,
+                                      rate_flip_lr, rate_flip_ud):
+    """Function closure for TF dataset map, after batching"""
+    def transform_fcn(input_images, binary_masks):
+        return random_affine_transform_batch(input_images, binary_masks,
+                                             rotation_min, rotation_max,
+                                             shear_min, shear_max,
+                                             zoom_min, zoom_max,
+                                             rate_flip_lr, rate_flip_ud
+                                             )
+    return transform_fcn
+
+
+def elastic_deformation_tensors(tensors, elasticity_coefficient, deformation_intensity, interpolation='bilinear',
+                                flow_bank=None):
+    """
+    Deforms a structure of aligned HWC tensors by the same random elastic transformation
+    interpolation: one for all the tensors, or a matching structure with one per tensor
+    The tensors are returned as is for a python deformation_intensity of 0 (the zero flow)
     """
-    img_hw = utils.image_shape_to_hw(tf.shape(images))
+    if _is_identity_elastic(deformation_intensity, flow_bank):
+        return tensors
+    plan = sample_elastic_plan(_structure_hw(tensors), elasticity_coefficient, deformation_intensity, flow_bank)
+    return apply_plan(plan, tensors, interpolation)
 
-    elastic_flow = elastic.generate_random_elastic_flow(img_hw, elasticity_coefficient, deformation_intensity)
 
-    deformed_image = elastic.warp_image_by_flow(images, elastic_flow)
-    deformed_label = elastic.warp_image_by_flow(labels, elastic_flow)
+@instrumentation.instrumented('seg_aug.elastic_deformation')
+def elastic_deformation(images, labels, elasticity_coefficient, deformation_intensity, flow_bank=None,
+                        label_interpolation='nearest'):
+    """
+    Deforms a batch of images and pixel labels by a random elastic transformation
+    Image format: HWC
+    flow_bank: optional elastic.ElasticFlowBank to draw the flow from instead of generating it
+    label_interpolation: 'nearest' keeps the label values exact (class indices), 'bilinear' for soft labels
+    """
+    deformed_image, deformed_label = elastic_deformation_tensors((images, labels),
+                                                                 elasticity_coefficient, deformation_intensity,
+                                                                 ('bilinear', label_interpolation),
+                                                                 flow_bank)
 
     return deformed_image, deformed_label
 
 
-def elastic_augmentation_fcn(sigma, alpha):
+def elastic_augmentation_fcn(sigma, alpha, flow_bank=None, label_interpolation='nearest'):
     """Closure for TF dataset map """
     def elastic_augmentation(input_image, binary_mask):
-        aug_img, aug_lbl = elastic_deformation(input_image, binary_mask, sigma, alpha)
+        aug_img, aug_lbl = elastic_deformation(input_image, binary_mask, sigma, alpha, flow_bank, label_interpolation)
         return aug_img, aug_lbl
     return elastic_augmentation
+
+
+@instrumentation.instrumented('seg_aug.elastic_deformation_annotated')
+def elastic_deformation_annotated(images, labels, annotations, elasticity_coefficient, deformation_intensity,
+                                  flow_bank=None, label_interpolation='nearest'):
+    """
+    elastic_deformation that also moves the annotations (see transform_annotations) by the flow sampled at their
+    points, instead of recomputing them from the warped labels
+    """
+    if _is_identity_elastic(deformation_intensity, flow_bank):
+        return images, labels, annotations
+    plan = sample_elastic_plan(_structure_hw(images), elasticity_coefficient, deformation_intensity, flow_bank)
+    deformed_image, deformed_label = apply_plan(plan, (images, labels), ('bilinear', label_interpolation))
+    return deformed_image, deformed_label, transform_annotations(plan, annotations)
+
+
+def elastic_augmentation_annotated_fcn(sigma, alpha, flow_bank=None, label_interpolation='nearest'):
+    """Closure for TF dataset map, for (image, label, annotations) elements"""
+    def elastic_augmentation(input_image, binary_mask, annotations):
+        return elastic_deformation_annotated(input_image, binary_mask, annotations, sigma, alpha, flow_bank,
+                                             label_interpolation)
+    return elastic_augmentation
+
+
+def _plan_closure(transform_fcn):
+    """Dataset.map passes tuple elements as separate arguments and any other structure as a single argument"""
+    def plan_fcn(*tensors):
+        return transform_fcn(tensors[0] if len(tensors) == 1 else tensors)
+    return plan_fcn
+
+
+def random_affine_transform_tensors_fcn(interpolation,
+                                        rotation_min, rotation_max,
+                                        shear_min, shear_max,
+                                        zoom_min, zoom_max,
+                                        rate_flip_lr, rate_flip_ud,
+                                        pixel_centers=False):
+    """Function closure for TF dataset map, for elements of any number of aligned tensors"""
+    def transform_fcn(tensors):
+        return random_affine_transform_tensors(tensors, interpolation,
+                                               rotation_min, rotation_max,
+                                               shear_min, shear_max,
+                                               zoom_min, zoom_max,
+                                               rate_flip_lr, rate_flip_ud,
+                                               pixel_centers)
+    return _plan_closure(transform_fcn)
+
+
+def elastic_augmentation_tensors_fcn(sigma, alpha, interpolation='bilinear', flow_bank=None):
+    """Closure for TF dataset map, for elements of any number of aligned tensors"""
+    def elastic_augmentation(tensors):
+        return elastic_deformation_tensors(tensors, sigma, alpha, interpolation, flow_bank)
+    return _plan_closure(elastic_augmentation)
+
+
+def _affine_grid_op(rotation_min, rotation_max, shear_min, shear_max, zoom_min, zoom_max):
+    """Grid operation of a random affine transformation, see _compose_grid_ops"""
+    def affine_op(grid, img_hw):
+        trans_mat = _sample_affine_matrix([], rotation_min, rotation_max, shear_min, shear_max, zoom_min, zoom_max)
+        return affine.transform_grid(grid, img_hw, trans_mat)
+    return affine_op
+
+
+def _elastic_grid_op(elasticity_coefficient, deformation_intensity, flow_bank=None):
+    """Grid operation of a random elastic deformation, see _compose_grid_ops"""
+    def elastic_op(grid, img_hw):
+        elastic_flow = _sample_elastic_flow(img_hw, elasticity_coefficient, deformation_intensity, flow_bank)
+        return grid - sampling.sample_bilinear(elastic_flow, grid)
+    return elastic_op
+
+
+def _compose_grid_ops(grid_ops, img_hw):
+    """Composes grid operations, functions (grid, img_hw) -> grid applied in order, into a single sampling grid"""
+    grid = sampling.identity_grid(img_hw)
+    # The last operation samples the output grid, the first one samples the original image
+    for grid_op in reversed(grid_ops):
+        grid = grid_op(grid, img_hw)
+    return grid
+
+
+class GeometricPipeline:
+    """
+    Composable geometric augmentation for TF dataset map
+    The operations are applied in the order they are added, but they are combined into a single sampling grid
+    so every tensor is resampled once per sample regardless of the number of operations
+    usage: GeometricPipeline().flip(0.5, 0.5).affine(rotation_min=-0.3, rotation_max=0.3).elastic(3, 10.0)
+    """
+    def __init__(self, interpolation='nearest', fill_value=0.0, compute_dtype=tf.float32):
+        """
+        interpolation: one for all the tensors, or a matching structure with one per tensor
+        fill_value: for points sampled out of the image, None to take the closest edge pixel
+        compute_dtype: the bilinear blend dtype, see sampling for the accuracy tradeoff
+        """
+        self.interpolation = interpolation
+        self.fill_value = fill_value
+        self.compute_dtype = compute_dtype
+        self._grid_ops = []
+
+    def flip(self, rate_flip_lr=0.0, rate_flip_ud=0.0):
+        """Random flips, rate: which fraction of the images to flip"""
+        def flip_op(grid, img_hw):
+            flag_flip_lr, flag_flip_ud = _sample_flips([], rate_flip_lr, rate_flip_ud)
+            return sampling.flip_grid(grid, img_hw, flag_flip_lr, flag_flip_ud)
+        self._grid_ops.append(flip_op)
+        return self
+
+    def affine(self, rotation_min=0.0, rotation_max=0.0, shear_min=0.0, shear_max=0.0, zoom_min=1.0, zoom_max=1.0):
+        """Random affine transformation, same parameters as random_affine_transform"""
+        self._grid_ops.append(_affine_grid_op(rotation_min, rotation_max, shear_min, shear_max, zoom_min, zoom_max))
+        return self
+
+    def elastic(self, elasticity_coefficient, deformation_intensity, flow_bank=None):
+        """Random elastic deformation, same parameters as elastic_deformation"""
+        self._grid_ops.append(_elastic_grid_op(elasticity_coefficient, deformation_intensity, flow_bank))
+        return self
+
+    def sample_plan(self, img_hw):
+        """Samples all the operations and composes them into a single plan, applied by apply_plan"""
+        return {'grid': _compose_grid_ops(self._grid_ops, img_hw), 'fill_value': self.fill_value}
+
+    @instrumentation.instrumented('seg_aug.GeometricPipeline.apply')
+    def apply(self, tensors):
+        """Augments a structure of aligned HWC tensors with a single resampling per tensor"""
+        plan = self.sample_plan(_structure_hw(tensors))
+        return apply_plan(plan, tensors, self.interpolation, self.compute_dtype)
+
+    def __call__(self, *tensors):
+        return self.apply(tensors[0] if len(tensors) == 1 else tensors)
+
+
+def _reverse_tensor(tensor, flip_lr, flip_ud):
+    """Flips an HWC tensor with reverse ops, no resampling"""
+    tensor = tf.cond(flip_lr, lambda: tf.reverse(tensor, [-2]), lambda: tensor)
+    return tf.cond(flip_ud, lambda: tf.reverse(tensor, [-3]), lambda: tensor)
+
+
+class AugmentationPolicy:
+    """
+    Probabilistic geometric augmentation policy for TF dataset map, every operation is applied with its own
+    probability, and with num_ops only num_ops of the operations chosen uniformly are considered per sample
+    (as in RandAugment, TrivialAugment is num_ops=1)
+    Operations that can't change the image are dropped when they are added, and the operations that are applied
+    are combined into a single resampling like GeometricPipeline. When no affine or elastic operation is applied
+    the resampling is skipped: the tensors are returned as is, or flipped with reverse ops
+    usage: AugmentationPolicy().flip(0.5, 0.5).affine(0.5, rotation_min=-0.3, rotation_max=0.3).elastic(0.5, 3, 10.0)
+    """
+    def __init__(self, interpolation='nearest', fill_value=0.0, compute_dtype=tf.float32, num_ops=None):
+        """
+        interpolation, fill_value, compute_dtype: as in GeometricPipeline
+        num_ops: number of operations considered per sample, None for all of them
+        """
+        self.interpolation = interpolation
+        self.fill_value = fill_value
+        self.compute_dtype = compute_dtype
+        self.num_ops = num_ops
+        # (probability, flip rates or None, grid op or None) in the order they are added
+        self._ops = []
+
+    def flip(self, rate_flip_lr=0.0, rate_flip_ud=0.0):
+        """Random flips, rate: which fraction of the images to flip"""
+        if not (_is_static_value(rate_flip_lr, 0.0) and _is_static_value(rate_flip_ud, 0.0)):
+            self._ops.append((1.0, (rate_flip_lr, rate_flip_ud), None))
+        return self
+
+    def affine(self, probability, rotation_min=0.0, rotation_max=0.0, shear_min=0.0, shear_max=0.0,
+               zoom_min=1.0, zoom_max=1.0):
+        """Random affine transformation applied with a probability, same parameters as random_affine_transform"""
+        if not (_is_static_value(probability, 0.0) or
+                _is_identity_affine(rotation_min, rotation_max, shear_min, shear_max, zoom_min, zoom_max)):
+            affine_op = _affine_grid_op(rotation_min, rotation_max, shear_min, shear_max, zoom_min, zoom_max)
+            self._ops.append((probability, None, affine_op))
+        return self
+
+    def elastic(self, probability, elasticity_coefficient, deformation_intensity, flow_bank=None):
+        """Random elastic deformation applied with a probability, same parameters as elastic_deformation"""
+        if not (_is_static_value(probability, 0.0) or _is_identity_elastic(deformation_intensity, flow_bank)):
+            self._ops.append((probability, None, _elastic_grid_op(elasticity_coefficient, deformation_intensity,
+                                                                  flow_bank)))
+        return self
+
+    def sample_applied(self):
+        """Samples which operations are applied to a sample, a boolean per operation"""
+        num_ops = len(self._ops)
+        applied = tf.random.uniform([num_ops]) < tf.cast([probability for probability, _, _ in self._ops],
+                                                         tf.float32)
+        if self.num_ops is not None and self.num_ops < num_ops:
+            _, chosen = tf.math.top_k(tf.random.uniform([num_ops]), self.num_ops)
+            applied &= tf.scatter_nd(chosen[:, None], tf.ones([self.num_ops], tf.bool), [num_ops])
+        return tf.unstack(applied, num_ops)
+
+    @instrumentation.instrumented('seg_aug.AugmentationPolicy.apply')
+    def apply(self, tensors):
+        """Augments a structure of aligned HWC tensors, with at most a single resampling per tensor"""
+        if not self._ops:
+            return tensors
+        applied = self.sample_applied()
+        flips = [tuple(tf.logical_and(op_applied, flag) for flag in _sample_flips([], *rates))
+                 for op_applied, (_, rates, _) in zip(applied, self._ops) if rates is not None]
+        grid_ops = [(op_applied, grid_op) for op_applied, (_, _, grid_op) in zip(applied, self._ops)
+                    if grid_op is not None]
+
+        def reverse():
+            # Flips commute with each other, only the parity of each flip matters
+            flip_lr = functools.reduce(tf.math.logical_xor, [lr for lr, _ in flips], tf.constant(False))
+            flip_ud = functools.reduce(tf.math.logical_xor, [ud for _, ud in flips], tf.constant(False))
+            return tf.nest.map_structure(lambda tensor: _reverse_tensor(tensor, flip_lr, flip_ud), tensors)
+
+        def flip_op(flip_lr, flip_ud):
+            return lambda grid, img_hw: sampling.flip_grid(grid, img_hw, flip_lr, flip_ud)
+
+        def optional_op(op_applied, grid_op):
+            return lambda grid, img_hw: tf.cond(op_applied, lambda: grid_op(grid, img_hw), lambda: grid)
+
+        def resample():
+            flip_iter = iter(flips)
+            applied_ops = [flip_op(*next(flip_iter)) if grid_op is None else optional_op(op_applied, grid_op)
+                           for op_applied, (_, _, grid_op) in zip(applied, self._ops)]
+            grid = _compose_grid_ops(applied_ops, _structure_hw(tensors))
+            return apply_plan({'grid': grid, 'fill_value': self.fill_value}, tensors, self.interpolation,
+                              self.compute_dtype)
+
+        if not grid_ops:
+            return reverse()
+        resampled = tf.reduce_any([op_applied for op_applied, _ in grid_ops])
+        instrumentation.count('seg_aug.AugmentationPolicy.apply', 'skipped_resamplings', tf.logical_not(resampled))
+        return tf.cond(resampled, resample, reverse)
+
+    def __call__(self, *tensors):
+        return self.apply(tensors[0] if len(tensors) == 1 else tensors)
+
+
+@instrumentation.instrumented('seg_aug.sample_object_crop_plan')
+def sample_object_crop_plan(mask, img_hw, output_hw, margin=0.0, pipeline=None):
+    """
+    Plans an object centred crop before augmentation: the loose box of the object (binary_mask.loose_box_coordinates)
+    is mapped to output_hw and augmented by the pipeline (a GeometricPipeline, in output pixels around the object
+    center)
+    The expanded ROI is the bounding box of all the source points of the augmented output, so it covers any rotation,
+    zoom and elastic displacement, and apply_object_crop_plan only warps the crop
+    Returns a plan with the 'crop_box' of the expanded ROI: offset_h, offset_w, crop_h, crop_w
+    """
+    img_hw = tf.convert_to_tensor(img_hw)
+    output_hw = tf.convert_to_tensor(output_hw)
+    hw__limits = tf.cast(img_hw - 1, tf.float32)
+    min_y, min_x, max_y, max_x = tf.unstack(binary_mask.loose_box_coordinates(mask, margin))
+    roi_min = tf.stack([min_y, min_x]) * hw__limits
+    roi_max = tf.stack([max_y, max_x]) * hw__limits
+    output_limits = tf.cast(tf.maximum(output_hw - 1, 1), tf.float32)
+
+    if pipeline is None:
+        output_grid = sampling.identity_grid(output_hw)
+        fill_value = 0.0
+    else:
+        output_plan = pipeline.sample_plan(output_hw)
+        output_grid, fill_value = output_plan['grid'], output_plan['fill_value']
+    # The output center is the object center, the output corners are the ROI corners
+    grid = (roi_min + roi_max) / 2 + (output_grid - (output_limits / 2)) * ((roi_max - roi_min) / output_limits)
+
+    crop_box = sampling.source_window(grid, img_hw)
+    return {'grid': grid, 'fill_value': fill_value, 'crop_box': crop_box, 'img_hw': img_hw}
+
+
+@instrumentation.instrumented('seg_aug.apply_object_crop_plan')
+def apply_object_crop_plan(plan, tensors, interpolation='nearest', compute_dtype=tf.float32):
+    """Crops the expanded ROI of a sample_object_crop_plan from a structure of aligned HWC tensors and warps only it"""
+    offset_h, offset_w, crop_h, crop_w = tf.unstack(plan['crop_box'])
+    if isinstance(interpolation, str):
+        interpolation = tf.nest.map_structure(lambda _: interpolation, tensors)
+    return tf.nest.map_structure(
+        lambda tensor, tensor_interpolation: sampling.sample_image(
+            tensor[offset_h:offset_h + crop_h, offset_w:offset_w + crop_w], plan['grid'], tensor_interpolation,
+            plan['fill_value'], compute_dtype, source_offset=[offset_h, offset_w], source_hw=plan['img_hw']),
+        tensors, interpolation, check_types=False)
+
+
+def object_crop_augmentation(tensors, mask, output_hw, margin=0.0, pipeline=None, interpolation=None):
+    """
+    Crop before augment: the same result as augmenting the full frame around the object and cropping the output_hw
+    object box, but only the object ROI is warped
+    mask: the object binary mask (HW or HWC), interpolation: default the pipeline interpolation or 'nearest'
+    """
+    plan = sample_object_crop_plan(mask, _structure_hw(tensors), output_hw, margin, pipeline)
+    if interpolation is None:
+        interpolation = 'nearest' if pipeline is None else pipeline.interpolation
+    compute_dtype = tf.float32 if pipeline is None else pipeline.compute_dtype
+    return apply_object_crop_plan(plan, tensors, interpolation, compute_dtype)
+
+
+def object_crop_augmentation_fcn(output_hw, margin=0.0, pipeline=None, mask_key=-1, interpolation=None):
+    """Closure for TF dataset map, mask_key: the index (tuple elements) or key (dict elements) of the object mask"""
+    def crop_augmentation(tensors):
+        return object_crop_augmentation(tensors, tensors[mask_key], output_hw, margin, pipeline, interpolation)
+    return _plan_closure(crop_augmentation)
+
+
+@instrumentation.instrumented('seg_aug.sample_affine_plan_3d')
+def sample_affine_plan_3d(img_dhw,
+                          rotation_min=0.0, rotation_max=0.0,
+                          shear_min=0.0, shear_max=0.0,
+                          zoom_min=1.0, zoom_max=1.0,
+                          rate_flip=0.0, fill_value=0.0):
+    """
+    Volume (DHWC) counterpart of sample_affine_plan, the plan is applied by apply_plan
+    rotations, shears and zooms are sampled independently for the 3 planes / axes,
+    rate_flip: which fraction of the volumes to flip along each axis
+    """
+    flags_flip = tf.random.uniform(shape=[3], minval=0.0, maxval=1.0) < rate_flip
+    rot_angles = tf.unstack(tf.random.uniform(shape=[3], minval=rotation_min, maxval=rotation_max))
+    shear_factors = tf.unstack(tf.random.uniform(shape=[3], minval=shear_min, maxval=shear_max))
+    zooms = tf.unstack(tf.random.uniform(shape=[3], minval=zoom_min, maxval=zoom_max))
+    trans_mat = affine.generate_rotation_matrix_3d(*rot_angles) @ affine.generate_shear_matrix_3d(*shear_factors) @\
+        affine.generate_zoom_matrix_3d(*zooms)
+
+    grid = affine.linear_transform_grid_3d(img_dhw, trans_mat)
+    grid = sampling.flip_grid_3d(grid, img_dhw, flags_flip)
+    return {'grid': grid, 'fill_value': fill_value}
+
+
+@instrumentation.instrumented('seg_aug.sample_elastic_plan_3d')
+def sample_elastic_plan_3d(img_dhw, elasticity_coefficient, deformation_intensity, grid_spacing=None):
+    """Volume (DHWC) counterpart of sample_elastic_plan, the flow is sampled on a coarse 3D control grid"""
+    elastic_flow = elastic.generate_coarse_elastic_flow_3d(img_dhw, elasticity_coefficient, deformation_intensity,
+                                                           grid_spacing)
+    grid = sampling.identity_grid_3d(img_dhw) - elastic_flow
+    return {'grid': grid, 'fill_value': None}
+
+
+@instrumentation.instrumented('seg_aug.random_affine_transform_3d')
+def random_affine_transform_3d(inputs, labels,
+                               rotation_min=0.0, rotation_max=0.0,
+                               shear_min=0.0, shear_max=0.0,
+                               zoom_min=1.0, zoom_max=1.0,
+                               rate_flip=0.0):
+    """Volume counterpart of random_affine_transform, format DHWC for both inputs and labels"""
+    tf.assert_rank(inputs, 4, 'expected volume format DHWC (4D)')
+    tf.assert_rank(labels, 4, 'expected label format DHWC (4D)')
+    plan = sample_affine_plan_3d(tf.shape(inputs)[:3], rotation_min, rotation_max, shear_min, shear_max,
+                                 zoom_min, zoom_max, rate_flip)
+    inputs, labels = apply_plan(plan, (inputs, labels))
+    return inputs, labels
+
+
+def random_affine_transform_3d_fcn(rotation_min, rotation_max,
+                                   shear_min, shear_max,
+                                   zoom_min, zoom_max,
+                                   rate_flip):
+    """Function closure for TF dataset map"""
+    def transform_fcn(input_volume, label_volume):
+        return random_affine_transform_3d(input_volume, label_volume,
+                                          rotation_min, rotation_max,
+                                          shear_min, shear_max,
+                                          zoom_min, zoom_max,
+                                          rate_flip)
+    return transform_fcn
+
+
+@instrumentation.instrumented('seg_aug.elastic_deformation_3d')
+def elastic_deformation_3d(images, labels, elasticity_coefficient, deformation_intensity, grid_spacing=None,
+                           label_interpolation='nearest'):
+    """
+    Volume counterpart of elastic_deformation, format DHWC, the deformation is smooth across the slices
+    and every volume is warped in one gather
+    """
+    tf.assert_rank(images, 4, 'expected volume format DHWC (4D)')
+    plan = sample_elastic_plan_3d(tf.shape(images)[:3], elasticity_coefficient, deformation_intensity, grid_spacing)
+    deformed_image, deformed_label = apply_plan(plan, (images, labels), ('bilinear', label_interpolation))
+    return deformed_image, deformed_label
+
+
+def elastic_augmentation_3d_fcn(sigma, alpha, grid_spacing=None, label_interpolation='nearest'):
+    """Closure for TF dataset map"""
+    def elastic_augmentation(input_volume, label_volume):
+        return elastic_deformation_3d(input_volume, label_volume, sigma, alpha, grid_spacing, label_interpolation)
+    return elastic_augmentation
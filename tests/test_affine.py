@@ -1,5 +1,5 @@
 import tensorflow as tf
-from tf_image_augmentations import affine, utils
+from tf_image_augmentations import affine, utils, sampling
 
 
 class TestAffine(tf.test.TestCase):
@@ -51,3 +51,82 @@ class TestAffine(tf.test.TestCase):
         trans_image = affine.linear_transform_image(self.dummy_image, shear_factor=0.1)
         self.assertShapeEqual(trans_image.numpy(), self.dummy_image)
         self.assertNotAllEqual(trans_image, self.dummy_image)
+
+    def test_generate_matrices_batch(self):
+        # The batched matrices should match the single matrices
+        angles = tf.constant([0.0, 0.3, -1.2])
+        self.assertAllClose(affine.generate_rotation_matrices(angles)[1], affine.generate_rotation_matrix(angles[1]))
+        self.assertAllClose(affine.generate_shear_matrices(angles)[2], affine.generate_shear_matrix(angles[2]))
+        self.assertAllClose(affine.generate_zoom_matrices(angles, angles)[1],
+                            affine.generate_zoom_matrix(angles[1], angles[1]))
+
+    def test_linear_transform_image_batch(self):
+        # Every sample of the batch should match the per-example transformation
+        dummy_batch = tf.stack([self.dummy_image, self.dummy_image[::-1], self.dummy_image[:, ::-1]])
+        angles = tf.constant([0.0, 0.3, -0.5])
+        shears = tf.constant([0.0, 0.1, -0.2])
+        zooms_h = tf.constant([1.0, 0.8, 1.3])
+        zooms_w = tf.constant([1.0, 1.2, 0.9])
+        trans_batch = affine.linear_transform_image_batch(dummy_batch, angles, shears, zooms_h, zooms_w)
+        self.assertShapeEqual(trans_batch.numpy(), dummy_batch)
+        for i in range(3):
+            trans_image = affine.linear_transform_image(dummy_batch[i], angles[i], shears[i], zooms_h[i], zooms_w[i])
+            self.assertAllEqual(trans_batch[i], trans_image)
+
+    def test_linear_transform_tiles(self):
+        # The tiled transformation is identical to the untiled transformation
+        trans_mat = affine.generate_rotation_matrix(0.4) @ affine.generate_zoom_matrix(1.3, 0.8)
+        tiles = affine.linear_transform_tiles(self.dummy_image.numpy(), trans_mat, tile_hw=(64, 100))
+        tiled_image = sampling.assemble_tiles(tiles, self.image_dims, tf.float32)
+        grid = affine.linear_transform_grid(self.image_dims[:2], trans_mat)
+        self.assertAllEqual(tiled_image, sampling.sample_image(self.dummy_image, grid, fill_value=0.0))
+
+    def test_generate_matrices_3d(self):
+        # Zero parameters are the unit transformation
+        self.assertAllClose(affine.generate_rotation_matrix_3d(0.0, 0.0, 0.0), tf.eye(4))
+        self.assertAllClose(affine.generate_shear_matrix_3d(0.0, 0.0, 0.0), tf.eye(4))
+        self.assertAllClose(affine.generate_zoom_matrix_3d(1.0, 1.0, 1.0), tf.eye(4))
+        # A rotation in the (h, w) plane is the 2D rotation
+        rot_mat = affine.generate_rotation_matrix_3d(0.3)
+        self.assertAllClose(rot_mat[1:3, 1:3], affine.generate_rotation_matrix(0.3)[:2, :2])
+
+    def test_linear_transform_grid_3d(self):
+        # The unit transformation samples every voxel from itself
+        grid = affine.linear_transform_grid_3d([8, 10, 12], tf.eye(4))
+        self.assertAllClose(grid, sampling.identity_grid_3d([8, 10, 12]))
+        # A rotation in the (h, w) plane is the 2D rotation of every slice
+        grid = affine.linear_transform_grid_3d([8, 10, 12], affine.generate_rotation_matrix_3d(0.3))
+        grid_2d = affine.linear_transform_grid([10, 12], affine.generate_rotation_matrix(0.3))
+        self.assertAllClose(grid[3, ..., 1:], grid_2d, atol=1e-5)
+
+    def test_affine_index_cache(self):
+        cache = affine.AffineIndexCache(max_entries=2, rotation_step=0.1, shear_step=0.1, zoom_step=0.1)
+        # The cached warp is the grid warp of the quantized parameters
+        trans_img = cache.transform_image(self.dummy_image, 0.33, 0.12, 1.14, 0.91)
+        trans_mat = affine.generate_rotation_matrix(0.3) @ affine.generate_shear_matrix(0.1) @ \
+            affine.generate_zoom_matrix(1.1, 0.9)
+        grid = affine.linear_transform_grid(tf.shape(self.dummy_image)[:2], trans_mat, pixel_centers=False)
+        expected_img = sampling.sample_image(self.dummy_image, grid, fill_value=0.0)
+        mismatched = tf.reduce_mean(tf.cast(tf.reduce_any(trans_img != expected_img, axis=-1), tf.float32))
+        self.assertLess(mismatched, 1e-3)
+        self.assertAllEqual(cache.transform_image(self.dummy_image), self.dummy_image)
+
+        # Nearby parameters share a table, the least recently used table is evicted
+        cache.transform_image(self.dummy_image, 0.31, 0.09, 1.12, 0.88)
+        cache.transform_image(self.dummy_image, 1.0)
+        statistics = cache.statistics()
+        self.assertEqual((statistics['hits'], statistics['misses'], statistics['evictions']), (1, 3, 1))
+        self.assertEqual(statistics['entries'], 2)
+        self.assertEqual(statistics['memory_bytes'], 2 * 4 * self.dummy_image.shape[0] * self.dummy_image.shape[1])
+
+        # Shared by parallel dataset map calls
+        cache.clear()
+        lookups = statistics['hits'] + statistics['misses']
+        dataset = tf.data.Dataset.from_tensors(self.dummy_image).repeat(32)
+        dataset = dataset.map(lambda img: cache.transform_image(img, tf.random.uniform([], -0.2, 0.2)),
+                              num_parallel_calls=8)
+        for trans_img in dataset:
+            self.assertShapeEqual(trans_img.numpy(), self.dummy_image)
+        statistics = cache.statistics()
+        self.assertEqual(statistics['hits'] + statistics['misses'] - lookups, 32)
+        self.assertLessEqual(statistics['entries'], 2)
@@ -0,0 +1,38 @@
+import tensorflow as tf
+from tf_image_augmentations.benchmarks import suite
+
+
+class TestBenchmarks(tf.test.TestCase):
+    def test_run_suite(self):
+        # Every case runs in every mode on a small image
+        results = suite.run_suite(sizes=[32], channels=[3], dtypes=['uint8'], parallel_calls=[2],
+                                  num_elements=2, batch_size=2, log=None)
+        self.assertEqual(len(results['results']), len(list(suite.configurations(sizes=[32], channels=[3],
+                                                                                dtypes=['uint8'],
+                                                                                parallel_calls=[2]))))
+        for record in results['results']:
+            self.assertGreater(record['images_per_sec'], 0)
+            self.assertGreaterEqual(record['peak_memory_bytes'], 0)
+
+    def test_coarse_elastic_flow_speed(self):
+        # The coarse flow is faster than the full resolution flow of the same sigma on a large image
+        cases = {case.name: case for case in suite.CASES}
+        records = [suite.run_case(cases[name], 512, 1, 'float32', 'eager', num_elements=8)
+                   for name in ('elastic.generate_random_elastic_flow_sigma_8', 'elastic.generate_coarse_elastic_flow')]
+        self.assertGreater(records[1]['images_per_sec'], records[0]['images_per_sec'])
+
+    def test_compare(self):
+        record = {'case': 'case', 'size': 32, 'channels': 3, 'dtype': 'uint8', 'mode': 'eager',
+                  'num_parallel_calls': None, 'batching': 'none', 'images_per_sec': 100.0, 'peak_memory_bytes': 2 ** 22}
+        baseline = {'results': [record]}
+        self.assertEqual(suite.compare(baseline, baseline), [])
+
+        # Slower and larger than the thresholds
+        regressed = {'results': [dict(record, images_per_sec=50.0, peak_memory_bytes=2 ** 23)]}
+        regressions = suite.compare(regressed, baseline, max_slowdown=0.1, max_memory_increase=0.2)
+        self.assertEqual({regression['metric'] for regression in regressions},
+                         {'images_per_sec', 'peak_memory_bytes'})
+
+        # Small memory differences are noise
+        noisy = {'results': [dict(record, peak_memory_bytes=2 ** 22 + 2 ** 10)]}
+        self.assertEqual(suite.compare(noisy, baseline, max_memory_increase=0.0), [])
@@ -51,3 +51,30 @@ class TestBinaryMask(tf.test.TestCase):
 
 
 
+    def test_instance_box_coordinates(self):
+        # Two images, the first with instances 1 and 3, the second with instance 2 only
+        instance_maps = tf.zeros([2, 64, 64], tf.int32)
+        boxes = {(0, 1): (5, 10, 20, 30), (0, 3): (40, 2, 60, 12), (1, 2): (0, 0, 63, 40)}
+        for (b, instance_id), (ymin, xmin, ymax, xmax) in boxes.items():
+            instance_maps = tf.tensor_scatter_nd_update(
+                instance_maps, [[b]],
+                [tf.where(tf.pad(tf.ones([ymax - ymin + 1, xmax - xmin + 1], tf.bool),
+                                 [[ymin, 63 - ymax], [xmin, 63 - xmax]]), instance_id, instance_maps[b])])
+
+        instance_boxes, present = binary_mask.instance_tight_box_coordinates(instance_maps, 3)
+        self.assertAllEqual(present, [[True, False, True], [False, True, False]])
+        # Every present instance box is the same as the single mask box
+        for (b, instance_id) in boxes:
+            single_box = binary_mask.tight_box_coordinates(tf.cast(instance_maps[b] == instance_id, tf.float32))
+            self.assertAllClose(instance_boxes[b, instance_id - 1], single_box)
+        self.assertAllEqual(instance_boxes[0, 1], tf.zeros([4]))
+
+        # Ragged output keeps only the present instances
+        ragged_boxes = binary_mask.instance_tight_box_coordinates(instance_maps[..., None], 3, ragged=True)
+        self.assertAllEqual(ragged_boxes.row_lengths(), [2, 1])
+
+        MARGIN = 0.05
+        loose_boxes, _ = binary_mask.instance_loose_box_coordinates(instance_maps, 3, MARGIN)
+        single_box = binary_mask.loose_box_coordinates(tf.cast(instance_maps[0] == 3, tf.float32), MARGIN)
+        self.assertAllClose(loose_boxes[0, 2], single_box)
+
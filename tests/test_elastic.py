@@ -1,5 +1,5 @@
 import tensorflow as tf
-from tf_image_augmentations import elastic
+from tf_image_augmentations import elastic, sampling
 
 
 class TestElastic(tf.test.TestCase):
@@ -30,4 +30,128 @@ class TestElastic(tf.test.TestCase):
         self.assertTrue(tf.reduce_all(tf.math.is_finite(trans_image)))
 
 
+    def test_generate_coarse_elastic_flow(self):
+        image_shape = tf.random.uniform([2], minval=1, maxval=500, dtype=tf.int32)
+        for blur in ('separable', 'fft'):
+            flow = elastic.generate_coarse_elastic_flow(image_shape, 8, self.alpha, grid_spacing=2, blur=blur)
+
+            # The flow shape should be HxWx2
+            self.assertEqual(flow.shape, tf.concat([image_shape, [2]], axis=0))
+            # The flow should be smooth
+            self.assertLess(tf.reduce_max(tf.abs(flow[1:] - flow[:-1])), self.alpha / 4)
+            self.assertTrue(tf.reduce_all(tf.math.is_finite(flow)))
+
+        with self.assertRaises(ValueError):
+            elastic.generate_coarse_elastic_flow(image_shape, 8, self.alpha, blur='box')
+
+    def test_generate_coarse_elastic_flow_statistics(self):
+        def statistics(flows):
+            # The flow standard deviation and its autocorrelation at a lag of 8 pixels
+            flows = tf.stack(flows)
+            flows = flows - tf.reduce_mean(flows, axis=[1, 2], keepdims=True)
+            variance = tf.reduce_mean(tf.square(flows))
+            return tf.sqrt(variance), tf.reduce_mean(flows[:, 8:] * flows[:, :-8]) / variance
+
+        for sigma, alpha in ((9, 4.0), (15, 8.0)):
+            # Same amplitude and smoothness as the full resolution flow, for both blurs
+            base_std, base_correlation = statistics(
+                [elastic.generate_random_elastic_flow([128, 128], sigma, alpha) for _ in range(20)])
+            for blur in ('separable', 'fft'):
+                std, correlation = statistics(
+                    [elastic.generate_coarse_elastic_flow([128, 128], sigma, alpha, grid_spacing=sigma // 4, blur=blur)
+                     for _ in range(20)])
+                self.assertAllClose(std, base_std, rtol=0.15)
+                self.assertAllClose(correlation, base_correlation, atol=0.1)
+
+        # Without a control grid (small sigma or image) the default is the full resolution flow, never slower
+        for image_size, sigma in (([1024, 1024], 5), ([128, 128], 9)):
+            tf.random.set_seed(1)
+            flow = elastic.generate_coarse_elastic_flow(image_size, sigma, 4.0)
+            tf.random.set_seed(1)
+            self.assertAllEqual(flow, elastic.generate_random_elastic_flow(image_size, sigma, 4.0))
+
+    def test_randomize_flow(self):
+        flow = elastic.generate_coarse_elastic_flow([64, 64], 8, self.alpha)
+        randomized = elastic.randomize_flow(flow)
+        # The randomized flow keeps the shape and the magnitudes (up to the order)
+        self.assertShapeEqual(randomized.numpy(), flow)
+        self.assertAllClose(tf.sort(tf.reshape(tf.abs(randomized), [-1])), tf.sort(tf.reshape(tf.abs(flow), [-1])))
+
+    def test_elastic_flow_bank(self):
+        flow_bank = elastic.ElasticFlowBank([32, 48], 8, self.alpha, pool_size=4, refresh_rate=0.5,
+                                            eviction='random')
+        self.assertEqual(flow_bank.memory_bytes, 4 * 32 * 48 * 2 * 4)
+
+        # Draws work in a dataset map and are counted
+        dataset = tf.data.Dataset.range(8).map(lambda _: flow_bank.draw())
+        for flow in dataset:
+            self.assertAllEqual(tf.shape(flow), [32, 48, 2])
+        flow_bank.refresh(2)
+        statistics = flow_bank.statistics()
+        self.assertEqual(statistics['draws'], 8)
+        self.assertGreaterEqual(statistics['refreshes'], 2)
+
+        # Concurrent fifo refreshes replace different slots, every flow of the pool is replaced once
+        flow_bank = elastic.ElasticFlowBank([32, 48], 8, self.alpha, pool_size=4, refresh_rate=1.0)
+        initial_flows = tf.identity(flow_bank._flows)
+        dataset = tf.data.Dataset.range(4).map(lambda _: flow_bank.draw(), num_parallel_calls=4)
+        for _ in dataset:
+            pass
+        for slot in range(4):
+            self.assertNotAllEqual(flow_bank._flows[slot], initial_flows[slot])
+
+        with self.assertRaises(ValueError):
+            elastic.ElasticFlowBank([32, 48], 8, self.alpha, eviction='lru')
+
+    def test_warp_image_by_flow_compute_dtype(self):
+        org_image = tf.random.uniform([64, 64, 3], maxval=255, dtype=tf.int32)
+        org_image = tf.cast(org_image, tf.uint8)
+        flow = elastic.generate_random_elastic_flow([64, 64], self.sigma, self.alpha)
+        # The half precision warp keeps the dtype and is close to the float32 warp
+        trans_image = elastic.warp_image_by_flow(org_image, flow, compute_dtype=tf.float16)
+        self.assertEqual(trans_image.dtype, tf.uint8)
+        self.assertAllClose(tf.cast(trans_image, tf.float32),
+                            tf.cast(elastic.warp_image_by_flow(org_image, flow), tf.float32), atol=2.0)
+
+    def test_warp_image_by_flow_nearest(self):
+        org_label = tf.random.uniform([64, 64, 1], maxval=5, dtype=tf.int32)
+        flow = elastic.generate_random_elastic_flow([64, 64], self.sigma, self.alpha)
+        # The nearest neighbour warp keeps the dtype and only moves existing values
+        trans_label = elastic.warp_image_by_flow(org_label, flow, interpolation='nearest')
+        self.assertEqual(trans_label.dtype, tf.int32)
+        self.assertNotAllEqual(trans_label, org_label)
+        self.assertAllInSet(trans_label, [0, 1, 2, 3, 4])
+
+    def test_warp_image_by_flow_tiles(self):
+        org_image = tf.random.uniform([100, 80, 3])
+        flow = elastic.generate_random_elastic_flow([100, 80], self.sigma, 20.0)
+        # The tiled warp is identical to the untiled warp
+        tiles = elastic.warp_image_by_flow_tiles(org_image.numpy(), flow.numpy(), tile_hw=(32, 32))
+        tiled_image = sampling.assemble_tiles(tiles, [100, 80, 3], tf.float32)
+        self.assertAllEqual(tiled_image, elastic.warp_image_by_flow(org_image, flow))
+
+    def test_generate_coarse_elastic_flow_3d(self):
+        flow = elastic.generate_coarse_elastic_flow_3d([16, 24, 32], 8, self.alpha)
+        # The flow shape should be DxHxWx3, and smooth along every axis including the slices
+        self.assertAllEqual(tf.shape(flow), [16, 24, 32, 3])
+        for axis in range(3):
+            diffs = tf.abs(tf.experimental.numpy.diff(flow, axis=axis))
+            self.assertLess(tf.reduce_max(diffs), self.alpha / 4)
+
+        # Same amplitude as the full resolution flow (one control point per voxel)
+        std = tf.math.reduce_std(tf.stack([elastic.generate_coarse_elastic_flow_3d([32, 32, 32], 9, 4.0)
+                                           for _ in range(4)]))
+        base_std = tf.math.reduce_std(tf.stack([elastic.generate_coarse_elastic_flow_3d([32, 32, 32], 9, 4.0,
+                                                                                        grid_spacing=1)
+                                                for _ in range(4)]))
+        self.assertAllClose(std, base_std, rtol=0.15)
+
+    def test_warp_volume_by_flow(self):
+        org_volume = tf.random.uniform([16, 24, 32, 2])
+        flow = elastic.generate_coarse_elastic_flow_3d([16, 24, 32], 8, self.alpha)
+        # The zero flow doesn't change the volume
+        self.assertAllClose(elastic.warp_volume_by_flow(org_volume, tf.zeros_like(flow)), org_volume)
+        trans_volume = elastic.warp_volume_by_flow(org_volume, flow)
+        self.assertNotAllEqual(trans_volume, org_volume)
+        self.assertTrue(tf.reduce_all(tf.math.is_finite(trans_volume)))
 
@@ -0,0 +1,55 @@
+import tensorflow as tf
+from tf_image_augmentations import instrumentation, seg_aug, affine
+
+
+class TestInstrumentation(tf.test.TestCase):
+    def setUp(self):
+        self.dummy_image = tf.random.uniform([64, 64, 3])
+        self.dummy_label = tf.random.uniform([64, 64, 1], maxval=3, dtype=tf.int32)
+
+    def test_eager(self):
+        with instrumentation.instrument() as recorder:
+            seg_aug.random_affine_transform(self.dummy_image, self.dummy_label, rotation_min=-1.0, rotation_max=1.0)
+            # A plan of the default values is the identity transformation
+            plan = seg_aug.sample_affine_plan([64, 64])
+            trans_image = seg_aug.apply_plan(plan, self.dummy_image)
+        stages = recorder.as_dict()
+        self.assertEqual(stages['seg_aug.random_affine_transform']['calls'], 1)
+        self.assertEqual(stages['sampling.sample_image']['calls'], 3)
+        self.assertEqual(stages['seg_aug.apply_plan']['output_bytes'], 64 * 64 * 4 * 4 + 64 * 64 * 3 * 4)
+        self.assertGreaterEqual(stages['seg_aug.random_affine_transform']['total_seconds'],
+                                stages['sampling.sample_image']['max_seconds'])
+        self.assertEqual(stages['seg_aug.apply_plan']['identity_transforms'], 1)
+        self.assertAllEqual(trans_image, self.dummy_image)
+
+        # Nothing is recorded outside of the context
+        affine.linear_transform_image(self.dummy_image, 0.3)
+        self.assertEqual(recorder.as_dict(), stages)
+
+    def test_dataset_map(self):
+        recorder = instrumentation.Recorder()
+        dataset = tf.data.Dataset.from_tensors((self.dummy_image, self.dummy_label)).repeat(3)
+        with instrumentation.instrument(recorder):
+            instrumented_dataset = dataset.map(seg_aug.elastic_augmentation_fcn(3, 5.0))
+        # A dataset traced outside of the context isn't instrumented
+        dataset = dataset.map(seg_aug.elastic_augmentation_fcn(3, 5.0))
+        for _ in dataset:
+            pass
+        self.assertEqual(recorder.as_dict(), {})
+
+        # The instrumented dataset records after the context
+        for _ in instrumented_dataset:
+            pass
+        stages = recorder.as_dict()
+        self.assertEqual(stages['seg_aug.elastic_deformation']['calls'], 3)
+        self.assertEqual(stages['elastic.generate_random_elastic_flow']['calls'], 3)
+        self.assertEqual(stages['seg_aug.apply_plan']['identity_transforms'], 0)
+        self.assertGreater(stages['seg_aug.elastic_deformation']['mean_seconds'], 0)
+
+        # Exported as summary scalars
+        writer = tf.summary.create_file_writer(self.get_temp_dir())
+        with writer.as_default():
+            recorder.write_summaries(step=0)
+        writer.flush()
+        recorder.reset()
+        self.assertEqual(recorder.as_dict(), {})
@@ -0,0 +1,84 @@
+import functools
+import os
+import numpy as np
+import tensorflow as tf
+from tf_image_augmentations import materialize, seg_aug
+
+
+class TestMaterialize(tf.test.TestCase):
+    def setUp(self):
+        images = np.random.uniform(size=[6, 32, 32, 3]).astype(np.float32)
+        labels = np.random.randint(0, 3, size=[6, 32, 32, 1]).astype(np.int32)
+        # Picklable builders, for the process pool
+        self.dataset_fn = functools.partial(tf.data.Dataset.from_tensor_slices, (images, labels))
+        self.augmentations = [functools.partial(seg_aug.random_affine_transform_fcn,
+                                                -0.5, 0.5, -0.2, 0.2, 0.8, 1.2, 0.5, 0.5),
+                              functools.partial(seg_aug.elastic_augmentation_fcn, 3, 5.0)]
+
+    def test_materialize(self):
+        for file_format in materialize.FORMATS:
+            output_dir = os.path.join(self.get_temp_dir(), file_format)
+            manifests = materialize.materialize(self.dataset_fn, self.augmentations, output_dir, num_epochs=2,
+                                                num_shards=2, seed=1, file_format=file_format)
+            self.assertEqual([manifest['num_samples'] for manifest in manifests], [3, 3, 3, 3])
+            samples = list(materialize.materialized_dataset(output_dir, with_seeds=True))
+            self.assertLen(samples, 12)
+            image, label, seed = samples[0]
+            self.assertEqual(label.dtype, tf.int32)
+            self.assertAllEqual(tf.shape(image), [32, 32, 3])
+            self.assertLen(list(materialize.materialized_dataset(output_dir, epoch=1)), 6)
+
+            # A sample is reproduced from its seed
+            source_image, source_label = next(iter(self.dataset_fn()))
+            augmentation_fcns = [augmentation() for augmentation in self.augmentations]
+            reproduced_image, reproduced_label = materialize.augment_element((source_image, source_label),
+                                                                             augmentation_fcns, seed)
+            self.assertAllEqual(reproduced_image, image)
+            self.assertAllEqual(reproduced_label, label)
+
+    def test_raw_shard_memory_map(self):
+        output_dir = self.get_temp_dir()
+        manifest, = materialize.materialize(self.dataset_fn, self.augmentations, output_dir, file_format='raw')
+        images, labels = materialize.load_raw_shard(output_dir, manifest)
+        self.assertIsInstance(images, np.memmap)
+        self.assertAllEqual(images.shape, [6, 32, 32, 3])
+        self.assertAllEqual(next(iter(materialize.materialized_dataset(output_dir)))[1], labels[0])
+
+    def test_deterministic_and_resumable(self):
+        output_dirs = [os.path.join(self.get_temp_dir(), name) for name in ('serial', 'pool')]
+        materialize.materialize(self.dataset_fn, self.augmentations, output_dirs[0], num_shards=2, seed=3)
+        # The same seed gives identical files with a process pool
+        materialize.materialize(self.dataset_fn, self.augmentations, output_dirs[1], num_shards=2, num_workers=2,
+                                seed=3)
+        for name in ('epoch-00000-shard-00000-of-00002.tfrecord', 'epoch-00000-shard-00001-of-00002.tfrecord'):
+            with open(os.path.join(output_dirs[0], name), 'rb') as serial, \
+                    open(os.path.join(output_dirs[1], name), 'rb') as pool:
+                self.assertEqual(serial.read(), pool.read())
+
+        # Finished shards are skipped, an unfinished shard is written again
+        finished_path = os.path.join(output_dirs[0], 'epoch-00000-shard-00000-of-00002.tfrecord')
+        finished_mtime = os.path.getmtime(finished_path)
+        os.remove(os.path.join(output_dirs[0], 'epoch-00000-shard-00001-of-00002.json'))
+        materialize.materialize(self.dataset_fn, self.augmentations, output_dirs[0], num_shards=2, seed=3)
+        self.assertEqual(os.path.getmtime(finished_path), finished_mtime)
+        self.assertLen(materialize.shard_manifests(output_dirs[0]), 2)
+
+        # A finished shard of another config isn't skipped
+        with self.assertRaises(ValueError):
+            materialize.materialize(self.dataset_fn, self.augmentations, output_dirs[0], num_shards=2, seed=4)
+        with self.assertRaises(ValueError):
+            materialize.materialize(self.dataset_fn, self.augmentations[:1], output_dirs[0], num_shards=2, seed=3)
+
+    def test_empty_shards_and_failures(self):
+        output_dir = os.path.join(self.get_temp_dir(), 'empty')
+        # More shards than samples, the extra shards are empty
+        manifests = materialize.materialize(self.dataset_fn, self.augmentations, output_dir, num_shards=8)
+        self.assertEqual([manifest['num_samples'] for manifest in manifests], [1] * 6 + [0] * 2)
+        self.assertLen(list(materialize.materialized_dataset(output_dir)), 6)
+
+        # A shard that fails leaves no partial files
+        output_dir = os.path.join(self.get_temp_dir(), 'failed')
+        with self.assertRaises(ValueError):
+            materialize.materialize(lambda: tf.data.Dataset.range(2).map(lambda i: tf.zeros([i + 1])), [],
+                                    output_dir, file_format='raw')
+        self.assertEqual(os.listdir(output_dir), [])
@@ -0,0 +1,121 @@
+import tensorflow as tf
+import tensorflow_addons as tfa
+from tf_image_augmentations import sampling
+
+
+class TestSampling(tf.test.TestCase):
+    def setUp(self):
+        self.image_dims = (64, 48, 3)
+        self.dummy_image = tf.random.uniform(self.image_dims, maxval=255, dtype=tf.int32)
+        self.grid = sampling.identity_grid(self.image_dims[:2])
+
+    def test_identity_grid(self):
+        # The grid holds the coordinates of every pixel
+        self.assertAllEqual(tf.shape(self.grid), [64, 48, 2])
+        self.assertAllEqual(self.grid[5, 7], [5.0, 7.0])
+
+    def test_flip_grid(self):
+        # Flipping the grid is the same as flipping the image
+        flipped_grid = sampling.flip_grid(self.grid, self.image_dims[:2], True, False)
+        self.assertAllEqual(sampling.sample_nearest(self.dummy_image, flipped_grid),
+                            tf.image.flip_left_right(self.dummy_image))
+        flipped_grid = sampling.flip_grid(self.grid, self.image_dims[:2], False, True)
+        self.assertAllEqual(sampling.sample_nearest(self.dummy_image, flipped_grid),
+                            tf.image.flip_up_down(self.dummy_image))
+
+    def test_sample_nearest(self):
+        # The identity grid doesn't change the image and keeps the dtype
+        self.assertAllEqual(sampling.sample_nearest(self.dummy_image, self.grid), self.dummy_image)
+
+        # Out of image points take the fill value, or the edge if there is none
+        shifted_grid = self.grid + [0.0, 10.0]
+        trans_image = sampling.sample_nearest(self.dummy_image, shifted_grid, fill_value=0)
+        self.assertAllEqual(trans_image[:, :-10], self.dummy_image[:, 10:])
+        self.assertAllEqual(trans_image[:, -10:], tf.zeros_like(trans_image[:, -10:]))
+        trans_image = sampling.sample_nearest(self.dummy_image, shifted_grid)
+        self.assertAllEqual(trans_image[:, -1], self.dummy_image[:, -1])
+
+    def test_sample_bilinear(self):
+        # Half pixel shifts average the neighbouring pixels
+        float_image = tf.cast(self.dummy_image, tf.float32)
+        trans_image = sampling.sample_bilinear(float_image, self.grid + [0.5, 0.0])
+        self.assertAllClose(trans_image[:-1], (float_image[:-1] + float_image[1:]) / 2)
+
+    def test_sample_image_batch(self):
+        # A batch of grids samples every image by its own grid
+        dummy_batch = tf.stack([self.dummy_image, self.dummy_image])
+        grids = tf.stack([self.grid, sampling.flip_grid(self.grid, self.image_dims[:2], True, False)])
+        trans_batch = sampling.sample_image(dummy_batch, grids, 'nearest')
+        self.assertAllEqual(trans_batch[0], self.dummy_image)
+        self.assertAllEqual(trans_batch[1], tf.image.flip_left_right(self.dummy_image))
+
+        with self.assertRaises(ValueError):
+            sampling.sample_image(self.dummy_image, self.grid, 'bicubic')
+
+    def test_identity_grid_cache(self):
+        # Static image sizes share the same grid
+        self.assertIs(sampling.identity_grid([64, 48]), sampling.identity_grid((64, 48)))
+        traced_grid = tf.function(lambda: sampling.identity_grid(tf.constant([64, 48])))()
+        self.assertAllEqual(traced_grid, self.grid)
+
+    def test_sample_bilinear_compute_dtype(self):
+        # float32 is the same as tfa interpolate_bilinear, also out of the image (clamped)
+        float_image = tf.cast(self.dummy_image, tf.float32)
+        grid = self.grid + tf.random.uniform([64, 48, 2], minval=-3.0, maxval=3.0)
+        expected = tfa.image.interpolate_bilinear(float_image[None], tf.reshape(grid, [1, -1, 2]))
+        self.assertAllEqual(sampling.sample_bilinear(float_image, grid), tf.reshape(expected, [64, 48, 3]))
+
+        # Reduced precision keeps the image dtype and is close to float32
+        uint8_image = tf.cast(self.dummy_image, tf.uint8)
+        # bfloat16 has an 8 bit significand, a step of 1 above 128 before the blend rounding
+        for compute_dtype, atol in ((tf.float16, 2.0), (tf.bfloat16, 4.0)):
+            trans_image = sampling.sample_bilinear(uint8_image, grid, compute_dtype=compute_dtype)
+            self.assertEqual(trans_image.dtype, tf.uint8)
+            self.assertAllClose(tf.cast(trans_image, tf.float32),
+                                tf.cast(sampling.sample_bilinear(uint8_image, grid), tf.float32), atol=atol)
+
+    def test_resampling_bytes(self):
+        # Reduced precision and native dtype need less memory than float32
+        float32_bytes = sampling.estimate_resampling_bytes([512, 512, 3], tf.float32, 'bilinear')
+        self.assertLess(sampling.estimate_resampling_bytes([512, 512, 3], tf.uint8, 'bilinear', tf.float16),
+                        float32_bytes)
+        self.assertLess(sampling.estimate_resampling_bytes([512, 512, 3], tf.uint8, 'nearest'), float32_bytes)
+
+        # The same in the measured allocations, and the estimate is in the range of the measurement
+        image = tf.random.uniform([512, 512, 3], maxval=255.0)
+        grid = sampling.identity_grid([512, 512]) + 0.3
+        measured_float32_bytes = sampling.measure_resampling_bytes(image, grid, 'bilinear')
+        measured_float16_bytes = sampling.measure_resampling_bytes(tf.cast(image, tf.uint8), grid, 'bilinear',
+                                                                   tf.float16)
+        self.assertLess(measured_float16_bytes, measured_float32_bytes)
+        self.assertBetween(float32_bytes / measured_float32_bytes, 0.4, 2.5)
+
+    def test_sample_image_tiles(self):
+        # The assembled tiles are identical to the untiled sampling, for both interpolations
+        grid = self.grid + tf.random.uniform([64, 48, 2], minval=-6.0, maxval=6.0)
+        float_image = tf.cast(self.dummy_image, tf.float32)
+        for interpolation, fill_value in (('nearest', 0.0), ('bilinear', None), ('bilinear', -1.0)):
+            tiles = sampling.sample_image_tiles(float_image.numpy(),
+                                                lambda offset, size: grid[offset[0]:offset[0] + size[0],
+                                                                          offset[1]:offset[1] + size[1]],
+                                                [64, 48], [16, 20], interpolation, fill_value)
+            tiled_image = sampling.assemble_tiles(tiles, [64, 48, 3], tf.float32)
+            self.assertAllEqual(tiled_image, sampling.sample_image(float_image, grid, interpolation, fill_value))
+
+    def test_sample_volume(self):
+        dummy_volume = tf.random.uniform([6, 8, 10, 2])
+        grid = sampling.identity_grid_3d([6, 8, 10])
+        # The identity grid doesn't change the volume
+        self.assertAllEqual(sampling.sample_volume(dummy_volume, grid, 'nearest'), dummy_volume)
+        self.assertAllClose(sampling.sample_volume(dummy_volume, grid, 'bilinear'), dummy_volume)
+        # Trilinear sampling of a single slice is bilinear sampling
+        grid_2d = sampling.identity_grid([8, 10]) + tf.random.uniform([8, 10, 2], minval=-2.0, maxval=2.0)
+        grid = tf.concat([tf.fill([8, 10, 1], 2.0), grid_2d], axis=-1)[None]
+        self.assertAllClose(sampling.sample_image(dummy_volume, grid, 'bilinear')[0],
+                            sampling.sample_bilinear(dummy_volume[2], grid_2d))
+        # Flips
+        flipped_grid = sampling.flip_grid_3d(sampling.identity_grid_3d([6, 8, 10]), [6, 8, 10], [True, False, True])
+        self.assertAllEqual(sampling.sample_volume(dummy_volume, flipped_grid), dummy_volume[::-1, :, ::-1])
+        # The source window is only for images
+        with self.assertRaises(ValueError):
+            sampling.sample_image(dummy_volume, flipped_grid, source_offset=[0, 0], source_hw=[8, 10])
@@ -1,5 +1,5 @@
 import tensorflow as tf
-from tf_image_augmentations import seg_aug
+from tf_image_augmentations import seg_aug, elastic, sampling, instrumentation, binary_mask, affine
 
 
 class TestSegAug(tf.test.TestCase):
@@ -35,14 +35,261 @@ class TestSegAug(tf.test.TestCase):
         # The transformation should change the image
         self.assertNotAllEqual(trans_label1, self.dummy_label)
 
+    def test_random_affine_transform_legacy_pixels(self):
+        def legacy_random_affine_transform(inputs):
+            # The original implementation: flips, then the truncated coordinates scattered to the new image
+            flag_flip_lr = tf.random.uniform(shape=[], minval=0.0, maxval=1.0) < 0.5
+            flag_flip_ud = tf.random.uniform(shape=[], minval=0.0, maxval=1.0) < 0.5
+            rot_angle = tf.random.uniform(shape=[], minval=-1.0, maxval=1.0)
+            shear_factor = tf.random.uniform(shape=[], minval=-0.2, maxval=0.2)
+            zoom_h, zoom_w = tf.unstack(tf.random.uniform(shape=(2,), minval=0.8, maxval=1.2))
+            if flag_flip_lr:
+                inputs = tf.image.flip_left_right(inputs)
+            if flag_flip_ud:
+                inputs = tf.image.flip_up_down(inputs)
+            trans_mat = affine.generate_rotation_matrix(rot_angle) @ affine.generate_shear_matrix(shear_factor) @ \
+                affine.generate_zoom_matrix(zoom_h, zoom_w)
+            org_coords, new_coords = affine.linear_transform_coords(tf.shape(inputs), trans_mat)
+            return affine.linear_transform_from_coords(inputs, org_coords, new_coords)
+
+        # The same seed gives the same pixels as the original implementation
+        for seed in range(4):
+            tf.random.set_seed(seed)
+            expected_image = legacy_random_affine_transform(self.dummy_image)
+            tf.random.set_seed(seed)
+            trans_image, _ = seg_aug.random_affine_transform(self.dummy_image, self.dummy_label,
+                                                             -1.0, 1.0, -0.2, 0.2, 0.8, 1.2, 0.5, 0.5)
+            self.assertAllEqual(trans_image, expected_image)
+
+    def test_apply_plan(self):
+        # A plan applies the same geometry to any number of tensors, each keeps its dtype and channels
+        dummy_weights = tf.random.uniform([256, 256, 2], dtype=tf.float32)
+        tensors = {'image': self.dummy_image, 'label': self.dummy_label, 'weights': dummy_weights}
+        plan = seg_aug.sample_affine_plan([256, 256], rotation_min=-1.0, rotation_max=1.0,
+                                          zoom_min=0.5, zoom_max=2.0, rate_flip_lr=0.5)
+        trans_tensors = seg_aug.apply_plan(plan, tensors,
+                                           interpolation={'image': 'bilinear', 'label': 'nearest',
+                                                          'weights': 'nearest'})
+        self.assertEqual(trans_tensors['image'].dtype, tf.int32)
+        self.assertShapeEqual(trans_tensors['weights'].numpy(), dummy_weights)
+        self.assertAllEqual(trans_tensors['label'], seg_aug.apply_plan(plan, self.dummy_label))
+
+        # The same for the elastic plan
+        plan = seg_aug.sample_elastic_plan([256, 256], 3, 5.0)
+        trans_label1, trans_label2 = seg_aug.apply_plan(plan, (self.dummy_label, self.dummy_label), 'bilinear')
+        self.assertAllEqual(trans_label1, trans_label2)
+        self.assertNotAllEqual(trans_label1, self.dummy_label)
+
+    def test_tensors_fcn(self):
+        # The closures map over dataset elements of any structure
+        dataset = tf.data.Dataset.from_tensors({'image': self.dummy_image, 'label': self.dummy_label})
+        dataset = dataset.map(seg_aug.random_affine_transform_tensors_fcn('nearest', -1.0, 1.0, 0.0, 0.0,
+                                                                          1.0, 1.0, 0.5, 0.5))
+        dataset = dataset.map(seg_aug.elastic_augmentation_tensors_fcn(3, 0.1))
+        element = next(iter(dataset))
+        self.assertShapeEqual(element['image'].numpy(), self.dummy_image)
+
+        dataset = tf.data.Dataset.from_tensors((self.dummy_label, self.dummy_label, self.dummy_label))
+        dataset = dataset.map(seg_aug.elastic_augmentation_tensors_fcn(3, 0.1))
+        trans_label1, trans_label2, trans_label3 = next(iter(dataset))
+        self.assertAllEqual(trans_label1, trans_label3)
+
+    def test_geometric_pipeline(self):
+        # An empty pipeline doesn't change the tensors
+        trans_image, trans_label = seg_aug.GeometricPipeline()(self.dummy_image, self.dummy_label)
+        self.assertAllEqual(trans_image, self.dummy_image)
+        self.assertAllEqual(trans_label, self.dummy_label)
+
+        # The operations are composed in order, a certain flip then a rotation by pi is the identity up to the flips
+        pipeline = seg_aug.GeometricPipeline().flip(1.0, 1.0).affine(rotation_min=3.14159265, rotation_max=3.14159265)
+        self.assertAllEqual(pipeline(self.dummy_image), self.dummy_image)
+
+        # The image and label should remain compatible after the combined transformation
+        pipeline = seg_aug.GeometricPipeline().flip(0.5, 0.5).affine(-1.0, 1.0, -0.5, 0.5, 0.5, 2.0).elastic(3, 5.0)
+        dataset = tf.data.Dataset.from_tensors((self.dummy_label, self.dummy_label)).map(pipeline)
+        trans_label1, trans_label2 = next(iter(dataset))
+        self.assertAllEqual(trans_label1, trans_label2)
+        self.assertNotAllEqual(trans_label1, self.dummy_label)
+
+    def test_augmentation_policy(self):
+        # Operations that can't change the image are dropped, the tensors are returned as is
+        policy = seg_aug.AugmentationPolicy().flip(0.0, 0.0).affine(0.0, -1.0, 1.0).affine(1.0).elastic(1.0, 3, 0.0)
+        trans_image, trans_label = policy(self.dummy_image, self.dummy_label)
+        self.assertAllEqual(trans_image, self.dummy_image)
+        self.assertAllEqual(trans_label, self.dummy_label)
+
+        # Flips only are reversed, and match the resampled flips
+        policy = seg_aug.AugmentationPolicy().flip(1.0, 1.0)
+        trans_image = policy(self.dummy_image)
+        self.assertAllEqual(trans_image, tf.image.flip_up_down(tf.image.flip_left_right(self.dummy_image)))
+        self.assertAllEqual(trans_image, seg_aug.GeometricPipeline().flip(1.0, 1.0)(self.dummy_image))
+
+        # Certain operations are composed in order like the pipeline
+        policy = seg_aug.AugmentationPolicy().flip(1.0, 0.0).affine(1.0, rotation_min=0.5, rotation_max=0.5)
+        pipeline = seg_aug.GeometricPipeline().flip(1.0, 0.0).affine(rotation_min=0.5, rotation_max=0.5)
+        self.assertAllEqual(policy(self.dummy_image), pipeline(self.dummy_image))
+
+        # num_ops operations are considered per sample
+        policy = seg_aug.AugmentationPolicy(num_ops=1).affine(1.0, -1.0, 1.0).elastic(1.0, 3, 5.0)
+        self.assertEqual(sum(int(op_applied) for op_applied in policy.sample_applied()), 1)
+
+        # The image and label remain compatible, and the samples with no geometric operation skip the resampling
+        policy = seg_aug.AugmentationPolicy().flip(0.5, 0.5).affine(0.5, -1.0, 1.0, -0.2, 0.2, 0.8, 1.2)\
+            .elastic(0.5, 3, 5.0)
+        dataset = tf.data.Dataset.from_tensors((self.dummy_label, self.dummy_label)).repeat(40)
+        with instrumentation.instrument() as recorder:
+            dataset = dataset.map(policy)
+        for trans_label1, trans_label2 in dataset:
+            self.assertAllEqual(trans_label1, trans_label2)
+        stages = recorder.as_dict()
+        self.assertGreater(stages['seg_aug.AugmentationPolicy.apply']['skipped_resamplings'], 0)
+        self.assertLess(stages['seg_aug.apply_plan']['calls'], 40)
+
+    def test_transform_annotations(self):
+        object_mask = tf.pad(tf.ones([60, 40, 1]), [[100, 96], [30, 186], [0, 0]])
+        boxes = binary_mask.tight_box_coordinates(object_mask)
+        # A quarter turn and flips move the pixel centers to pixel centers, the boxes match the warped mask boxes
+        plan = seg_aug.sample_affine_plan([256, 256], rotation_min=1.5707964, rotation_max=1.5707964,
+                                          rate_flip_lr=1.0, pixel_centers=True)
+        self.assertAllClose(seg_aug.transform_boxes(plan, boxes),
+                            binary_mask.tight_box_coordinates(seg_aug.apply_plan(plan, object_mask)), atol=1e-4)
+
+        # The points move to where the grid samples them from, also for a batch plan and ragged polygons
+        keypoints = tf.random.uniform([10, 2], minval=80.0, maxval=176.0)
+        plan = seg_aug.sample_affine_plan([256, 256], -1.0, 1.0, -0.2, 0.2, 0.8, 1.2, 0.5, 0.5, pixel_centers=True)
+        moved_keypoints = seg_aug.transform_points(plan, keypoints)
+        self.assertAllClose(sampling.sample_bilinear(plan['grid'], moved_keypoints[:, None])[:, 0], keypoints,
+                            atol=1e-2)
+        batch_plan = seg_aug.sample_affine_plan([256, 256], -1.0, 1.0, -0.2, 0.2, 0.8, 1.2, 0.5, 0.5, batch_size=3,
+                                                pixel_centers=True)
+        moved_keypoints = seg_aug.transform_points(batch_plan, tf.stack([keypoints] * 3))
+        self.assertAllClose(sampling.sample_bilinear(batch_plan['grid'], moved_keypoints[:, :, None])[:, :, 0],
+                            tf.stack([keypoints] * 3), atol=1e-2)
+        # The default (truncated) plans move the boxes and points within a pixel of the warped pixels
+        for rotation in (0.7, -0.4, 1.2):
+            plan = seg_aug.sample_affine_plan([256, 256], rotation, rotation, 0.1, 0.1, 1.1, 1.1, rate_flip_lr=1.0)
+            self.assertAllClose(seg_aug.transform_boxes(plan, boxes),
+                                binary_mask.tight_box_coordinates(seg_aug.apply_plan(plan, object_mask)),
+                                atol=1.0 / 255)
+        plan = seg_aug.sample_affine_plan([256, 256], -1.0, 1.0, -0.2, 0.2, 0.8, 1.2, 0.5, 0.5)
+        moved_keypoints = seg_aug.transform_points(plan, keypoints)
+        self.assertAllClose(sampling.sample_nearest(plan['grid'], moved_keypoints[:, None])[:, 0],
+                            tf.round(keypoints), atol=1.0)
+        plan = seg_aug.sample_affine_plan([256, 256], -1.0, 1.0, -0.2, 0.2, 0.8, 1.2, 0.5, 0.5, pixel_centers=True)
+
+        polygons = tf.RaggedTensor.from_row_lengths(keypoints, [3, 7])
+        moved_polygons = seg_aug.transform_points(plan, polygons)
+        self.assertAllClose(moved_polygons.flat_values, seg_aug.transform_points(plan, keypoints))
+
+        # The elastic flow is sampled at the points, a first order inverse of the warp
+        plan = seg_aug.sample_elastic_plan([256, 256], 8, 5.0)
+        moved_keypoints = seg_aug.transform_points(plan, keypoints)
+        self.assertAllClose(sampling.sample_bilinear(plan['grid'], moved_keypoints[:, None])[:, 0], keypoints,
+                            atol=0.5)
+
+        # The closures for (image, label, annotations) elements
+        annotations = {'boxes': boxes[None], 'keypoints': keypoints}
+        dataset = tf.data.Dataset.from_tensors((self.dummy_image, object_mask, annotations))
+        dataset = dataset.map(seg_aug.random_affine_transform_annotated_fcn(-1.0, 1.0, 0.0, 0.0, 1.0, 1.0, 0.5, 0.5))
+        dataset = dataset.map(seg_aug.elastic_augmentation_annotated_fcn(8, 5.0))
+        trans_image, trans_mask, trans_annotations = next(iter(dataset))
+        self.assertAllEqual(tf.shape(trans_annotations['boxes']), [1, 4])
+        self.assertNotAllClose(trans_annotations['keypoints'], keypoints)
+        with self.assertRaises(ValueError):
+            seg_aug.transform_annotations(plan, {'masks': keypoints})
+
+    def test_object_crop_augmentation(self):
+        object_mask = tf.pad(tf.ones([60, 40, 1]), [[100, 96], [30, 186], [0, 0]])
+        # Without augmentation the output is the object box
+        crop_image, crop_mask = seg_aug.object_crop_augmentation((self.dummy_image, object_mask), object_mask, [60, 40])
+        self.assertAllEqual(crop_image, self.dummy_image[100:160, 30:70])
+        self.assertAllEqual(crop_mask, tf.ones([60, 40, 1]))
+
+        # Cropping the expanded ROI first gives the same result as warping the full frame
+        pipeline = seg_aug.GeometricPipeline().flip(0.5, 0.5).affine(-1.0, 1.0, -0.2, 0.2, 0.8, 1.2).elastic(3, 5.0)
+        plan = seg_aug.sample_object_crop_plan(object_mask, [256, 256], [64, 64], 0.05, pipeline)
+        crop_image = seg_aug.apply_object_crop_plan(plan, self.dummy_image)
+        self.assertAllEqual(crop_image, sampling.sample_image(self.dummy_image, plan['grid'], fill_value=0.0))
+        self.assertAllEqual(seg_aug.apply_object_crop_plan(plan, self.dummy_label, 'bilinear'),
+                            sampling.sample_image(self.dummy_label, plan['grid'], 'bilinear', fill_value=0.0))
+        self.assertAllEqual(tf.shape(crop_image), [64, 64, 3])
+
+        # The closure in a dataset map
+        dataset = tf.data.Dataset.from_tensors((self.dummy_image, object_mask))
+        dataset = dataset.map(seg_aug.object_crop_augmentation_fcn([32, 32], 0.1, pipeline))
+        crop_image, crop_mask = next(iter(dataset))
+        self.assertAllEqual(tf.shape(crop_mask), [32, 32, 1])
+
+    def test_random_affine_transform_index_cache(self):
+        index_cache = affine.AffineIndexCache(max_entries=8)
+        # The image and label should remain compatible with the cached warps
+        dataset = tf.data.Dataset.from_tensors((self.dummy_label, self.dummy_label)).repeat(4)
+        dataset = dataset.map(seg_aug.random_affine_transform_fcn(-1.0, 1.0, -0.2, 0.2, 0.8, 1.2, 0.5, 0.5,
+                                                                  index_cache), num_parallel_calls=4)
+        for trans_label1, trans_label2 in dataset:
+            self.assertAllEqual(trans_label1, trans_label2)
+            self.assertNotAllEqual(trans_label1, self.dummy_label)
+        self.assertEqual(index_cache.statistics()['misses'], 4)
+
+    def test_random_affine_transform_batch(self):
+        dummy_images = tf.stack([self.dummy_image] * 4)
+        dummy_labels = tf.stack([self.dummy_label] * 4)
+        # The batch should stay the same with the default values
+        trans_images, trans_labels = seg_aug.random_affine_transform_batch(dummy_images, dummy_labels)
+        self.assertAllEqual(trans_images, dummy_images)
+        self.assertAllEqual(trans_labels, dummy_labels)
+
+        # A certain flip should match the per-example flip
+        trans_images, trans_labels = seg_aug.random_affine_transform_batch(dummy_images, dummy_labels,
+                                                                           rate_flip_lr=1.0, rate_flip_ud=1.0)
+        self.assertAllEqual(trans_images, tf.image.flip_up_down(tf.image.flip_left_right(dummy_images)))
+        self.assertAllEqual(trans_labels, tf.image.flip_up_down(tf.image.flip_left_right(dummy_labels)))
+
+        # The images and labels should remain compatible, and every sample gets its own transformation
+        trans_labels1, trans_labels2 = seg_aug.random_affine_transform_batch(dummy_labels, dummy_labels,
+                                                                             shear_min=-1.0, shear_max=1.0,
+                                                                             rotation_min=-1.0, rotation_max=1.0,
+                                                                             zoom_min=0.1, zoom_max=10.0,
+                                                                             rate_flip_lr=0.5, rate_flip_ud=0.5)
+        self.assertAllEqual(trans_labels1, trans_labels2)
+        self.assertNotAllEqual(trans_labels1[0], trans_labels1[1])
+
     def test_elastic_deformation(self):
         # The image and label should remain compatible after the transformation
         SIGMA = 3
         ALPHA = 0.1
-        trans_label1, trans_label2 = seg_aug.elastic_deformation(self.dummy_label, self.dummy_label, SIGMA, ALPHA)
+        trans_label1, trans_label2 = seg_aug.elastic_deformation(self.dummy_label, self.dummy_label, SIGMA, ALPHA,
+                                                                 label_interpolation='bilinear')
         self.assertAllEqual(trans_label1, trans_label2)
 
         # The transformation should change the image
         self.assertNotAllEqual(trans_label1, self.dummy_label)
 
+        # The labels are warped by nearest neighbour by default, the label values are kept exactly
+        class_label = tf.random.uniform([256, 256, 1], maxval=5, dtype=tf.int32)
+        trans_image, trans_label = seg_aug.elastic_deformation(self.dummy_label, class_label, SIGMA, 5.0)
+        self.assertEqual(trans_label.dtype, tf.int32)
+        self.assertNotAllEqual(trans_label, class_label)
+        float_label = tf.cast(class_label, tf.float32)
+        trans_image, trans_label = seg_aug.elastic_deformation(self.dummy_label, float_label, SIGMA, 5.0)
+        self.assertAllEqual(trans_label, tf.round(trans_label))
+
+        # The same with flows drawn from a flow bank
+        flow_bank = elastic.ElasticFlowBank([256, 256], 8, 5.0, pool_size=2)
+        trans_label1, trans_label2 = seg_aug.elastic_deformation(self.dummy_label, self.dummy_label, SIGMA, ALPHA,
+                                                                 flow_bank, label_interpolation='bilinear')
+        self.assertAllEqual(trans_label1, trans_label2)
+        self.assertNotAllEqual(trans_label1, self.dummy_label)
+        self.assertEqual(flow_bank.statistics()['draws'], 1)
 
+    def test_volume_augmentations(self):
+        dummy_volume = tf.random.uniform([16, 24, 32, 1])
+        # The volume and label should stay the same with the default values, and remain compatible otherwise
+        trans_volume, trans_label = seg_aug.random_affine_transform_3d(dummy_volume, dummy_volume)
+        self.assertAllEqual(trans_volume, dummy_volume)
+        dataset = tf.data.Dataset.from_tensors((dummy_volume, dummy_volume))
+        dataset = dataset.map(seg_aug.random_affine_transform_3d_fcn(-0.5, 0.5, -0.1, 0.1, 0.8, 1.2, 0.5))
+        dataset = dataset.map(seg_aug.elastic_augmentation_3d_fcn(8, 3.0, label_interpolation='bilinear'))
+        trans_volume, trans_label = next(iter(dataset))
+        self.assertAllClose(trans_volume, trans_label)
+        self.assertNotAllClose(trans_volume, dummy_volume)
@@ -13,6 +13,8 @@ class TestUtils(tf.test.TestCase):
         self.assertAllEqual(utils.image_shape_to_hw(img_shape_3d), img_shape_3d[:2])
         img_shape_4d = tf.random.uniform([4], maxval=500, dtype=tf.int32)
         self.assertAllEqual(utils.image_shape_to_hw(img_shape_4d), img_shape_4d[1:3])
+        with self.assertRaises(ValueError):
+            utils.image_shape_to_hw([1, 2, 3, 4, 5])
 
     def test_hwc_to_bhwc(self):
         img_shape_3d = tf.random.uniform([3], maxval=500, dtype=tf.int32)
@@ -30,6 +32,12 @@ class TestUtils(tf.test.TestCase):
         self.assertAllEqual(tf.shape(coords), [3, img_shape_3d[0] * img_shape_3d[1] * img_shape_3d[2]])
         self.assertAllEqual(tf.reduce_max(coords, axis=1), img_shape_3d - 1)
 
+    def test_image_hw_to_coordinates(self):
+        img_hw = tf.random.uniform([2], minval=1, maxval=10, dtype=tf.int32)
+        coords = utils.image_hw_to_coordinates(img_hw)
+        self.assertAllEqual(tf.shape(coords), [2, img_hw[0] * img_hw[1]])
+        self.assertAllEqual(tf.reduce_max(coords, axis=1), img_hw - 1)
+
     def test_image_to_coordinates(self):
         img_shape_3d = tf.random.uniform([3], maxval=10, dtype=tf.int32)
         dummy_img_3d = tf.random.uniform(img_shape_3d)
@@ -0,0 +1,59 @@
+import tensorflow as tf
+from tf_image_augmentations import xla, affine, elastic, seg_aug
+
+
+class TestXla(tf.test.TestCase):
+    def setUp(self):
+        self.dummy_image = tf.random.uniform([64, 64, 3])
+        self.dummy_label = tf.random.uniform([64, 64, 1])
+
+    def test_compile_augmentation(self):
+        compiled_fcn = xla.compile_augmentation(seg_aug.random_affine_transform_fcn(-1.0, 1.0, -0.2, 0.2, 0.8, 1.2,
+                                                                                    0.5, 0.5))
+        # The function traces only once for the same static signature
+        for _ in range(3):
+            trans_image, trans_label = compiled_fcn(tf.random.uniform([64, 64, 3]), self.dummy_label)
+            self.assertShapeEqual(trans_image.numpy(), self.dummy_image)
+        self.assertEqual(compiled_fcn.trace_count, 1)
+        self.assertEqual(xla.trace_counts()[compiled_fcn.name], compiled_fcn.trace_count)
+
+        # And retraces for a new one
+        compiled_fcn(tf.random.uniform([32, 32, 3]), tf.random.uniform([32, 32, 1]))
+        self.assertEqual(compiled_fcn.trace_count, 2)
+
+        # Closures of the same name are counted apart
+        other_fcn = xla.compile_augmentation(seg_aug.random_affine_transform_fcn(-0.5, 0.5, 0.0, 0.0, 1.0, 1.0,
+                                                                                 0.0, 0.0), jit_compile=False)
+        other_fcn(self.dummy_image, self.dummy_label)
+        self.assertNotEqual(other_fcn.name, compiled_fcn.name)
+        self.assertEqual(xla.trace_counts()[compiled_fcn.name], 2)
+        self.assertEqual(xla.trace_counts()[other_fcn.name], 1)
+
+    def test_input_signature(self):
+        compiled_fcn = xla.compile_augmentation(seg_aug.elastic_augmentation_fcn(3, 5.0),
+                                                input_signature=[xla.image_signature([64, 64, 3]),
+                                                                 xla.image_signature([64, 64, 1])])
+        for _ in range(2):
+            compiled_fcn(self.dummy_image, self.dummy_label)
+        self.assertEqual(compiled_fcn.trace_count, 1)
+
+    def test_public_functions_compile(self):
+        # Every public augmentation compiles with XLA
+        augmentations = [
+            lambda img, lbl: affine.linear_transform_image(img, 0.3, 0.1, 1.2, 0.9),
+            lambda img, lbl: affine.linear_transform_image_batch(tf.stack([img, img]), [0.3, 0.1], [0.0, 0.1],
+                                                                 [1.0, 1.1], [1.0, 0.9]),
+            lambda img, lbl: elastic.warp_image_by_flow(img, elastic.generate_random_elastic_flow([64, 64], 3, 5.0)),
+            lambda img, lbl: elastic.generate_coarse_elastic_flow([64, 64], 8, 5.0, upsampling='bilinear'),
+            lambda img, lbl: elastic.generate_coarse_elastic_flow([64, 64], 8, 5.0, blur='fft', upsampling='bilinear'),
+            lambda img, lbl: seg_aug.random_affine_transform(img, lbl, -1.0, 1.0, -0.2, 0.2, 0.8, 1.2, 0.5, 0.5),
+            lambda img, lbl: seg_aug.random_affine_transform_batch(tf.stack([img, img]), tf.stack([lbl, lbl]),
+                                                                   -1.0, 1.0, -0.2, 0.2, 0.8, 1.2, 0.5, 0.5),
+            lambda img, lbl: seg_aug.elastic_deformation(img, lbl, 3, 5.0),
+            lambda img, lbl: seg_aug.GeometricPipeline().flip(0.5, 0.5).affine(-1.0, 1.0).elastic(3, 5.0)(img, lbl),
+        ]
+        for augmentation in augmentations:
+            compiled_fcn = xla.compile_augmentation(augmentation)
+            compiled_fcn(self.dummy_image, self.dummy_label)
+            compiled_fcn(self.dummy_image, self.dummy_label)
+            self.assertEqual(compiled_fcn.trace_count, 1)
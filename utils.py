@@ -4,16 +4,18 @@ import tensorflow as tf
 
 
 def image_shape_to_hw(image_shape):
-    """Extract the height and width of the image from HW, HWC or BHWC"""
-    img_size = (-1, -1)
-    if len(image_shape) == 2:
+    """Extract the height and width of the image from HW, HWC or BHWC
+    The number of dimensions must be static (graph and XLA safe, no branching on tensor values)"""
+    image_shape = tf.convert_to_tensor(image_shape)
+    ndims = image_shape.shape[0] if image_shape.shape.rank == 1 else None
+    if ndims == 2:
         img_size = image_shape
-    elif len(image_shape) == 3:
+    elif ndims == 3:
         img_size = image_shape[:2]
-    elif len(image_shape) == 4:
+    elif ndims == 4:
         img_size = image_shape[1:3]
     else:
-        ValueError('image dimensions must be 2, 3, or 4')
+        raise ValueError('image dimensions must be 2, 3, or 4')
     return img_size
 
 
@@ -37,6 +39,15 @@ def image_dims_to_coordinates(img_dims):
     return hwc__sample__coords
 
 
+def image_hw_to_coordinates(img_hw):
+    """Generates a matrix of pixel coordinates (h, w) x pixel index from the image height and width, row major order
+    Unlike image_dims_to_coordinates a pixel is a single column regardless of the number of channels"""
+    h, w = tf.unstack(img_hw)
+    H, W = tf.meshgrid(tf.range(h), tf.range(w), indexing='ij')
+    hw__sample__coords = tf.stack([tf.reshape(H, [-1]), tf.reshape(W, [-1])], 0)
+    return hw__sample__coords
+
+
 def image_to_coordinates(image):
     """Transforms an image to a grid of its coordinates"""
     tf.assert_rank(image, 3, 'expected image format HWC (3D)')
@@ -0,0 +1,52 @@
+import collections
+import functools
+import tensorflow as tf
+
+"""Graph mode and XLA compilation of the augmentations, with retracing counters
+The augmentations in affine, elastic and seg_aug have static output shapes for static input shapes and compile with
+tf.function(jit_compile=True) on CPU, except:
+affine.linear_transform_coords (trimmed coordinates, value dependent shapes),
+elastic.generate_coarse_elastic_flow with the default bicubic upsampling (use upsampling='bilinear'),
+elastic.ElasticFlowBank (variables, use it in graph mode without jit_compile)"""
+
+# Number of traces of every compiled function, by TracedFunction.name
+TRACE_COUNTS = collections.Counter()
+
+
+class TracedFunction:
+    """
+    tf.function wrapper that counts the traces of the python function, trace_count should stay 1 per static
+    input signature (shapes, dtypes and python arguments), a higher count means the function retraces
+    name: the python function name and a unique id, so lambdas and closures of the same name are counted apart
+    """
+    def __init__(self, python_function, jit_compile=True, input_signature=None):
+        self.python_function = python_function
+        self.name = f"{getattr(python_function, '__qualname__', type(python_function).__name__)}#{id(self)}"
+        self.trace_count = 0
+
+        @functools.wraps(python_function)
+        def counted_function(*args, **kwargs):
+            # Python side effects run only while tracing
+            self.trace_count += 1
+            TRACE_COUNTS[self.name] += 1
+            return python_function(*args, **kwargs)
+
+        self._function = tf.function(counted_function, jit_compile=jit_compile, input_signature=input_signature)
+
+    def __call__(self, *args, **kwargs):
+        return self._function(*args, **kwargs)
+
+
+def compile_augmentation(python_function, jit_compile=True, input_signature=None):
+    """Compiles an augmentation (or closure for TF dataset map) with XLA and counts its traces"""
+    return TracedFunction(python_function, jit_compile, input_signature)
+
+
+def image_signature(img_dims, dtype=tf.float32):
+    """A static tf.TensorSpec for input_signature, fixes the shape so the function traces only once"""
+    return tf.TensorSpec(shape=img_dims, dtype=dtype)
+
+
+def trace_counts():
+    """The number of traces of every compiled function"""
+    return dict(TRACE_COUNTS)